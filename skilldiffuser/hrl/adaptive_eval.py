@@ -0,0 +1,107 @@
+import numpy as np
+from scipy import stats
+
+
+def wilson_interval(successes, trials, confidence=0.95):
+    """Wilson score interval of a success rate"""
+    if trials == 0:
+        return 0.0, 1.0
+    z = stats.norm.ppf(0.5 + confidence / 2)
+    p = successes / trials
+    denominator = 1 + z ** 2 / trials
+    center = (p + z ** 2 / (2 * trials)) / denominator
+    half_width = z * np.sqrt(p * (1 - p) / trials + z ** 2 / (4 * trials ** 2)) / denominator
+    return float(max(center - half_width, 0.0)), float(min(center + half_width, 1.0))
+
+
+def beta_interval(successes, trials, confidence=0.95):
+    """Equal tailed credible interval of a success rate under the Jeffreys prior Beta(1/2, 1/2)"""
+    a, b = successes + 0.5, trials - successes + 0.5
+    return float(stats.beta.ppf((1 - confidence) / 2, a, b)), float(stats.beta.ppf((1 + confidence) / 2, a, b))
+
+
+INTERVALS = {'wilson': wilson_interval, 'beta': beta_interval}
+
+
+class AdaptiveEvalSchedule:
+    """
+    Sequential allocation of eval episodes between keys (LOReL instructions), with a confidence interval of the
+    success rate of every key.
+
+    Every key gets min_episodes episodes, then the episodes go to the keys with the widest intervals. A key is
+    done once its interval is narrower than target_width or it has had max_episodes episodes, and the evaluation
+    once every key is done or budget episodes were run. The i-th episode of a key is given as (key, i), so it can
+    start from the i-th state of the reset pool.
+    An episode of a key can be a group of rollouts (the rephrasals of an instruction), their successes are counted
+    as separate trials of the key.
+    """
+
+    def __init__(self, keys, max_episodes, min_episodes=10, target_width=0.2, budget=None, interval='wilson',
+                 confidence=0.95):
+        self.keys = list(keys)
+        self.max_episodes = max_episodes
+        self.min_episodes = min(min_episodes, max_episodes)
+        self.target_width = target_width
+        self.budget = budget if budget is not None else max_episodes * len(self.keys)
+        self.interval = INTERVALS[interval]
+        self.confidence = confidence
+        self.episodes = {k: 0 for k in self.keys}  # scheduled, finished or not
+        self.successes = {k: 0 for k in self.keys}
+        self.trials = {k: 0 for k in self.keys}
+
+    def ci(self, key):
+        return self.interval(self.successes[key], self.trials[key], self.confidence)
+
+    def width(self, key):
+        low, high = self.ci(key)
+        return high - low
+
+    def is_done(self, key):
+        return (self.episodes[key] >= self.max_episodes
+                or (self.episodes[key] >= self.min_episodes and self.width(key) <= self.target_width))
+
+    @property
+    def used(self):
+        return sum(self.episodes.values())
+
+    def next_episodes(self, n=1):
+        """
+        Up to n (key, episode index) to run before the next update, empty when the evaluation is done.
+        The keys below min_episodes come first, then the widest intervals, one episode per key in turn.
+        """
+        keys = sorted((k for k in self.keys if not self.is_done(k)),
+                      key=lambda k: (self.episodes[k] >= self.min_episodes, -self.width(k)))
+        episodes = []
+        while keys and len(episodes) < n and self.used < self.budget:
+            for k in list(keys):
+                if len(episodes) == n or self.used == self.budget:
+                    break
+                episodes.append((k, self.episodes[k]))
+                self.episodes[k] += 1
+                if self.episodes[k] >= self.max_episodes:
+                    keys.remove(k)
+        return episodes
+
+    def update(self, key, successes):
+        """Record the successes of a finished episode (or group of rollouts) of key"""
+        successes = np.atleast_1d(successes)
+        self.successes[key] += int(np.sum(successes))
+        self.trials[key] += len(successes)
+
+    def success_rates(self):
+        return {k: self.successes[k] / max(self.trials[k], 1) for k in self.keys}
+
+    def metrics(self):
+        widths = [self.width(k) for k in self.keys]
+        rates = self.success_rates()
+        # every key weighs its rollouts per episode, as in a full evaluation, however many episodes it got
+        weights = [self.trials[k] / max(self.episodes[k], 1) for k in self.keys]
+        return {
+            'success_rate': float(np.average([rates[k] for k in self.keys], weights=weights))
+            if sum(weights) > 0 else 0.0,
+            'eval_episodes': self.used,
+            'eval_budget': self.budget,
+            'ci_width_mean': float(np.mean(widths)),
+            'ci_width_max': float(np.max(widths)),
+            'instrs_converged': int(sum(w <= self.target_width for w in widths)),
+        }
@@ -0,0 +1,244 @@
+"""
+Throughput of the evaluation loop: steps/sec, decisions/sec and the latency of every stage of a decision.
+
+Runs LOReL composition episodes with a randomly initialized model, or the model of `checkpoint_path`,
+e.g. on a machine without MuJoCo:
+
+    python benchmark_eval.py env=lorel_fake env.step_cost=0.002 benchmark.output=eval_benchmark.json
+
+(diffuser.n_diffusion_steps can be lowered to keep CPU runs short, the latency of a denoising step is what matters).
+
+The stages are timed around the calls of eval_episode (or parallel_eval_episodes with benchmark.n_envs > 1),
+so the loop itself is the one used by Trainer.evaluate. Nested stages (the diffusion sampling and the inverse
+dynamics within the plan) are also counted in their parent.
+"""
+import ast
+import functools
+import json
+import random
+import time
+from collections import defaultdict
+
+import hydra
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+from transformers import DistilBertTokenizer
+
+from env import LorlWrapper, make_env
+from eval import eval_episode, parallel_eval_episodes
+from main_hot import build_model, get_args
+from utils import LORL_COMPOSITION_INSTRS
+from vec_env import SubprocEnvs
+
+
+class EnvStats:
+    """Zero mean and unit std in place of the ExpertDataset statistics used by the env wrappers"""
+
+    def __init__(self, state_dim, use_state):
+        self.state_mean = np.zeros(state_dim, dtype=np.float32)
+        self.state_std = np.ones(state_dim, dtype=np.float32)
+        self.kwargs = {'use_state': use_state}
+
+
+class StageTimer:
+    """
+    Wall clock time of the calls to the wrapped methods, grouped by stage.
+
+    The device is synchronized before and after every timed call, so GPU stages are not attributed to the next
+    stage that waits for them. A call nested in a call of the same stage (get_option calling get_options) is not
+    counted twice.
+    """
+
+    def __init__(self, device):
+        cuda = torch.device(device).type == 'cuda'
+        self.synchronize = torch.cuda.synchronize if cuda else (lambda: None)
+        self.times = defaultdict(list)
+        self.items = defaultdict(int)
+        self.active = set()
+        self.enabled = True
+
+    def wrap(self, obj, name, stage, count=None):
+        """Time obj.name as stage, count(output) is the number of items (e.g. episodes) of a call"""
+        fn = getattr(obj, name)
+
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            if not self.enabled or stage in self.active:
+                return fn(*args, **kwargs)
+            self.active.add(stage)
+            try:
+                self.synchronize()
+                start = time.perf_counter()
+                out = fn(*args, **kwargs)
+                self.synchronize()
+            finally:
+                self.active.discard(stage)
+            self.times[stage].append(time.perf_counter() - start)
+            self.items[stage] += count(out) if count is not None else 1
+            return out
+
+        setattr(obj, name, timed)
+
+    def summary(self):
+        summary = {}
+        for stage, times in self.times.items():
+            times_ms = 1000 * np.array(times)
+            summary[stage] = {'calls': len(times),
+                              'items': self.items[stage],
+                              'total_s': float(times_ms.sum() / 1000),
+                              'mean_ms': float(times_ms.mean()),
+                              'p50_ms': float(np.percentile(times_ms, 50)),
+                              'p95_ms': float(np.percentile(times_ms, 95))}
+        return summary
+
+
+def time_model(timer, model, ema_diffusion_model):
+    timer.wrap(model.lm, 'forward', 'lm')
+    if model.method == 'traj_option':
+        timer.wrap(model.option_selector.option_dt.embed_state, 'forward', 'embed_state')
+    if model.method != 'vanilla':
+        for name in ('get_option', 'get_cached_option', 'get_options'):
+            # get_options returns the options of a batch of episodes
+            timer.wrap(model.option_selector, name, 'option',
+                       count=lambda out: 1 if out[0].dim() == 1 else len(out[0]))
+        timer.wrap(ema_diffusion_model, 'conditional_sample', 'diffusion', count=len)
+        timer.wrap(model, 'inverse_dynamics', 'inverse_dynamics', count=len)
+    # get_action returns the planned actions of one episode, get_actions one plan per episode
+    timer.wrap(model, 'get_action', 'plan')
+    timer.wrap(model, 'get_actions', 'plan', count=len)
+
+
+def run_episodes(args, bench, tasks, model, tokenizer, timer, envs, env, stats, device, ema_diffusion_model):
+    """Run one episode per task, returns the number of steps"""
+    words_dict = defaultdict(list)
+    if envs is not None:
+        results = parallel_eval_episodes(envs, tasks, False, tokenizer, model, bench.max_ep_len, args.model.K,
+                                         words_dict, device, ema_diffusion_model)
+        return sum(episode_length for _, episode_length, _, _, _ in results)
+
+    steps = 0
+    for task in tasks:
+        wrapper = LorlWrapper(env, stats, **task)
+        timer.wrap(wrapper, 'step', 'env_step')
+        with torch.no_grad():
+            _, episode_length, _, _, _, _, _ = eval_episode(
+                wrapper, False, tokenizer, model, bench.max_ep_len, args.model.K, words_dict, False, device,
+                ema_diffusion_model=ema_diffusion_model)
+        steps += episode_length
+    return steps
+
+
+def benchmark(cfg):
+    bench = cfg.benchmark
+    device = cfg.trainer.device
+
+    checkpoint = None
+    if cfg.checkpoint_path:
+        checkpoint = torch.load(hydra.utils.to_absolute_path(cfg.checkpoint_path), map_location=device)
+        # the model is built as it was trained, the env comes from cfg
+        args = checkpoint['config']
+        args.trainer.device = device
+        args.hydra_base_dir = cfg.hydra_base_dir
+        max_length = checkpoint['train_dataset_max_length']
+    else:
+        args = cfg
+        max_length = bench.max_length
+    args.method = args.model.name
+
+    state_dim = cfg.env.state_dim
+    if isinstance(state_dim, str):
+        state_dim = ast.literal_eval(state_dim)
+    model = build_model(args, state_dim, cfg.env.action_dim, max_length, device)
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+    model = model.to(device=device)
+    model.eval()
+    ema_diffusion_model = model.diff_trainer.ema_model
+
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+    stats = EnvStats(state_dim, cfg.env.use_state)
+    env_kwargs = {'step_cost': cfg.env.step_cost} if 'step_cost' in cfg.env else {}
+
+    env, envs = None, None
+    if bench.n_envs > 1:
+        envs = SubprocEnvs(cfg.env.name, LorlWrapper, stats, bench.n_envs, seed=cfg.seed, env_kwargs=env_kwargs)
+    else:
+        env = make_env(cfg.env.name, **env_kwargs)
+        env.seed(cfg.seed)
+
+    timer = StageTimer(device)
+    time_model(timer, model, ema_diffusion_model)
+    if envs is not None:
+        timer.wrap(envs, 'step', 'env_step', count=len)
+
+    def tasks(n):
+        return [dict(instr=instr, orig_instr=instr) for instr in
+                (LORL_COMPOSITION_INSTRS[i % len(LORL_COMPOSITION_INSTRS)] for i in range(n))]
+
+    try:
+        timer.enabled = False
+        run_episodes(args, bench, tasks(bench.warmup_episodes), model, tokenizer, timer, envs, env, stats, device,
+                     ema_diffusion_model)
+        timer.enabled = True
+
+        start = time.perf_counter()
+        steps = run_episodes(args, bench, tasks(bench.num_episodes), model, tokenizer, timer, envs, env, stats,
+                             device, ema_diffusion_model)
+        timer.synchronize()
+        wall_time = time.perf_counter() - start
+    finally:
+        if envs is not None:
+            envs.close()
+        else:
+            env.close()
+
+    stages = timer.summary()
+    decisions = stages['plan']['items']
+    return {'env': cfg.env.name,
+            'step_cost': env_kwargs.get('step_cost'),
+            'method': args.method,
+            'checkpoint_path': cfg.checkpoint_path,
+            'device': str(device),
+            'n_envs': bench.n_envs,
+            'episodes': bench.num_episodes,
+            'steps': steps,
+            'decisions': decisions,
+            'wall_time_s': wall_time,
+            'steps_per_sec': steps / wall_time,
+            'decisions_per_sec': decisions / wall_time,
+            'episodes_per_sec': bench.num_episodes / wall_time,
+            'stages': stages}
+
+
+def print_results(results):
+    print('=' * 50)
+    print(f"{results['env']} ({results['method']}, {results['device']}, {results['n_envs']} env(s)): "
+          f"{results['episodes']} episodes, {results['steps']} steps in {results['wall_time_s']:.2f}s")
+    print(f"steps/sec: {results['steps_per_sec']:.2f}  decisions/sec: {results['decisions_per_sec']:.2f}  "
+          f"episodes/sec: {results['episodes_per_sec']:.3f}")
+    print(f"{'stage':<18}{'calls':>8}{'items':>8}{'total s':>10}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, s in sorted(results['stages'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"{stage:<18}{s['calls']:>8}{s['items']:>8}{s['total_s']:>10.3f}{s['mean_ms']:>10.2f}"
+              f"{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}")
+    print('=' * 50)
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig):
+    args = get_args(cfg)
+
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    print(OmegaConf.to_yaml(args.benchmark))
+
+    results = benchmark(args)
+    print_results(results)
+    if args.benchmark.output:
+        with open(hydra.utils.to_absolute_path(args.benchmark.output), 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
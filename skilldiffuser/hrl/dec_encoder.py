@@ -270,7 +270,9 @@ class DecEncoder(TrajectoryModel):
         #
         #     return outputs
 
-    def get_action(self, states, actions, timesteps, options=None, embed_state=None, word_embeddings=None, **kwargs):
+    def get_action(self, states, actions, timesteps, options=None, embed_state=None, word_embeddings=None,
+                   state_embeddings=None, **kwargs):
+        # state_embeddings, if given, are the embeddings of the last max_length (padded) states
 
         if self.use_options:
             assert options is not None
@@ -306,7 +308,10 @@ class DecEncoder(TrajectoryModel):
             attention_mask = None
 
             with torch.no_grad():
-                state_embeddings = embed_state(states)
+                if state_embeddings is None:
+                    state_embeddings = embed_state(states)
+                else:
+                    state_embeddings = state_embeddings.reshape(1, -1, state_embeddings.shape[-1])
                 encoder_out = self.encode(states, actions, timesteps, options=options,
                                           state_embeddings=state_embeddings,
                                           attention_mask=attention_mask)
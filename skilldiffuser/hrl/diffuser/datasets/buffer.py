@@ -6,11 +6,16 @@ def atleast_2d(x):
     return x
 
 class ReplayBuffer:
+    '''
+        stores every field as one flat [ n_steps x dim ] array;
+        episode i occupies rows offsets[i]:offsets[i+1]
+    '''
 
     def __init__(self, max_n_episodes, max_path_length, termination_penalty):
         self._dict = {
-            'path_lengths': np.zeros(max_n_episodes, dtype=np.int),
+            'path_lengths': np.zeros(max_n_episodes, dtype=np.int64),
         }
+        self._chunks = {}
         self._count = 0
         self.max_n_episodes = max_n_episodes
         self.max_path_length = max_path_length
@@ -52,18 +57,42 @@ class ReplayBuffer:
 
     def items(self):
         return {k: v for k, v in self._dict.items()
-                if k != 'path_lengths'}.items()
+                if k not in ('path_lengths', 'offsets')}.items()
 
-    def _allocate(self, key, array):
-        assert key not in self._dict
-        dim = array.shape[-1]
-        shape = (self.max_n_episodes, self.max_path_length, dim)
-        self._dict[key] = np.zeros(shape, dtype=np.float32)
-        # print(f'[ utils/mujoco ] Allocated {key} with size {shape}')
+    def episode(self, key, path_ind):
+        offsets = self._dict['offsets']
+        return self._dict[key][offsets[path_ind]:offsets[path_ind + 1]]
+
+    def window(self, key, path_ind, start, end, fill=0):
+        '''
+            returns steps [start, end) of episode `path_ind`,
+            padded with `fill` only if the window crosses the end of the episode
+        '''
+        offsets = self._dict['offsets']
+        first = offsets[path_ind] + start
+        last = min(offsets[path_ind] + end, offsets[path_ind + 1])
+        x = self._dict[key][first:last]
+        if len(x) < end - start:
+            pad = np.full((end - start - len(x), *x.shape[1:]), fill, dtype=x.dtype)
+            x = np.concatenate([x, pad], axis=0)
+        return x
+
+    def windows(self, key, path_inds, starts, length, fill=0):
+        '''
+            batched `window`: returns [ len(path_inds) x length x dim ] windows
+            gathered with a single fancy index
+        '''
+        offsets = self._dict['offsets']
+        stored_lengths = offsets[path_inds + 1] - offsets[path_inds]
+        steps = starts[:, None] + np.arange(length)
+        valid = steps < stored_lengths[:, None]
+        rows = offsets[path_inds][:, None] + np.minimum(steps, stored_lengths[:, None] - 1)
+        return np.where(valid[..., None], self._dict[key][rows], fill).astype(self._dict[key].dtype)
 
     def add_path(self, path):
         path_length = len(path['observations'])
         assert path_length <= self.max_path_length
+        assert self._count < self.max_n_episodes
 
         if path['terminals'].any():
             assert (path['terminals'][-1] == True) and (not path['terminals'][:-1].any())
@@ -72,15 +101,16 @@ class ReplayBuffer:
         self._add_keys(path)
 
         ## add tracked keys in path
-        for key in self.keys:
-            array = atleast_2d(path[key])
-            if key not in self._dict: self._allocate(key, array)
-            self._dict[key][self._count, :path_length] = array
+        ## (copied, since episodes can be views of the raw dataset)
+        chunks = {key: np.array(atleast_2d(path[key]), dtype=np.float32) for key in self.keys}
 
         ## penalize early termination
         if path['terminals'].any() and self.termination_penalty is not None:
             assert not path['timeouts'].any(), 'Penalized a timeout episode for early termination'
-            self._dict['rewards'][self._count, path_length - 1] += self.termination_penalty
+            chunks['rewards'][path_length - 1] += self.termination_penalty
+
+        for key, array in chunks.items():
+            self._chunks.setdefault(key, []).append(array)
 
         ## record path length
         self._dict['path_lengths'][self._count] = path_length
@@ -94,8 +124,11 @@ class ReplayBuffer:
         self._dict['path_lengths'][path_ind] = new
 
     def finalize(self):
-        ## remove extra slots
-        for key in self.keys + ['path_lengths']:
-            self._dict[key] = self._dict[key][:self._count]
+        ## concatenate episodes into flat arrays and remove extra slots
+        stored_lengths = [len(x) for x in self._chunks[self.keys[0]]]
+        self._dict['offsets'] = np.concatenate([[0], np.cumsum(stored_lengths)]).astype(np.int64)
+        for key in self.keys:
+            self._dict[key] = np.concatenate(self._chunks.pop(key), axis=0)
+        self._dict['path_lengths'] = self._dict['path_lengths'][:self._count]
         self._add_attributes()
         print(f'[ datasets/buffer ] Finalized replay buffer | {self._count} episodes')
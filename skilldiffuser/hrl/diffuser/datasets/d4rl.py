@@ -1,5 +1,4 @@
 import os
-import collections
 import numpy as np
 import gym
 import pdb
@@ -20,10 +19,6 @@ def suppress_output():
         with redirect_stderr(fnull) as err, redirect_stdout(fnull) as out:
             yield (err, out)
 
-with suppress_output():
-    ## d4rl prints out a variety of warnings
-    import d4rl
-
 #-----------------------------------------------------------------------------#
 #-------------------------------- general api --------------------------------#
 #-----------------------------------------------------------------------------#
@@ -33,6 +28,9 @@ def load_environment(name):
         ## name is already an environment
         return name
     with suppress_output():
+        ## d4rl prints out a variety of warnings, it is only needed (to register its envs) when an env is made,
+        ## so the diffuser package can be used on machines without mujoco
+        import d4rl
         wrapped_env = gym.make(name)
     env = wrapped_env.unwrapped
     env.max_episode_steps = wrapped_env._max_episode_steps
@@ -71,35 +69,42 @@ def sequence_dataset(env, preprocess_fn):
     dataset = preprocess_fn(dataset)
 
     N = dataset['rewards'].shape[0]
-    data_ = collections.defaultdict(list)
-
-    # The newer version of the dataset adds an explicit
-    # timeouts field. Keep old method for backwards compatability.
-    use_timeouts = 'timeouts' in dataset
-
-    episode_step = 0
-    for i in range(N):
-        done_bool = bool(dataset['terminals'][i])
-        if use_timeouts:
-            final_timestep = dataset['timeouts'][i]
-        else:
-            final_timestep = (episode_step == env._max_episode_steps - 1)
-
-        for k in dataset:
-            if 'metadata' in k or 'infos' in k: continue
-            data_[k].append(dataset[k][i])
-        if done_bool or final_timestep:
-            episode_step = 0
-            episode_data = {}
-            for k in data_:
-                episode_data[k] = np.array(data_[k])
-            if 'maze2d' in env.name:
-                episode_data = process_maze2d_episode(episode_data)
-            yield episode_data
-            data_ = collections.defaultdict(list)
-
-        episode_step += 1
-
+    keys = [k for k in dataset if 'metadata' not in k and 'infos' not in k]
+
+    ## episode boundaries are computed once for the whole dataset and
+    ## every episode is a slice (view) of the flat arrays
+    ends = episode_ends(dataset, N, env._max_episode_steps)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    for start, end in zip(starts, ends + 1):
+        episode_data = {k: dataset[k][start:end] for k in keys}
+        if 'maze2d' in env.name:
+            episode_data = process_maze2d_episode(episode_data)
+        yield episode_data
+
+def episode_ends(dataset, N, max_episode_steps):
+    '''
+        returns the index of the last transition of every episode,
+        trailing transitions without an episode end are dropped
+    '''
+    done = dataset['terminals'][:N].astype(bool)
+
+    ## The newer version of the dataset adds an explicit
+    ## timeouts field. Keep old method for backwards compatability.
+    if 'timeouts' in dataset:
+        return np.flatnonzero(done | dataset['timeouts'][:N].astype(bool))
+
+    ## old method: an episode also ends after `max_episode_steps` steps, where
+    ## the step counter starts at 0 for the first episode and at 1 afterwards
+    ends = []
+    start, first_step = 0, 0
+    for terminal in np.append(np.flatnonzero(done), N):
+        last = min(terminal, N - 1)
+        timeouts = np.arange(start + max_episode_steps - 1 - first_step, last + 1, max_episode_steps - 1)
+        ends.append(timeouts)
+        if terminal < N and (len(timeouts) == 0 or timeouts[-1] != terminal):
+            ends.append([terminal])
+        start, first_step = terminal + 1, 1
+    return np.concatenate(ends).astype(np.int64)
 
 #-----------------------------------------------------------------------------#
 #-------------------------------- maze2d fixes -------------------------------#
@@ -1,5 +1,7 @@
+import os
 import numpy as np
 import scipy.interpolate as interpolate
+import torch
 import pdb
 
 POINTMASS_KEYS = ['observations', 'actions', 'next_observations', 'deltas']
@@ -9,9 +11,18 @@ POINTMASS_KEYS = ['observations', 'actions', 'next_observations', 'deltas']
 #-----------------------------------------------------------------------------#
 
 class DatasetNormalizer:
+    '''
+        if `max_samples` is given for a flat dataset (with `offsets`), the normalizers are
+        fitted on a reservoir sample of at most `max_samples` steps, with exact limits
+        and moments, streamed over the episodes instead of a flattened copy of the dataset
+    '''
 
-    def __init__(self, dataset, normalizer, path_lengths=None):
-        dataset = flatten(dataset, path_lengths)
+    def __init__(self, dataset, normalizer, path_lengths=None, offsets=None, max_samples=None, seed=0):
+        if max_samples is not None and offsets is not None:
+            dataset, stats = stream_fit_data(dataset, path_lengths, offsets, max_samples, seed)
+        else:
+            dataset = flatten(dataset, path_lengths, offsets)
+            stats = {key: None for key in dataset}
 
         self.observation_dim = dataset['observations'].shape[1]
         self.action_dim = dataset['actions'].shape[1]
@@ -22,7 +33,7 @@ class DatasetNormalizer:
         self.normalizers = {}
         for key, val in dataset.items():
             try:
-                self.normalizers[key] = normalizer(val)
+                self.normalizers[key] = normalizer(val, stats=stats[key])
             except:
                 print(f'[ utils/normalization ] Skipping {key} | {normalizer}')
             # key: normalizer(val)
@@ -43,11 +54,126 @@ class DatasetNormalizer:
     def unnormalize(self, x, key):
         return self.normalizers[key].unnormalize(x)
 
-def flatten(dataset, path_lengths):
+    def arrays(self):
+        '''
+            the fitted normalizers as plain arrays { key/attribute: array }, see `from_arrays`
+        '''
+        arrays = {'observation_dim': np.array(self.observation_dim), 'action_dim': np.array(self.action_dim)}
+        for key, normalizer in self.normalizers.items():
+            arrays[f'{key}/class'] = np.array(type(normalizer).__name__)
+            arrays.update({f'{key}/{name}': val for name, val in normalizer.arrays().items()})
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        self = cls.__new__(cls)
+        self.observation_dim = int(arrays['observation_dim'])
+        self.action_dim = int(arrays['action_dim'])
+        self.normalizers = {}
+        for name, val in arrays.items():
+            if not name.endswith('/class'):
+                continue
+            key = name[:-len('/class')]
+            normalizer = NORMALIZERS[str(val)]
+            self.normalizers[key] = normalizer.from_arrays({
+                attr[len(key) + 1:]: x for attr, x in arrays.items()
+                if attr.startswith(f'{key}/') and attr != name
+            })
+        return self
+
+def cached_normalizer(cache_path, cache_key, *args, **kwargs):
+    '''
+        loads a fitted DatasetNormalizer from the arrays in `cache_path` if they were saved
+            with the same `cache_key` (normalizer and dataset settings), or fits one and saves it there
+    '''
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path, allow_pickle=False) as f:
+            arrays = dict(f)
+        if str(arrays.pop('cache_key', None)) == cache_key:
+            print(f'[ utils/normalization ] Loaded normalizer from {cache_path}')
+            return DatasetNormalizer.from_arrays(arrays)
+        print(f'[ utils/normalization ] Refitting normalizer, {cache_path} was saved with other settings')
+
+    normalizer = DatasetNormalizer(*args, **kwargs)
+    if cache_path is not None:
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, cache_key=np.array(cache_key), **normalizer.arrays())
+            os.replace(tmp_path, cache_path)
+            print(f'[ utils/normalization ] Saved normalizer to {cache_path}')
+        except OSError as e:
+            print(f'[ utils/normalization ] Could not save normalizer to {cache_path} | {e}')
+    return normalizer
+
+def stream_fit_data(dataset, path_lengths, offsets, max_samples, seed=0):
+    '''
+        streams over the episodes of a flat dataset { key: [ n_steps x dim ] } and returns
+            { key: [ <= max_samples x dim ] } uniform (reservoir) sample of the valid steps
+            { key: { mins, maxs, means, stds } } exact statistics of the valid steps
+    '''
+    rng = np.random.default_rng(seed)
+    reservoir = np.zeros(0, dtype=np.int64)
+    n_seen = 0
+    moments = {key: None for key, _ in dataset.items()}
+
+    for start, length in zip(offsets[:-1], path_lengths):
+        rows = np.arange(start, start + length)
+
+        ## Algorithm R: fill the reservoir, then row n replaces a random slot with probability k / n
+        n_fill = min(max(max_samples - len(reservoir), 0), length)
+        reservoir = np.concatenate([reservoir, rows[:n_fill]])
+        rest = rows[n_fill:]
+        if len(rest):
+            slots = rng.integers(0, n_seen + n_fill + np.arange(len(rest)) + 1)
+            keep = slots < max_samples
+            slots, rest = slots[keep][::-1], rest[keep][::-1]
+            ## a later row wins if several rows draw the same slot
+            slots, first = np.unique(slots, return_index=True)
+            reservoir[slots] = rest[first]
+        n_seen += length
+
+        for key, xs in dataset.items():
+            moments[key] = merge_moments(moments[key], episode_moments(xs[start:start + length]))
+
+    reservoir = np.sort(reservoir)
+    samples = {key: xs[reservoir] for key, xs in dataset.items()}
+    stats = {}
+    for key, (count, mins, maxs, means, m2) in moments.items():
+        stats[key] = {'mins': mins, 'maxs': maxs, 'means': means, 'stds': np.sqrt(m2 / count)}
+    return samples, stats
+
+def episode_moments(x):
+    x = x.reshape(len(x), -1).astype(np.float64)
+    means = x.mean(axis=0)
+    return len(x), x.min(axis=0), x.max(axis=0), means, ((x - means) ** 2).sum(axis=0)
+
+def merge_moments(a, b):
+    '''
+        (count, mins, maxs, means, M2) of the union of two sets of steps (Chan et al.)
+    '''
+    if a is None or a[0] == 0:
+        return b
+    if b[0] == 0:
+        return a
+    n_a, mins_a, maxs_a, means_a, m2_a = a
+    n_b, mins_b, maxs_b, means_b, m2_b = b
+    n = n_a + n_b
+    delta = means_b - means_a
+    means = means_a + delta * n_b / n
+    m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return n, np.minimum(mins_a, mins_b), np.maximum(maxs_a, maxs_b), means, m2
+
+def flatten(dataset, path_lengths, offsets=None):
     '''
         flattens dataset of { key: [ n_episodes x max_path_lenth x dim ] }
             to { key : [ (n_episodes * sum(path_lengths)) x dim ]}
+        if `offsets` are given, the dataset is already stored as { key: [ n_steps x dim ] }
+            with episode i in rows offsets[i]:offsets[i+1]
     '''
+    if offsets is not None:
+        return flatten_ragged(dataset, path_lengths, offsets)
+
     flattened = {}
     for key, xs in dataset.items():
         assert len(xs) == len(path_lengths)
@@ -57,6 +183,19 @@ def flatten(dataset, path_lengths):
         ], axis=0)
     return flattened
 
+def flatten_ragged(dataset, path_lengths, offsets):
+    '''
+        keeps the first path_lengths[i] steps of every episode of a flat dataset;
+            returns the arrays themselves if no episode was truncated
+    '''
+    stored_lengths = np.diff(offsets)
+    if np.array_equal(stored_lengths, path_lengths):
+        return dict(dataset.items())
+
+    starts = np.repeat(offsets[:-1] - np.cumsum(path_lengths) + path_lengths, path_lengths)
+    inds = starts + np.arange(np.sum(path_lengths))
+    return {key: xs[inds] for key, xs in dataset.items()}
+
 #-----------------------------------------------------------------------------#
 #------------------------------- @TODO: remove? ------------------------------#
 #-----------------------------------------------------------------------------#
@@ -87,13 +226,41 @@ class PointMassDatasetNormalizer(DatasetNormalizer):
 
 class Normalizer:
     '''
-        parent class, subclass by defining the `normalize` and `unnormalize` methods
+        parent class, subclass by defining the `normalize` and `unnormalize` methods;
+        `stats` overrides the statistics computed from X (e.g. when X is a subsample)
     '''
 
-    def __init__(self, X):
+    def __init__(self, X, stats=None):
         self.X = X.astype(np.float32)
-        self.mins = X.min(axis=0)
-        self.maxs = X.max(axis=0)
+        if stats is None:
+            self.mins = X.min(axis=0)
+            self.maxs = X.max(axis=0)
+        else:
+            self.mins = stats['mins'].astype(X.dtype)
+            self.maxs = stats['maxs'].astype(X.dtype)
+        self.stats = stats
+
+    def __getstate__(self):
+        ## the fitting data is not needed after __init__
+        state = self.__dict__.copy()
+        state.pop('X', None)
+        return state
+
+    def arrays(self):
+        '''
+            the fitted parameters as arrays, without the fitting data and statistics
+        '''
+        state = self.__getstate__()
+        state.pop('stats', None)
+        return {name: np.asarray(val) for name, val in state.items() if not isinstance(val, dict)}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        self = cls.__new__(cls)
+        for name, val in arrays.items():
+            setattr(self, name, val.item() if val.ndim == 0 else val)
+        self.stats = None
+        return self
 
     def __repr__(self):
         return (
@@ -130,8 +297,12 @@ class GaussianNormalizer(Normalizer):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.means = self.X.mean(axis=0)
-        self.stds = self.X.std(axis=0)
+        if self.stats is None:
+            self.means = self.X.mean(axis=0)
+            self.stds = self.X.std(axis=0)
+        else:
+            self.means = self.stats['means'].astype(np.float32)
+            self.stds = self.stats['stds'].astype(np.float32)
         self.z = 1
 
     def __repr__(self):
@@ -195,34 +366,98 @@ class SafeLimitsNormalizer(LimitsNormalizer):
 
 class CDFNormalizer(Normalizer):
     '''
-        makes training data uniform (over each dimension) by transforming it with marginal CDFs
+        makes training data uniform (over each dimension) by transforming it with marginal CDFs;
+        the CDFs of all dimensions are stored as padded [ dim x n_knots ] quantile tables
+        and evaluated together, on numpy arrays or on torch tensors (on their device)
     '''
 
-    def __init__(self, X):
-        super().__init__(atleast_2d(X))
+    def __init__(self, X, max_knots=1024, stats=None):
+        super().__init__(atleast_2d(X), stats=stats)
         self.dim = self.X.shape[1]
-        self.cdfs = [CDFNormalizer1d(self.X[:, i]) for i in range(self.dim)]
+        self.constant = self.X.min(axis=0) == self.X.max(axis=0)
+        self.quantiles, self.cumprobs, self.n_knots = quantile_tables(self.X, max_knots)
+
+        self.xmin, self.xmax = self.quantiles[:, 0], self.quantiles[:, -1]
+        self.ymin, self.ymax = self.cumprobs[:, 0], self.cumprobs[:, -1]
+        self._tensors = {}
 
     def __repr__(self):
         return f'[ CDFNormalizer ] dim: {self.mins.size}\n' + '    |    '.join(
-            f'{i:3d}: {cdf}' for i, cdf in enumerate(self.cdfs)
+            f'{i:3d}: [{np.round(xmin, 2):.4f}, {np.round(xmax, 2):.4f}'
+            for i, (xmin, xmax) in enumerate(zip(self.xmin, self.xmax))
         )
 
-    def wrap(self, fn_name, x):
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_tensors'] = {}
+        return state
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        self = super().from_arrays(arrays)
+        self._tensors = {}
+        return self
+
+    def tables(self, x):
+        '''
+            quantile tables as arrays, or as tensors on the device of `x`
+        '''
+        if not torch.is_tensor(x):
+            return self.quantiles, self.cumprobs, self.constant
+        key = (x.device, x.dtype)
+        if key not in self._tensors:
+            self._tensors[key] = tuple(
+                torch.as_tensor(table, device=x.device).to(x.dtype if table.dtype != bool else torch.bool)
+                for table in (self.quantiles, self.cumprobs, self.constant)
+            )
+        return self._tensors[key]
+
+    def wrap(self, x, inverse=False):
         shape = x.shape
         ## reshape to 2d
         x = x.reshape(-1, self.dim)
-        out = np.zeros_like(x)
-        for i, cdf in enumerate(self.cdfs):
-            fn = getattr(cdf, fn_name)
-            out[:, i] = fn(x[:, i])
-        return out.reshape(shape)
+        quantiles, cumprobs, constant = self.tables(x)
+        xp, fp = (cumprobs, quantiles) if inverse else (quantiles, cumprobs)
+        if torch.is_tensor(x):
+            x = torch.minimum(torch.maximum(x, xp[:, 0]), xp[:, -1])
+            y = interp_torch(x, xp, fp)
+        else:
+            dtype = x.dtype if np.issubdtype(x.dtype, np.floating) else np.float64
+            x = np.clip(x, xp[:, 0], xp[:, -1])
+            y = interp(x, xp, fp).astype(dtype)
+        return y.reshape(shape)
 
     def normalize(self, x):
-        return self.wrap('normalize', x)
+        ## [ 0, 1 ]
+        y = self.wrap(x)
+        ## [ -1, 1 ]
+        y = 2 * y - 1
+        constant = self.tables(x)[2]
+        return where(constant, x, y)
 
-    def unnormalize(self, x):
-        return self.wrap('unnormalize', x)
+    def unnormalize(self, x, eps=1e-4):
+        '''
+            X : [ -1, 1 ]
+        '''
+        ## [ -1, 1 ] --> [ 0, 1 ]
+        y = (x + 1) / 2.
+
+        _, cumprobs, constant = self.tables(x)
+        flat = y.reshape(-1, self.dim)
+        out_of_range = ((flat < cumprobs[:, 0] - eps) | (flat > cumprobs[:, -1] + eps)) & ~constant
+        if out_of_range.any():
+            print(
+                f'''[ dataset/normalization ] Warning: out of range in unnormalize: '''
+                f'''[{flat.min()}, {flat.max()}] | '''
+                f'''x : [{self.xmin.min()}, {self.xmax.max()}] | '''
+                f'''y: [{self.ymin.min()}, {self.ymax.max()}]'''
+            )
+
+        y = self.wrap(y, inverse=True)
+        return where(constant, x, y)
+
+NORMALIZERS = {cls.__name__: cls for cls in (
+    DebugNormalizer, GaussianNormalizer, LimitsNormalizer, SafeLimitsNormalizer, CDFNormalizer)}
 
 class CDFNormalizer1d:
     '''
@@ -294,6 +529,78 @@ def empirical_cdf(sample):
 
     return quantiles, cumprob
 
+def quantile_tables(X, max_knots=1024):
+    '''
+        empirical CDF knots of every column of X [ N x dim ], at most `max_knots`
+        (evenly spaced in probability) per column, returned as quantiles and cumulative
+        probabilities padded to [ dim x n_knots ] by repeating the last knot
+    '''
+    n, dim = X.shape
+    X = np.sort(X, axis=0)
+    ## the last occurrence of every unique value carries its cumulative probability
+    last = np.ones(X.shape, dtype=bool)
+    last[:-1] = X[1:] != X[:-1]
+
+    knots = []
+    for i in range(dim):
+        inds = np.flatnonzero(last[:, i])
+        if len(inds) > max_knots:
+            inds = inds[np.unique(np.linspace(0, len(inds) - 1, max_knots).round().astype(int))]
+        knots.append(inds)
+    n_knots = np.array([len(inds) for inds in knots])
+
+    width = max(n_knots.max(), 2)
+    quantiles = np.zeros((dim, width))
+    cumprobs = np.zeros((dim, width))
+    for i, inds in enumerate(knots):
+        inds = np.pad(inds, (0, width - len(inds)), mode='edge')
+        quantiles[i] = X[inds, i]
+        cumprobs[i] = (inds + 1) / n
+    return quantiles, cumprobs, n_knots
+
+def interp(x, xp, fp):
+    '''
+        linear interpolation of x [ N x dim ] through the knots xp, fp [ dim x n_knots ]
+        of every dimension; xp is nondecreasing along each row and x is within its range.
+        the rows are rescaled to [ 0, 1 ] and shifted apart so that a single
+        searchsorted over the flattened table finds the segments of all dimensions
+    '''
+    dim, width = xp.shape
+    lo, span = xp[:, :1], xp[:, -1:] - xp[:, :1]
+    span = np.where(span > 0, span, 1)
+    shift = 2 * np.arange(dim)[:, None]
+    keys = ((xp - lo) / span + shift).ravel()
+    x_keys = (x - lo.T) / span.T + shift.T
+
+    inds = np.searchsorted(keys, x_keys, side='right') - 1 - np.arange(dim) * width
+    inds = np.clip(inds, 0, width - 2)
+    return _lerp(x, xp.T, fp.T, inds, np.take_along_axis)
+
+def interp_torch(x, xp, fp):
+    '''
+        `interp` for tensors, with a batched torch.searchsorted
+    '''
+    width = xp.shape[1]
+    inds = torch.searchsorted(xp.contiguous(), x.T.contiguous(), right=True).T - 1
+    inds = inds.clamp(0, width - 2)
+    return _lerp(x, xp.T, fp.T, inds, torch.take_along_dim)
+
+def _lerp(x, xp, fp, inds, take):
+    '''
+        xp, fp : [ n_knots x dim ], inds : [ N x dim ] segment of every x
+    '''
+    x0, x1 = take(xp, inds, 0), take(xp, inds + 1, 0)
+    f0, f1 = take(fp, inds, 0), take(fp, inds + 1, 0)
+    dx = x1 - x0
+    ## repeated (padding) knots have dx == 0 and map to f0
+    w = (x - x0) / where(dx > 0, dx, 1)
+    return f0 + where(dx > 0, w, 0) * (f1 - f0)
+
+def where(condition, x, y):
+    if torch.is_tensor(x):
+        return torch.where(condition, x, y)
+    return np.where(condition, x, y)
+
 def atleast_2d(x):
     if x.ndim < 2:
         x = x[:,None]
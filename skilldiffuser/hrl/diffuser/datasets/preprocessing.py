@@ -1,6 +1,5 @@
 import gym
 import numpy as np
-import einops
 from scipy.spatial.transform import Rotation as R
 import pdb
 
@@ -88,6 +87,15 @@ def maze2d_set_terminals(env):
 
 #-------------------------- block-stacking --------------------------#
 
+def block_views(X, robot_dim, n_blocks, block_dim):
+    '''
+        X : [ ... x robot_dim + n_blocks * block_dim ]
+        returns views of X : [ ... x robot_dim ], [ ... x n_blocks x block_dim ]
+    '''
+    robot = X[..., :robot_dim]
+    blocks = X[..., robot_dim:].reshape(*X.shape[:-1], n_blocks, block_dim)
+    return robot, blocks
+
 def blocks_quat_to_euler(observations):
     '''
         input : [ N x robot_dim + n_blocks * 8 ] = [ N x 39 ]
@@ -106,29 +114,20 @@ def blocks_quat_to_euler(observations):
     n_blocks = 4
     assert observations.shape[-1] == robot_dim + n_blocks * block_dim
 
-    X = observations[:, :robot_dim]
-
-    for i in range(n_blocks):
-        start = robot_dim + i * block_dim
-        end = start + block_dim
-
-        block_info = observations[:, start:end]
+    N = len(observations)
+    robot, blocks = block_views(observations, robot_dim, n_blocks, block_dim)
 
-        xpos = block_info[:, :3]
-        quat = block_info[:, 3:-1]
-        contact = block_info[:, -1:]
+    ## all blocks of all steps in a single conversion
+    quat = blocks[..., 3:-1].reshape(-1, 4)
+    euler = R.from_quat(quat).as_euler('xyz').reshape(N, n_blocks, 3)
 
-        euler = R.from_quat(quat).as_euler('xyz')
-        sin = np.sin(euler)
-        cos = np.cos(euler)
-
-        X = np.concatenate([
-            X,
-            xpos,
-            sin,
-            cos,
-            contact,
-        ], axis=-1)
+    X = np.empty((N, robot_dim + n_blocks * 10), dtype=np.result_type(observations, euler))
+    X_robot, X_blocks = block_views(X, robot_dim, n_blocks, 10)
+    X_robot[:] = robot
+    X_blocks[..., :3] = blocks[..., :3]
+    np.sin(euler, out=X_blocks[..., 3:6])
+    np.cos(euler, out=X_blocks[..., 6:9])
+    X_blocks[..., 9:] = blocks[..., -1:]
 
     return X
 
@@ -139,36 +138,29 @@ def blocks_euler_to_quat_2d(observations):
 
     assert observations.shape[-1] == robot_dim + n_blocks * block_dim
 
-    X = observations[:, :robot_dim]
-
-    for i in range(n_blocks):
-        start = robot_dim + i * block_dim
-        end = start + block_dim
-
-        block_info = observations[:, start:end]
+    N = len(observations)
+    robot, blocks = block_views(observations, robot_dim, n_blocks, block_dim)
 
-        xpos = block_info[:, :3]
-        sin = block_info[:, 3:6]
-        cos = block_info[:, 6:9]
-        contact = block_info[:, 9:]
+    euler = np.arctan2(blocks[..., 3:6], blocks[..., 6:9]).reshape(-1, 3)
+    quat = R.from_euler('xyz', euler, degrees=False).as_quat().reshape(N, n_blocks, 4)
 
-        euler = np.arctan2(sin, cos)
-        quat = R.from_euler('xyz', euler, degrees=False).as_quat()
-
-        X = np.concatenate([
-            X,
-            xpos,
-            quat,
-            contact,
-        ], axis=-1)
+    X = np.empty((N, robot_dim + n_blocks * 8), dtype=np.result_type(observations, quat))
+    X_robot, X_blocks = block_views(X, robot_dim, n_blocks, 8)
+    X_robot[:] = robot
+    X_blocks[..., :3] = blocks[..., :3]
+    X_blocks[..., 3:7] = quat
+    X_blocks[..., 7:] = blocks[..., 9:]
 
     return X
 
 def blocks_euler_to_quat(paths):
-    return np.stack([
-        blocks_euler_to_quat_2d(path)
-        for path in paths
-    ], axis=0)
+    '''
+        paths : [ n_paths x path_length x robot_dim + n_blocks * 10 ]
+    '''
+    paths = np.asarray(paths)
+    n_paths, path_length, dim = paths.shape
+    X = blocks_euler_to_quat_2d(paths.reshape(n_paths * path_length, dim))
+    return X.reshape(n_paths, path_length, -1)
 
 def blocks_process_cubes(env):
 
@@ -212,22 +204,17 @@ def blocks_cumsum_quat(deltas):
     batch_size, horizon, _ = deltas.shape
 
     cumsum = deltas.cumsum(axis=1)
-    for i in range(n_blocks):
-        start = robot_dim + i * block_dim + 3
-        end = start + 4
-
-        quat = deltas[:, :, start:end].copy()
-
-        quat = einops.rearrange(quat, 'b h q -> (b h) q')
-        euler = R.from_quat(quat).as_euler('xyz')
-        euler = einops.rearrange(euler, '(b h) e -> b h e', b=batch_size)
-        cumsum_euler = euler.cumsum(axis=1)
+    _, delta_blocks = block_views(deltas, robot_dim, n_blocks, block_dim)
+    _, cumsum_blocks = block_views(cumsum, robot_dim, n_blocks, block_dim)
 
-        cumsum_euler = einops.rearrange(cumsum_euler, 'b h e -> (b h) e')
-        cumsum_quat = R.from_euler('xyz', cumsum_euler).as_quat()
-        cumsum_quat = einops.rearrange(cumsum_quat, '(b h) q -> b h q', b=batch_size)
+    ## [ (batch_size * horizon * n_blocks) x 4 ]
+    quat = delta_blocks[..., 3:7].reshape(-1, 4)
+    euler = R.from_quat(quat).as_euler('xyz')
+    euler = euler.reshape(batch_size, horizon, n_blocks, 3)
+    cumsum_euler = euler.cumsum(axis=1)
 
-        cumsum[:, :, start:end] = cumsum_quat.copy()
+    cumsum_quat = R.from_euler('xyz', cumsum_euler.reshape(-1, 3)).as_quat()
+    cumsum_blocks[..., 3:7] = cumsum_quat.reshape(batch_size, horizon, n_blocks, 4)
 
     return cumsum
 
@@ -243,48 +230,32 @@ def blocks_delta_quat_helper(observations, next_observations):
     n_blocks = 4
     assert observations.shape[-1] == next_observations.shape[-1] == robot_dim + n_blocks * block_dim
 
-    deltas = (next_observations - observations)[:, :robot_dim]
-
-    for i in range(n_blocks):
-        start = robot_dim + i * block_dim
-        end = start + block_dim
-
-        block_info = observations[:, start:end]
-        next_block_info = next_observations[:, start:end]
-
-        xpos = block_info[:, :3]
-        next_xpos = next_block_info[:, :3]
-
-        quat = block_info[:, 3:-1]
-        next_quat = next_block_info[:, 3:-1]
-
-        contact = block_info[:, -1:]
-        next_contact = next_block_info[:, -1:]
-
-        delta_xpos = next_xpos - xpos
-        delta_contact = next_contact - contact
+    N = len(observations)
+    _, blocks = block_views(observations, robot_dim, n_blocks, block_dim)
+    _, next_blocks = block_views(next_observations, robot_dim, n_blocks, block_dim)
 
-        rot = R.from_quat(quat)
-        next_rot = R.from_quat(next_quat)
+    ## all blocks of all steps in a single rotation object
+    rot = R.from_quat(blocks[..., 3:-1].reshape(-1, 4))
+    next_rot = R.from_quat(next_blocks[..., 3:-1].reshape(-1, 4))
 
-        delta_quat = (next_rot * rot.inv()).as_quat()
-        w = delta_quat[:, -1:]
+    delta_quat = (next_rot * rot.inv()).as_quat()
+    w = delta_quat[:, -1:]
 
-        ## make w positive to avoid [0, 0, 0, -1]
-        delta_quat = delta_quat * np.sign(w)
+    ## make w positive to avoid [0, 0, 0, -1]
+    delta_quat = delta_quat * np.sign(w)
 
-        ## apply rot then delta to ensure we end at next_rot
-        ## delta * rot = next_rot * rot' * rot = next_rot
-        next_euler = next_rot.as_euler('xyz')
-        next_euler_check = (R.from_quat(delta_quat) * rot).as_euler('xyz')
-        assert np.allclose(next_euler, next_euler_check)
+    ## apply rot then delta to ensure we end at next_rot
+    ## delta * rot = next_rot * rot' * rot = next_rot
+    next_euler = next_rot.as_euler('xyz')
+    next_euler_check = (R.from_quat(delta_quat) * rot).as_euler('xyz')
+    assert np.allclose(next_euler, next_euler_check)
 
-        deltas = np.concatenate([
-            deltas,
-            delta_xpos,
-            delta_quat,
-            delta_contact,
-        ], axis=-1)
+    deltas = np.empty(observations.shape, dtype=np.result_type(observations, delta_quat))
+    delta_robot, delta_blocks = block_views(deltas, robot_dim, n_blocks, block_dim)
+    delta_robot[:] = next_observations[:, :robot_dim] - observations[:, :robot_dim]
+    delta_blocks[..., :3] = next_blocks[..., :3] - blocks[..., :3]
+    delta_blocks[..., 3:7] = delta_quat.reshape(N, n_blocks, 4)
+    delta_blocks[..., 7:] = next_blocks[..., -1:] - blocks[..., -1:]
 
     return deltas
 
@@ -1,11 +1,14 @@
+import os
+import hashlib
 from collections import namedtuple
 import numpy as np
+import scipy.signal
 import torch
 import pdb
 
 from .preprocessing import get_preprocess_fn
 from .d4rl import load_environment, sequence_dataset
-from .normalization import DatasetNormalizer
+from .normalization import cached_normalizer
 from .buffer import ReplayBuffer
 
 RewardBatch = namedtuple('Batch', 'trajectories conditions returns')
@@ -16,14 +19,14 @@ class SequenceDataset(torch.utils.data.Dataset):
 
     def __init__(self, env='hopper-medium-replay', horizon=64,
         normalizer='LimitsNormalizer', preprocess_fns=[], max_path_length=1000,
-        max_n_episodes=10000, termination_penalty=0, use_padding=True, discount=0.99, returns_scale=1000, include_returns=False):
+        max_n_episodes=10000, termination_penalty=0, use_padding=True, discount=0.99, returns_scale=1000, include_returns=False,
+        normalizer_samples=1000000, cache_normalizer=False):
         self.preprocess_fn = get_preprocess_fn(preprocess_fns, env)
         self.env = env = load_environment(env)
         self.returns_scale = returns_scale
         self.horizon = horizon
         self.max_path_length = max_path_length
         self.discount = discount
-        self.discounts = self.discount ** np.arange(self.max_path_length)[:, None]
         self.use_padding = use_padding
         self.include_returns = include_returns
         itr = sequence_dataset(env, self.preprocess_fn)
@@ -33,7 +36,10 @@ class SequenceDataset(torch.utils.data.Dataset):
             fields.add_path(episode)
         fields.finalize()
 
-        self.normalizer = DatasetNormalizer(fields, normalizer, path_lengths=fields['path_lengths'])
+        cache_path, cache_key = normalizer_cache_path(env, fields, normalizer, normalizer_samples, preprocess_fns,
+            max_path_length, termination_penalty) if cache_normalizer else (None, None)
+        self.normalizer = cached_normalizer(cache_path, cache_key, fields, normalizer,
+            path_lengths=fields['path_lengths'], offsets=fields['offsets'], max_samples=normalizer_samples)
         self.indices = self.make_indices(fields.path_lengths, horizon)
 
         self.observation_dim = fields.observations.shape[-1]
@@ -41,6 +47,7 @@ class SequenceDataset(torch.utils.data.Dataset):
         self.fields = fields
         self.n_episodes = fields.n_episodes
         self.path_lengths = fields.path_lengths
+        self.returns_to_go = discounted_returns(fields, self.discount)
         self.normalize()
 
         print(fields)
@@ -51,50 +58,53 @@ class SequenceDataset(torch.utils.data.Dataset):
         '''
             normalize fields that will be predicted by the diffusion model
         '''
+        self.paddings = {}
         for key in keys:
-            array = self.fields[key].reshape(self.n_episodes*self.max_path_length, -1)
-            normed = self.normalizer(array, key)
-            self.fields[f'normed_{key}'] = normed.reshape(self.n_episodes, self.max_path_length, -1)
+            self.fields[f'normed_{key}'] = self.normalizer(self.fields[key], key)
+            ## windows past the end of an episode are padded with normalized zeros
+            zeros = np.zeros((1, self.fields[key].shape[-1]), dtype=self.fields[key].dtype)
+            self.paddings[f'normed_{key}'] = self.normalizer(zeros, key)[0]
+
+    def windows(self, key, path_inds, starts):
+        return self.fields.windows(key, path_inds, starts, self.horizon, fill=self.paddings[key])
 
     def make_indices(self, path_lengths, horizon):
         '''
             makes indices for sampling from dataset;
             each index maps to a datapoint
         '''
-        indices = []
-        for i, path_length in enumerate(path_lengths):
-            max_start = min(path_length - 1, self.max_path_length - horizon)
-            if not self.use_padding:
-                max_start = min(max_start, path_length - horizon)
-            for start in range(max_start):
-                end = start + horizon
-                indices.append((i, start, end))
-        indices = np.array(indices)
-        return indices
+        return make_indices(path_lengths, horizon, self.max_path_length, self.use_padding)
 
     def get_conditions(self, observations):
         '''
             condition on current observation for planning
+            (observations are [ batch_size x horizon x observation_dim ])
         '''
-        return {0: observations[0]}
+        return {0: observations[:, 0]}
 
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx, eps=1e-4):
-        path_ind, start, end = self.indices[idx]
+        if np.ndim(idx) > 0:
+            return self.get_batch(idx)
+        return unbatch(self.get_batch([idx]))
 
-        observations = self.fields.normed_observations[path_ind, start:end]
-        actions = self.fields.normed_actions[path_ind, start:end]
+    def get_batch(self, indices):
+        '''
+            gathers the datapoints at `indices` as one batch
+        '''
+        path_inds, starts, ends = self.indices[np.asarray(indices)].T
+
+        observations = self.windows('normed_observations', path_inds, starts)
+        actions = self.windows('normed_actions', path_inds, starts)
 
         conditions = self.get_conditions(observations)
         trajectories = np.concatenate([actions, observations], axis=-1)
 
         if self.include_returns:
-            rewards = self.fields.rewards[path_ind, start:]
-            discounts = self.discounts[:len(rewards)]
-            returns = (discounts * rewards).sum()
-            returns = np.array([returns/self.returns_scale], dtype=np.float32)
+            returns = self.returns_to_go[self.fields.offsets[path_inds] + starts]
+            returns = (returns / self.returns_scale)[:, None].astype(np.float32)
             batch = RewardBatch(trajectories, conditions, returns)
         else:
             batch = Batch(trajectories, conditions)
@@ -105,14 +115,14 @@ class CondSequenceDataset(torch.utils.data.Dataset):
 
     def __init__(self, env='hopper-medium-replay', horizon=64,
         normalizer='LimitsNormalizer', preprocess_fns=[], max_path_length=1000,
-        max_n_episodes=10000, termination_penalty=0, use_padding=True, discount=0.99, returns_scale=1000, include_returns=False):
+        max_n_episodes=10000, termination_penalty=0, use_padding=True, discount=0.99, returns_scale=1000, include_returns=False,
+        normalizer_samples=1000000, cache_normalizer=False):
         self.preprocess_fn = get_preprocess_fn(preprocess_fns, env)
         self.env = env = load_environment(env)
         self.returns_scale = returns_scale
         self.horizon = horizon
         self.max_path_length = max_path_length
         self.discount = discount
-        self.discounts = self.discount ** np.arange(self.max_path_length)[:, None]
         self.use_padding = use_padding
         self.include_returns = include_returns
         itr = sequence_dataset(env, self.preprocess_fn)
@@ -122,7 +132,10 @@ class CondSequenceDataset(torch.utils.data.Dataset):
             fields.add_path(episode)
         fields.finalize()
 
-        self.normalizer = DatasetNormalizer(fields, normalizer, path_lengths=fields['path_lengths'])
+        cache_path, cache_key = normalizer_cache_path(env, fields, normalizer, normalizer_samples, preprocess_fns,
+            max_path_length, termination_penalty) if cache_normalizer else (None, None)
+        self.normalizer = cached_normalizer(cache_path, cache_key, fields, normalizer,
+            path_lengths=fields['path_lengths'], offsets=fields['offsets'], max_samples=normalizer_samples)
         self.indices = self.make_indices(fields.path_lengths, horizon)
 
         self.observation_dim = fields.observations.shape[-1]
@@ -130,6 +143,7 @@ class CondSequenceDataset(torch.utils.data.Dataset):
         self.fields = fields
         self.n_episodes = fields.n_episodes
         self.path_lengths = fields.path_lengths
+        self.returns_to_go = discounted_returns(fields, self.discount)
         self.normalize()
 
         print(fields)
@@ -140,57 +154,61 @@ class CondSequenceDataset(torch.utils.data.Dataset):
         '''
             normalize fields that will be predicted by the diffusion model
         '''
+        self.paddings = {}
         for key in keys:
-            array = self.fields[key].reshape(self.n_episodes*self.max_path_length, -1)
-            normed = self.normalizer(array, key)
-            self.fields[f'normed_{key}'] = normed.reshape(self.n_episodes, self.max_path_length, -1)
+            self.fields[f'normed_{key}'] = self.normalizer(self.fields[key], key)
+            ## windows past the end of an episode are padded with normalized zeros
+            zeros = np.zeros((1, self.fields[key].shape[-1]), dtype=self.fields[key].dtype)
+            self.paddings[f'normed_{key}'] = self.normalizer(zeros, key)[0]
+
+    def windows(self, key, path_inds, starts):
+        return self.fields.windows(key, path_inds, starts, self.horizon, fill=self.paddings[key])
 
     def make_indices(self, path_lengths, horizon):
         '''
             makes indices for sampling from dataset;
             each index maps to a datapoint
         '''
-        indices = []
-        for i, path_length in enumerate(path_lengths):
-            max_start = min(path_length - 1, self.max_path_length - horizon)
-            if not self.use_padding:
-                max_start = min(max_start, path_length - horizon)
-            for start in range(max_start):
-                end = start + horizon
-                indices.append((i, start, end))
-        indices = np.array(indices)
-        return indices
+        return make_indices(path_lengths, horizon, self.max_path_length, self.use_padding)
 
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx, eps=1e-4):
-        path_ind, start, end = self.indices[idx]
+        if np.ndim(idx) > 0:
+            return self.get_batch(idx)
+        return unbatch(self.get_batch([idx]))
 
-        t_step = np.random.randint(0, self.horizon)
+    def get_batch(self, indices):
+        '''
+            gathers the datapoints at `indices` as one batch
+        '''
+        path_inds, starts, ends = self.indices[np.asarray(indices)].T
+        batch_size = len(path_inds)
+
+        t_steps = np.random.randint(0, self.horizon, size=batch_size)
+        steps = np.arange(self.horizon)
 
-        observations = self.fields.normed_observations[path_ind, start:end]
-        actions = self.fields.normed_actions[path_ind, start:end]
+        ## windows are gathered into new arrays, masking them does not touch the dataset
+        observations = self.windows('normed_observations', path_inds, starts)
+        actions = self.windows('normed_actions', path_inds, starts)
 
         traj_dim = self.action_dim + self.observation_dim
 
-        conditions = np.ones((self.horizon, 2*traj_dim)).astype(np.float32)
+        conditions = np.ones((batch_size, self.horizon, 2*traj_dim)).astype(np.float32)
 
         # Set up conditional masking
-        conditions[t_step:,:self.action_dim] = 0
-        conditions[:,traj_dim:] = 0
-        conditions[t_step,traj_dim:traj_dim+self.action_dim] = 1
+        conditions[steps >= t_steps[:, None], :self.action_dim] = 0
+        conditions[:, :, traj_dim:] = 0
+        conditions[np.arange(batch_size), t_steps, traj_dim:traj_dim+self.action_dim] = 1
 
-        if t_step < self.horizon-1:
-            observations[t_step+1:] = 0
+        observations[steps > t_steps[:, None]] = 0
 
         trajectories = np.concatenate([actions, observations], axis=-1)
 
         if self.include_returns:
-            rewards = self.fields.rewards[path_ind, start:]
-            discounts = self.discounts[:len(rewards)]
-            returns = (discounts * rewards).sum()
-            returns = np.array([returns/self.returns_scale], dtype=np.float32)
+            returns = self.returns_to_go[self.fields.offsets[path_inds] + starts]
+            returns = (returns / self.returns_scale)[:, None].astype(np.float32)
             batch = RewardBatch(trajectories, conditions, returns)
         else:
             batch = Batch(trajectories, conditions)
@@ -204,8 +222,8 @@ class GoalDataset(SequenceDataset):
             condition on both the current observation and the last observation in the plan
         '''
         return {
-            0: observations[0],
-            self.horizon - 1: observations[-1],
+            0: observations[:, 0],
+            self.horizon - 1: observations[:, -1],
         }
 
 class ValueDataset(SequenceDataset):
@@ -216,14 +234,61 @@ class ValueDataset(SequenceDataset):
     def __init__(self, *args, discount=0.99, **kwargs):
         super().__init__(*args, **kwargs)
         self.discount = discount
-        self.discounts = self.discount ** np.arange(self.max_path_length)[:,None]
-
-    def __getitem__(self, idx):
-        batch = super().__getitem__(idx)
-        path_ind, start, end = self.indices[idx]
-        rewards = self.fields['rewards'][path_ind, start:]
-        discounts = self.discounts[:len(rewards)]
-        value = (discounts * rewards).sum()
-        value = np.array([value], dtype=np.float32)
-        value_batch = ValueBatch(*batch, value)
+        self.returns_to_go = discounted_returns(self.fields, self.discount)
+
+    def get_batch(self, indices):
+        batch = super().get_batch(indices)
+        path_inds, starts, ends = self.indices[np.asarray(indices)].T
+        values = self.returns_to_go[self.fields.offsets[path_inds] + starts]
+        values = values[:, None].astype(np.float32)
+        value_batch = ValueBatch(*batch, values)
         return value_batch
+
+def normalizer_cache_path(env, fields, *key):
+    '''
+        path of the fitted normalizer arrays next to the d4rl dataset file and the key
+            (normalizer and dataset settings) they are saved with,
+            or (None, None) if the environment has no local dataset file
+    '''
+    try:
+        dataset_filepath = env.dataset_filepath
+        stat = os.stat(dataset_filepath)
+    except (AttributeError, TypeError, OSError):
+        return None, None
+    key = repr((*key, env.name, fields.n_episodes, int(fields.n_steps), stat.st_size, int(stat.st_mtime)))
+    digest = hashlib.md5(key.encode()).hexdigest()[:12]
+    return f'{os.path.splitext(dataset_filepath)[0]}_normalizer_{digest}.npz', key
+
+def make_indices(path_lengths, horizon, max_path_length, use_padding=True):
+    '''
+        (path_ind, start, end) of every datapoint, built with arange/repeat
+    '''
+    path_lengths = np.asarray(path_lengths)
+    max_starts = np.minimum(path_lengths - 1, max_path_length - horizon)
+    if not use_padding:
+        max_starts = np.minimum(max_starts, path_lengths - horizon)
+    max_starts = np.maximum(max_starts, 0)
+
+    path_inds = np.repeat(np.arange(len(path_lengths)), max_starts)
+    starts = np.arange(max_starts.sum()) - np.repeat(np.cumsum(max_starts) - max_starts, max_starts)
+    return np.stack([path_inds, starts, starts + horizon], axis=1)
+
+def discounted_returns(fields, discount):
+    '''
+        discounted return-to-go of every step of a (flat) replay buffer,
+        as a reverse discounted cumulative sum over each episode
+    '''
+    rewards = fields.rewards.reshape(len(fields.rewards), -1)[:, 0].astype(np.float64)
+    returns = np.zeros_like(rewards)
+    for start, end in zip(fields.offsets[:-1], fields.offsets[1:]):
+        returns[start:end] = scipy.signal.lfilter([1], [1, -discount], rewards[start:end][::-1])[::-1]
+    return returns
+
+def unbatch(batch):
+    '''
+        first (and only) item of a batch returned by `get_batch`
+    '''
+    return type(batch)(*[
+        {k: v[0] for k, v in val.items()} if type(val) is dict else val[0]
+        for val in batch
+    ])
@@ -1,2 +1,3 @@
 from .temporal import TemporalUnet, TemporalValue, MLPnet
-from .diffusion import GaussianDiffusion, ActionGaussianDiffusion, GaussianInvDynDiffusion
\ No newline at end of file
+from .diffusion import GaussianDiffusion, ActionGaussianDiffusion, GaussianInvDynDiffusion
+from .helpers import DiffusionTrace
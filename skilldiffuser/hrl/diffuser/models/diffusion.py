@@ -9,6 +9,7 @@ from .helpers import (
     cosine_beta_schedule,
     extract,
     apply_conditioning,
+    diffusion_trace,
     Losses,
 )
 
@@ -160,7 +161,8 @@ class GaussianDiffusion(nn.Module):
         x = 0.5*torch.randn(shape, device=device)
         x = apply_conditioning(x, cond, self.action_dim)
 
-        if return_diffusion: diffusion = [x]
+        trace = diffusion_trace(return_diffusion, self.n_timesteps)
+        if trace is not None: trace.record(0, x)
 
         progress = utils.Progress(self.n_timesteps) if verbose else utils.Silent()
         for i in reversed(range(0, self.n_timesteps)):
@@ -170,12 +172,12 @@ class GaussianDiffusion(nn.Module):
 
             progress.update({'t': i})
 
-            if return_diffusion: diffusion.append(x)
+            if trace is not None: trace.record(self.n_timesteps - i, x)
 
         progress.close()
 
-        if return_diffusion:
-            return x, torch.stack(diffusion, dim=1)
+        if trace is not None:
+            return x, trace.result()
         else:
             return x
 
@@ -206,7 +208,8 @@ class GaussianDiffusion(nn.Module):
         x = 0.5*torch.randn(shape, device=device)
         x = apply_conditioning(x, cond, self.action_dim)
 
-        if return_diffusion: diffusion = [x]
+        trace = diffusion_trace(return_diffusion, self.n_timesteps)
+        if trace is not None: trace.record(0, x)
 
         progress = utils.Progress(self.n_timesteps) if verbose else utils.Silent()
         for i in reversed(range(0, self.n_timesteps)):
@@ -216,12 +219,12 @@ class GaussianDiffusion(nn.Module):
 
             progress.update({'t': i})
 
-            if return_diffusion: diffusion.append(x)
+            if trace is not None: trace.record(self.n_timesteps - i, x)
 
         progress.close()
 
-        if return_diffusion:
-            return x, torch.stack(diffusion, dim=1)
+        if trace is not None:
+            return x, trace.result()
         else:
             return x
 
@@ -437,7 +440,8 @@ class GaussianInvDynDiffusion(nn.Module):
         x = 0.5*torch.randn(shape, device=device)
         x = apply_conditioning(x, cond, 0)
 
-        if return_diffusion: diffusion = [x]
+        trace = diffusion_trace(return_diffusion, self.n_timesteps)
+        if trace is not None: trace.record(0, x)
 
         progress = utils.Progress(self.n_timesteps) if verbose else utils.Silent()
         for i in reversed(range(0, self.n_timesteps)):
@@ -447,12 +451,12 @@ class GaussianInvDynDiffusion(nn.Module):
 
             progress.update({'t': i})
 
-            if return_diffusion: diffusion.append(x)
+            if trace is not None: trace.record(self.n_timesteps - i, x)
 
         progress.close()
 
-        if return_diffusion:
-            return x, torch.stack(diffusion, dim=1)
+        if trace is not None:
+            return x, trace.result()
         else:
             return x
 
@@ -735,7 +739,8 @@ class ActionGaussianDiffusion(nn.Module):
         batch_size = shape[0]
         x = 0.5*torch.randn(shape, device=device)
 
-        if return_diffusion: diffusion = [x]
+        trace = diffusion_trace(return_diffusion, self.n_timesteps)
+        if trace is not None: trace.record(0, x)
 
         progress = utils.Progress(self.n_timesteps) if verbose else utils.Silent()
         for i in reversed(range(0, self.n_timesteps)):
@@ -744,12 +749,12 @@ class ActionGaussianDiffusion(nn.Module):
 
             progress.update({'t': i})
 
-            if return_diffusion: diffusion.append(x)
+            if trace is not None: trace.record(self.n_timesteps - i, x)
 
         progress.close()
 
-        if return_diffusion:
-            return x, torch.stack(diffusion, dim=1)
+        if trace is not None:
+            return x, trace.result()
         else:
             return x
 
@@ -778,7 +783,8 @@ class ActionGaussianDiffusion(nn.Module):
         batch_size = shape[0]
         x = 0.5*torch.randn(shape, device=device)
 
-        if return_diffusion: diffusion = [x]
+        trace = diffusion_trace(return_diffusion, self.n_timesteps)
+        if trace is not None: trace.record(0, x)
 
         progress = utils.Progress(self.n_timesteps) if verbose else utils.Silent()
         for i in reversed(range(0, self.n_timesteps)):
@@ -787,12 +793,12 @@ class ActionGaussianDiffusion(nn.Module):
 
             progress.update({'t': i})
 
-            if return_diffusion: diffusion.append(x)
+            if trace is not None: trace.record(self.n_timesteps - i, x)
 
         progress.close()
 
-        if return_diffusion:
-            return x, torch.stack(diffusion, dim=1)
+        if trace is not None:
+            return x, trace.result()
         else:
             return x
 
@@ -95,6 +95,68 @@ def apply_conditioning(x, conditions, action_dim):
         x[:, t, action_dim:] = val.clone()
     return x
 
+class DiffusionTrace:
+    '''
+        records the intermediate samples of a reverse diffusion process
+            at a subset of its steps; step 0 is the initial noise and
+            step n_timesteps the final sample
+
+        every : record every k-th step (the final sample is always recorded)
+        steps : explicit schedule of steps to record, overrides `every`
+        device : device the recorded samples are kept on (default: the sampling device)
+        memmap : path of a float32 .npy file the samples are streamed to
+            instead of being kept in memory
+        callback : called as callback(step, x) at every recorded step;
+            if given without `memmap`, nothing is kept
+    '''
+
+    def __init__(self, n_timesteps, every=1, steps=None, device=None, memmap=None, callback=None):
+        if steps is None:
+            steps = list(range(0, n_timesteps + 1, every))
+            if steps[-1] != n_timesteps:
+                steps.append(n_timesteps)
+        self.steps = sorted(set(int(step) for step in steps))
+        self._positions = {step: i for i, step in enumerate(self.steps)}
+        self.device = device
+        self.memmap = memmap
+        self.callback = callback
+        self._samples = []
+        self._array = None
+
+    def record(self, step, x):
+        if step not in self._positions:
+            return
+        if self.callback is not None:
+            self.callback(step, x)
+        if self.memmap is not None:
+            if self._array is None:
+                ## [ batch_size x n_steps x ... ], same layout as the stacked trace
+                self._array = np.lib.format.open_memmap(self.memmap, mode='w+', dtype=np.float32,
+                    shape=(x.shape[0], len(self.steps), *x.shape[1:]))
+            self._array[:, self._positions[step]] = x.detach().float().cpu().numpy()
+        elif self.callback is None:
+            self._samples.append(x if self.device is None else x.to(self.device))
+
+    def result(self):
+        '''
+            [ batch_size x n_steps x ... ] recorded samples
+                (a tensor, the memmapped array, or None when only a callback is used)
+        '''
+        if self._array is not None:
+            self._array.flush()
+            return self._array
+        if self._samples:
+            return torch.stack(self._samples, dim=1)
+        return None
+
+def diffusion_trace(return_diffusion, n_timesteps):
+    '''
+        `return_diffusion` of p_sample_loop: False, True (record every step) or a DiffusionTrace
+    '''
+    if isinstance(return_diffusion, DiffusionTrace):
+        return return_diffusion
+    return DiffusionTrace(n_timesteps) if return_diffusion else None
+
 #-----------------------------------------------------------------------------#
 #---------------------------------- losses -----------------------------------#
 #-----------------------------------------------------------------------------#
@@ -24,7 +24,8 @@ from itertools import product, combinations, count, cycle, islice
 from multiprocessing import TimeoutError
 from contextlib import contextmanager
 
-from .transformations import quaternion_from_matrix, unit_vector, euler_from_quaternion, quaternion_slerp
+from .transformations import quaternion_from_matrix, unit_vector, euler_from_quaternion, quaternion_slerp, \
+    quaternions_slerp
 
 directory = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.join(directory, '../motion'))
@@ -1579,6 +1580,10 @@ def quat_combination(quat1, quat2, fraction=0.5):
     #return p.getQuaternionSlerp(quat1, quat2, interpolationFraction=fraction)
     return quaternion_slerp(quat1, quat2, fraction)
 
+def quat_combinations(quat1, quat2, fractions):
+    # quat_combination for every fraction, in one batched slerp
+    return quaternions_slerp(quat1, quat2, fractions)
+
 def quat_angle_between(quat0, quat1):
     # #p.computeViewMatrixFromYawPitchRoll()
     # q0 = unit_vector(quat0[:4])
@@ -4216,9 +4221,8 @@ def get_position_waypoints(start_point, direction, quat, step_size=0.01):
 
 def get_quaternion_waypoints(point, start_quat, end_quat, step_size=np.pi/16):
     angle = quat_angle_between(start_quat, end_quat)
-    for t in np.arange(0, angle, step_size):
-        fraction = t/angle
-        quat = quat_combination(start_quat, end_quat, fraction=fraction)
+    fractions = np.arange(0, angle, step_size) / angle if angle > 0 else []
+    for quat in quat_combinations(start_quat, end_quat, fractions):
         yield (point, quat)
     yield (point, end_quat)
 
@@ -4235,9 +4239,9 @@ def interpolate_poses(pose1, pose2, pos_step_size=0.01, ori_step_size=np.pi/16):
     num_steps = max(2, int(math.ceil(max(
         np.divide(get_pose_distance(pose1, pose2), [pos_step_size, ori_step_size])))))
     yield pose1
-    for w in np.linspace(0, 1, num=num_steps, endpoint=True)[1:-1]:
+    weights = np.linspace(0, 1, num=num_steps, endpoint=True)[1:-1]
+    for w, quat in zip(weights, quat_combinations(quat1, quat2, weights)):
         pos = convex_combination(pos1, pos2, w=w)
-        quat = quat_combination(quat1, quat2, fraction=w)
         yield (pos, quat)
     yield pose2
 
@@ -1,11 +1,13 @@
 import os
+import hashlib
+import multiprocessing
+from collections import OrderedDict
 import numpy as np
 import einops
 import imageio
 import matplotlib.pyplot as plt
 from matplotlib.colors import ListedColormap
 import gym
-import mujoco_py as mjc
 import warnings
 import pdb
 
@@ -47,6 +49,84 @@ def atmost_2d(x):
         x = x.squeeze(0)
     return x
 
+def composite_images(images):
+    '''
+        overlays the non-background pixels of [ N x H x W x C ] images
+    '''
+    composite = np.ones_like(images[0]) * 255
+
+    for img in images:
+        mask = get_image_mask(img)
+        composite[mask] = img[mask]
+
+    return composite
+
+class FrameCache:
+    '''
+        LRU cache of rendered frames, keyed by the observation and the render arguments
+    '''
+
+    def __init__(self, size=512):
+        self.size = size
+        self._frames = OrderedDict()
+
+    def key(self, observation, render_args):
+        observation = np.ascontiguousarray(observation, dtype=np.float64)
+        return hashlib.md5(observation.tobytes() + repr(render_args).encode()).digest()
+
+    def get(self, key):
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+        return frame
+
+    def put(self, key, frame):
+        self._frames[key] = frame
+        self._frames.move_to_end(key)
+        while len(self._frames) > self.size:
+            self._frames.popitem(last=False)
+
+#-----------------------------------------------------------------------------#
+#-------------------------------- render pool --------------------------------#
+#-----------------------------------------------------------------------------#
+
+## renderer owned by a render pool worker process
+_worker_renderer = None
+
+def _init_render_worker(env):
+    global _worker_renderer
+    _worker_renderer = MuJoCoRenderer(env)
+
+def _render_worker(job):
+    observations, kwargs = job
+    return np.stack([
+        _worker_renderer.render(observation, **kwargs)
+        for observation in observations
+    ], axis=0)
+
+class RenderPool:
+    '''
+        worker processes that each own an env and offscreen renderer;
+        renders batches of observations in parallel
+    '''
+
+    def __init__(self, env, n_workers):
+        assert type(env) is str, 'RenderPool workers build their own env from its name'
+        self.n_workers = n_workers
+        ## spawned, since forking a process with an OpenGL context is not safe
+        ctx = multiprocessing.get_context('spawn')
+        self._pool = ctx.Pool(n_workers, initializer=_init_render_worker, initargs=(env,))
+
+    def render(self, observations, **kwargs):
+        n_chunks = min(len(observations), self.n_workers)
+        chunks = np.array_split(np.arange(len(observations)), n_chunks)
+        jobs = [([observations[i] for i in chunk], kwargs) for chunk in chunks]
+        return np.concatenate(self._pool.map(_render_worker, jobs), axis=0)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
 #-----------------------------------------------------------------------------#
 #---------------------------------- renderers --------------------------------#
 #-----------------------------------------------------------------------------#
@@ -56,17 +136,26 @@ class MuJoCoRenderer:
         default mujoco renderer
     '''
 
-    def __init__(self, env):
+    def __init__(self, env, n_workers=0, cache_size=512):
         if type(env) is str:
             env = env_map(env)
             self.env = gym.make(env)
         else:
             self.env = env
+        self.pool = None
+        if n_workers > 0:
+            if type(env) is str:
+                self.pool = RenderPool(env, n_workers)
+            else:
+                print('[ utils/rendering ] Warning: render pool needs an env name, rendering in process')
+        self.cache = FrameCache(cache_size) if cache_size > 0 else None
         ## - 1 because the envs in renderer are fully-observed
         ## @TODO : clean up
         self.observation_dim = np.prod(self.env.observation_space.shape) - 1
         self.action_dim = np.prod(self.env.action_space.shape)
         try:
+            ## imported here, so the diffuser utils can be used on machines without mujoco
+            import mujoco_py as mjc
             self.viewer = mjc.MjRenderContextOffscreen(self.env.sim)
         except:
             print('[ utils/rendering ] Warning: could not initialize offscreen renderer')
@@ -131,12 +220,30 @@ class MuJoCoRenderer:
         data = data[::-1, :, :]
         return data
 
+    def _render_batch(self, observations, **kwargs):
+        if self.pool is not None and len(observations) > 1:
+            return self.pool.render(observations, **kwargs)
+        return np.stack([self.render(observation, **kwargs) for observation in observations], axis=0)
+
     def _renders(self, observations, **kwargs):
-        images = []
-        for observation in observations:
-            img = self.render(observation, **kwargs)
-            images.append(img)
-        return np.stack(images, axis=0)
+        if self.cache is None:
+            return self._render_batch(observations, **kwargs)
+
+        ## only render (each distinct) observation missing from the frame cache
+        render_args = sorted(kwargs.items())
+        keys = [self.cache.key(observation, render_args) for observation in observations]
+        frames, missing = {}, []
+        for i, key in enumerate(keys):
+            if key not in frames:
+                frames[key] = self.cache.get(key)
+                if frames[key] is None:
+                    missing.append(i)
+        if len(missing):
+            rendered = self._render_batch([observations[i] for i in missing], **kwargs)
+            for i, frame in zip(missing, rendered):
+                frames[keys[i]] = frame
+                self.cache.put(keys[i], frame)
+        return np.stack([frames[key] for key in keys], axis=0)
 
     def renders(self, samples, partial=False, **kwargs):
         if partial:
@@ -144,30 +251,32 @@ class MuJoCoRenderer:
             partial = False
 
         sample_images = self._renders(samples, partial=partial, **kwargs)
+        return composite_images(sample_images)
 
-        composite = np.ones_like(sample_images[0]) * 255
-
-        for img in sample_images:
-            mask = get_image_mask(img)
-            composite[mask] = img[mask]
-
-        return composite
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
-    def composite(self, savepath, paths, dim=(1024, 256), **kwargs):
+    def composite(self, savepath, paths, dim=(1024, 256), render_kwargs=None, **kwargs):
 
-        render_kwargs = {
-            'trackbodyid': 2,
-            'distance': 10,
-            'lookat': [5, 2, 0.5],
-            'elevation': 0
-        }
-        images = []
-        for path in paths:
-            ## [ H x obs_dim ]
-            path = atmost_2d(path)
-            img = self.renders(to_np(path), dim=dim, partial=True, qvel=True, render_kwargs=render_kwargs, **kwargs)
-            images.append(img)
-        images = np.concatenate(images, axis=0)
+        if render_kwargs is None:
+            render_kwargs = {
+                'trackbodyid': 2,
+                'distance': 10,
+                'lookat': [5, 2, 0.5],
+                'elevation': 0
+            }
+        ## render the states of all paths in one batch
+        ## [ H x obs_dim ]
+        paths = [self.pad_observations(atmost_2d(to_np(path))) for path in paths]
+        sample_images = self._renders(np.concatenate(paths, axis=0), dim=dim, partial=False,
+            qvel=True, render_kwargs=render_kwargs, **kwargs)
+        splits = np.cumsum([len(path) for path in paths])[:-1]
+        images = np.concatenate([
+            composite_images(path_images)
+            for path_images in np.split(sample_images, splits)
+        ], axis=0)
 
         if savepath is not None:
             fig = plt.figure()
@@ -191,15 +300,14 @@ class MuJoCoRenderer:
         ## does not have an associated next_state in the sampled trajectory
         observations_real = observations_real[:,:-1]
 
-        images_pred = np.stack([
-            self._renders(obs_pred, partial=True)
-            for obs_pred in observations_pred
-        ])
+        ## [ batch_size x horizon x H x W x C ], all samples rendered in one batch
+        batch_size, horizon = observations_pred.shape[:2]
+        images_pred = self._renders(observations_pred.reshape(batch_size * horizon, -1), partial=True)
+        images_pred = images_pred.reshape(batch_size, horizon, *images_pred.shape[1:])
 
-        images_real = np.stack([
-            self._renders(obs_real, partial=False)
-            for obs_real in observations_real
-        ])
+        batch_size, horizon = observations_real.shape[:2]
+        images_real = self._renders(observations_real.reshape(batch_size * horizon, -1), partial=False)
+        images_real = images_real.reshape(batch_size, horizon, *images_real.shape[1:])
 
         ## [ batch_size x horizon x H x W x C ]
         images = np.concatenate([images_pred, images_real], axis=-2)
@@ -220,22 +328,18 @@ class MuJoCoRenderer:
 
         n_diffusion_steps, batch_size, _, horizon, joined_dim = diffusion_path.shape
 
-        frames = []
-        for t in reversed(range(n_diffusion_steps)):
-            print(f'[ utils/renderer ] Diffusion: {t} / {n_diffusion_steps}')
-
-            ## [ batch_size x horizon x observation_dim ]
-            states_l = diffusion_path[t].reshape(batch_size, horizon, joined_dim)[:, :, :self.observation_dim]
+        def frames():
+            for t in reversed(range(n_diffusion_steps)):
+                print(f'[ utils/renderer ] Diffusion: {t} / {n_diffusion_steps}')
 
-            frame = []
-            for states in states_l:
-                img = self.composite(None, states, dim=(1024, 256), partial=True, qvel=True, render_kwargs=render_kwargs)
-                frame.append(img)
-            frame = np.concatenate(frame, axis=0)
+                ## [ batch_size x horizon x observation_dim ]
+                states_l = diffusion_path[t].reshape(batch_size, horizon, joined_dim)[:, :, :self.observation_dim]
 
-            frames.append(frame)
+                ## [ batch_size * H x W x C ]
+                yield self.composite(None, states_l[:, None], dim=(1024, 256), render_kwargs=render_kwargs)
 
-        save_video(savepath, frames, **video_kwargs)
+        ## frames are written as they are rendered instead of being collected first
+        save_video(savepath, frames(), **video_kwargs)
 
     def __call__(self, *args, **kwargs):
         return self.renders(*args, **kwargs)
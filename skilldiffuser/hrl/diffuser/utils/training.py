@@ -17,6 +17,22 @@ def cycle(dl):
         for data in dl:
             yield data
 
+def batch_loader(dataset, batch_size):
+    '''
+        shuffled dataloader; datasets with a `get_batch` method are sampled
+        a whole batch of indices at a time instead of collating single items
+    '''
+    if not hasattr(dataset, 'get_batch'):
+        return torch.utils.data.DataLoader(
+            dataset, batch_size=batch_size, num_workers=0, shuffle=True, pin_memory=True
+        )
+    sampler = torch.utils.data.BatchSampler(
+        torch.utils.data.RandomSampler(dataset), batch_size=batch_size, drop_last=False
+    )
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=None, sampler=sampler, num_workers=0, pin_memory=True
+    )
+
 class EMA():
     '''
         empirical moving average
@@ -76,12 +92,8 @@ class Trainer(object):
 
         self.dataset = dataset
 
-        self.dataloader = cycle(torch.utils.data.DataLoader(
-            self.dataset, batch_size=train_batch_size, num_workers=0, shuffle=True, pin_memory=True
-        ))
-        self.dataloader_vis = cycle(torch.utils.data.DataLoader(
-            self.dataset, batch_size=1, num_workers=0, shuffle=True, pin_memory=True
-        ))
+        self.dataloader = cycle(batch_loader(self.dataset, train_batch_size))
+        self.dataloader_vis = cycle(batch_loader(self.dataset, 1))
         self.renderer = renderer
         self.optimizer = torch.optim.Adam(diffusion_model.parameters(), lr=train_lr)
 
@@ -189,9 +201,7 @@ class Trainer(object):
         '''
 
         ## get a temporary dataloader to load a single batch
-        dataloader_tmp = cycle(torch.utils.data.DataLoader(
-            self.dataset, batch_size=batch_size, num_workers=0, shuffle=True, pin_memory=True
-        ))
+        dataloader_tmp = cycle(batch_loader(self.dataset, batch_size))
         batch = dataloader_tmp.__next__()
         dataloader_tmp.close()
 
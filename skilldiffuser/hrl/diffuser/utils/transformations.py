@@ -148,6 +148,11 @@ import math
 
 import numpy
 
+try:
+    import torch
+except ImportError:
+    torch = None
+
 # Documentation in HTML format can be generated with Epydoc
 __docformat__ = "restructuredtext en"
 
@@ -1547,6 +1552,285 @@ def is_same_transform(matrix0, matrix1):
     return numpy.allclose(matrix0, matrix1)
 
 
+# batched transformations
+#
+# The functions below take stacks of quaternions [..., 4], 4x4 matrices [..., 4, 4]
+# or angles [...] and compute the same results as their single-transform
+# counterparts above, on numpy arrays or (if available) torch tensors.
+
+def _array_module(data):
+    """Return (data as float array or tensor, numpy or torch)."""
+    if torch is not None and torch.is_tensor(data):
+        return (data if data.is_floating_point() else data.double()), torch
+    return numpy.array(data, dtype=numpy.float64, copy=True), numpy
+
+
+def unit_vectors(data):
+    """Return stack of vectors normalized along the last axis.
+    >>> v0 = numpy.random.rand(5, 4, 3)
+    >>> v1 = unit_vectors(v0)
+    >>> numpy.allclose(v1, unit_vector(v0, axis=-1))
+    True
+    """
+    data, xp = _array_module(data)
+    return data / xp.sqrt((data*data).sum(-1))[..., None]
+
+
+def quaternion_matrices(quaternions):
+    """Return stack of homogeneous rotation matrices from stack of quaternions.
+    >>> q = numpy.stack([random_quaternion() for _ in range(10)] + [numpy.zeros(4)])
+    >>> R = quaternion_matrices(q)
+    >>> all(numpy.allclose(R[n], quaternion_matrix(q[n])) for n in range(len(q)))
+    True
+    """
+    q, xp = _array_module(quaternions)
+    q = q[..., :4]
+    nq = (q*q).sum(-1)
+    small = nq < _EPS
+    q = q * xp.sqrt(2.0 / xp.where(small, xp.ones_like(nq), nq))[..., None]
+    q = q[..., :, None] * q[..., None, :]
+    zeros, ones = xp.zeros_like(nq), xp.ones_like(nq)
+    M = xp.stack([
+        xp.stack([1.0-q[..., 1, 1]-q[..., 2, 2], q[..., 0, 1]-q[..., 2, 3], q[..., 0, 2]+q[..., 1, 3], zeros], -1),
+        xp.stack([q[..., 0, 1]+q[..., 2, 3], 1.0-q[..., 0, 0]-q[..., 2, 2], q[..., 1, 2]-q[..., 0, 3], zeros], -1),
+        xp.stack([q[..., 0, 2]-q[..., 1, 3], q[..., 1, 2]+q[..., 0, 3], 1.0-q[..., 0, 0]-q[..., 1, 1], zeros], -1),
+        xp.stack([zeros, zeros, zeros, ones], -1),
+    ], -2)
+    identity = xp.zeros_like(M)
+    for n in range(4):
+        identity[..., n, n] = 1.0
+    return xp.where(small[..., None, None], identity, M)
+
+
+def quaternions_from_matrices(matrices):
+    """Return stack of quaternions from stack of rotation matrices.
+    >>> R = numpy.stack([random_rotation_matrix() for _ in range(100)])
+    >>> R[:3, :3, :3] = numpy.diag([1, -1, -1]), numpy.diag([-1, 1, -1]), numpy.diag([-1, -1, 1])
+    >>> q = quaternions_from_matrices(R)
+    >>> all(numpy.allclose(q[n], quaternion_from_matrix(R[n])) for n in range(len(R)))
+    True
+    """
+    M, xp = _array_module(matrices)
+    M = M[..., :4, :4]
+    diag = [M[..., n, n] for n in range(4)]
+    t = diag[0] + diag[1] + diag[2] + diag[3]
+
+    ## trace branch
+    q = xp.stack([M[..., 2, 1] - M[..., 1, 2],
+                  M[..., 0, 2] - M[..., 2, 0],
+                  M[..., 1, 0] - M[..., 0, 1],
+                  t], -1)
+    scale = t
+
+    ## largest diagonal element branches, selected in the same order as the scalar version
+    largest = xp.where(diag[1] > diag[0], xp.ones_like(t), xp.zeros_like(t))
+    largest = xp.where(diag[2] > xp.where(largest == 1, diag[1], diag[0]), 2 * xp.ones_like(t), largest)
+    use_trace = t > diag[3]
+    for i, j, k in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+        ti = diag[i] - (diag[j] + diag[k]) + diag[3]
+        qi = [None] * 4
+        qi[i] = ti
+        qi[j] = M[..., i, j] + M[..., j, i]
+        qi[k] = M[..., k, i] + M[..., i, k]
+        qi[3] = M[..., k, j] - M[..., j, k]
+        select = (~use_trace) & (largest == i)
+        q = xp.where(select[..., None], xp.stack(qi, -1), q)
+        scale = xp.where(select, ti, scale)
+
+    return q * (0.5 / xp.sqrt(scale * diag[3]))[..., None]
+
+
+def eulers_from_matrices(matrices, axes='sxyz'):
+    """Return stack of Euler angles [..., 3] from stack of rotation matrices.
+    >>> R = numpy.stack([random_rotation_matrix() for _ in range(20)] + [euler_matrix(1, math.pi/2, 0)])
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    angles = eulers_from_matrices(R, axes)
+    ...    for n in range(len(R)):
+    ...        if not numpy.allclose(angles[n], euler_from_matrix(R[n], axes)): print(axes, "failed")
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _ = _TUPLE2AXES[axes]
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    M, xp = _array_module(matrices)
+    M = M[..., :3, :3]
+    if repetition:
+        sy = xp.sqrt(M[..., i, j]*M[..., i, j] + M[..., i, k]*M[..., i, k])
+        regular = sy > _EPS
+        ax = xp.where(regular, xp.arctan2(M[..., i, j], M[..., i, k]), xp.arctan2(-M[..., j, k], M[..., j, j]))
+        ay = xp.arctan2(sy, M[..., i, i])
+        az = xp.where(regular, xp.arctan2(M[..., j, i], -M[..., k, i]), xp.zeros_like(sy))
+    else:
+        cy = xp.sqrt(M[..., i, i]*M[..., i, i] + M[..., j, i]*M[..., j, i])
+        regular = cy > _EPS
+        ax = xp.where(regular, xp.arctan2(M[..., k, j], M[..., k, k]), xp.arctan2(-M[..., j, k], M[..., j, j]))
+        ay = xp.arctan2(-M[..., k, i], cy)
+        az = xp.where(regular, xp.arctan2(M[..., j, i], M[..., i, i]), xp.zeros_like(cy))
+
+    if parity:
+        ax, ay, az = -ax, -ay, -az
+    if frame:
+        ax, az = az, ax
+    return xp.stack([ax, ay, az], -1)
+
+
+def eulers_from_quaternions(quaternions, axes='sxyz'):
+    """Return stack of Euler angles [..., 3] from stack of quaternions.
+    >>> q = numpy.stack([random_quaternion() for _ in range(10)])
+    >>> angles = eulers_from_quaternions(q, 'rxyz')
+    >>> all(numpy.allclose(angles[n], euler_from_quaternion(q[n], 'rxyz')) for n in range(len(q)))
+    True
+    """
+    return eulers_from_matrices(quaternion_matrices(quaternions), axes)
+
+
+def quaternions_from_eulers(angles, axes='sxyz'):
+    """Return stack of quaternions from stack of Euler angles [..., 3].
+    >>> angles = (4.0*math.pi) * (numpy.random.random((10, 3)) - 0.5)
+    >>> for axes in _AXES2TUPLE.keys():
+    ...    q = quaternions_from_eulers(angles, axes)
+    ...    for n in range(len(angles)):
+    ...        if not numpy.allclose(q[n], quaternion_from_euler(axes=axes, *angles[n])): print(axes, "failed")
+    """
+    try:
+        firstaxis, parity, repetition, frame = _AXES2TUPLE[axes.lower()]
+    except (AttributeError, KeyError):
+        _ = _TUPLE2AXES[axes]
+        firstaxis, parity, repetition, frame = axes
+
+    i = firstaxis
+    j = _NEXT_AXIS[i+parity]
+    k = _NEXT_AXIS[i-parity+1]
+
+    angles, xp = _array_module(angles)
+    ai, aj, ak = angles[..., 0], angles[..., 1], angles[..., 2]
+    if frame:
+        ai, ak = ak, ai
+    if parity:
+        aj = -aj
+
+    ai = ai / 2.0
+    aj = aj / 2.0
+    ak = ak / 2.0
+    ci, si = xp.cos(ai), xp.sin(ai)
+    cj, sj = xp.cos(aj), xp.sin(aj)
+    ck, sk = xp.cos(ak), xp.sin(ak)
+    cc, cs = ci*ck, ci*sk
+    sc, ss = si*ck, si*sk
+
+    quaternion = [None] * 4
+    if repetition:
+        quaternion[i] = cj*(cs + sc)
+        quaternion[j] = sj*(cc + ss)
+        quaternion[k] = sj*(cs - sc)
+        quaternion[3] = cj*(cc - ss)
+    else:
+        quaternion[i] = cj*sc - sj*cs
+        quaternion[j] = cj*ss + sj*cc
+        quaternion[k] = cj*cs - sj*sc
+        quaternion[3] = cj*cc + sj*ss
+    if parity:
+        quaternion[j] = -quaternion[j]
+
+    return xp.stack(quaternion, -1)
+
+
+def quaternions_multiply(quaternions1, quaternions0):
+    """Return stack of products of two stacks of quaternions.
+    >>> q0 = numpy.stack([random_quaternion() for _ in range(10)])
+    >>> q1 = numpy.stack([random_quaternion() for _ in range(10)])
+    >>> q = quaternions_multiply(q1, q0)
+    >>> all(numpy.allclose(q[n], quaternion_multiply(q1[n], q0[n])) for n in range(10))
+    True
+    """
+    q0, xp = _array_module(quaternions0)
+    q1, _ = _array_module(quaternions1)
+    x0, y0, z0, w0 = q0[..., 0], q0[..., 1], q0[..., 2], q0[..., 3]
+    x1, y1, z1, w1 = q1[..., 0], q1[..., 1], q1[..., 2], q1[..., 3]
+    return xp.stack([
+         x1*w0 + y1*z0 - z1*y0 + w1*x0,
+        -x1*z0 + y1*w0 + z1*x0 + w1*y0,
+         x1*y0 - y1*x0 + z1*w0 + w1*z0,
+        -x1*x0 - y1*y0 - z1*z0 + w1*w0], -1)
+
+
+def quaternions_conjugate(quaternions):
+    """Return stack of conjugates of a stack of quaternions.
+    >>> q0 = numpy.stack([random_quaternion() for _ in range(10)])
+    >>> q1 = quaternions_conjugate(q0)
+    >>> all(numpy.allclose(q1[n], quaternion_conjugate(q0[n])) for n in range(10))
+    True
+    """
+    q, xp = _array_module(quaternions)
+    return xp.stack([-q[..., 0], -q[..., 1], -q[..., 2], q[..., 3]], -1)
+
+
+def quaternions_inverse(quaternions):
+    """Return stack of inverses of a stack of quaternions.
+    >>> q0 = numpy.stack([random_quaternion() for _ in range(10)])
+    >>> q1 = quaternions_inverse(q0)
+    >>> all(numpy.allclose(q1[n], quaternion_inverse(q0[n])) for n in range(10))
+    True
+    """
+    q, _ = _array_module(quaternions)
+    return quaternions_conjugate(q) / (q*q).sum(-1)[..., None]
+
+
+def quaternions_slerp(quats0, quats1, fraction, spin=0, shortestpath=True):
+    """Return spherical linear interpolations between two stacks of quaternions.
+    fraction : scalar or stack of fractions, broadcast against the stacks
+    >>> q = quaternions_slerp([0, 0, 0, 1], [0, 0, 1, 0], numpy.linspace(0, 1, 5))
+    >>> numpy.allclose(q[2], quaternion_slerp([0, 0, 0, 1], [0, 0, 1, 0], 0.5))
+    True
+    >>> q0 = numpy.stack([random_quaternion() for _ in range(10)] + [[0, 0, 0, 1]])
+    >>> q1 = numpy.stack([random_quaternion() for _ in range(10)] + [[0, 0, 0, 1]])
+    >>> fraction = numpy.random.random(11)
+    >>> fraction[:2] = 0.0, 1.0
+    >>> q = quaternions_slerp(q0, q1, fraction)
+    >>> all(numpy.allclose(q[n], quaternion_slerp(q0[n], q1[n], fraction[n])) for n in range(11))
+    True
+    """
+    q0, xp = _array_module(quats0)
+    q1, _ = _array_module(quats1)
+    q0 = unit_vectors(q0[..., :4])
+    q1 = unit_vectors(q1[..., :4])
+    if xp is numpy:
+        fraction = numpy.asarray(fraction, dtype=numpy.float64)
+        shape = numpy.broadcast_shapes(q0.shape[:-1], q1.shape[:-1], fraction.shape)
+        q0, q1 = numpy.broadcast_to(q0, shape + (4,)), numpy.broadcast_to(q1, shape + (4,))
+        fraction = numpy.broadcast_to(fraction, shape)
+    else:
+        fraction = torch.as_tensor(fraction, dtype=q0.dtype, device=q0.device)
+        shape = torch.broadcast_shapes(q0.shape[:-1], q1.shape[:-1], fraction.shape)
+        q0, q1 = q0.expand(shape + (4,)), q1.expand(shape + (4,))
+        fraction = fraction.expand(shape)
+
+    d = (q0*q1).sum(-1)
+    keep_q0 = xp.abs(xp.abs(d) - 1.0) < _EPS
+    if shortestpath:
+        # invert rotation
+        flip = d < 0.0
+        d = xp.where(flip, -d, d)
+        q1_short = xp.where(flip[..., None], -q1, q1)
+    else:
+        q1_short = q1
+    angle = xp.arccos(xp.clip(d, -1.0, 1.0)) + spin * math.pi
+    keep_q0 = keep_q0 | (xp.abs(angle) < _EPS)
+    isin = 1.0 / xp.where(keep_q0, xp.ones_like(angle), xp.sin(angle))
+    q = (q0 * (xp.sin((1.0 - fraction) * angle) * isin)[..., None] +
+         q1_short * (xp.sin(fraction * angle) * isin)[..., None])
+
+    q = xp.where(keep_q0[..., None], q0, q)
+    q = xp.where((fraction == 1.0)[..., None], q1, q)
+    return xp.where((fraction == 0.0)[..., None], q0, q)
+
+
 def _import_module(module_name, warn=True, prefix='_py_', ignore='_'):
     """Try import all public attributes from module into global namespace.
     Existing attributes with name clashes are renamed with prefix.
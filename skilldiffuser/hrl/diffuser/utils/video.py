@@ -9,13 +9,16 @@ def _make_dir(filename):
         os.makedirs(folder)
 
 def save_video(filename, video_frames, fps=60, video_format='mp4'):
+    '''
+        video_frames : [ N x H x W x C ] array, or any iterable of [ H x W x C ] frames;
+            frames are encoded as they are produced, so a generator is never held in memory
+    '''
     assert fps == int(fps), fps
     # logger.save_video(video_frames, filename, fps=fps, format=video_format)
     _make_dir(filename)
 
-    skvideo.io.vwrite(
+    writer = skvideo.io.FFmpegWriter(
         filename,
-        video_frames,
         inputdict={
             '-r': str(int(fps)),
         },
@@ -24,6 +27,11 @@ def save_video(filename, video_frames, fps=60, video_format='mp4'):
             '-pix_fmt': 'yuv420p', # '-pix_fmt=yuv420p' needed for osx https://github.com/scikit-video/scikit-video/issues/74
         }
     )
+    try:
+        for frame in video_frames:
+            writer.writeFrame(frame)
+    finally:
+        writer.close()
 
 def save_videos(filename, *video_frames, axis=1, **kwargs):
     ## video_frame : [ N x H x W x C ]
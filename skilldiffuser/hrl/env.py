@@ -1,3 +1,6 @@
+import multiprocessing as mp
+import zlib
+
 import numpy as np
 import copy
 import gym
@@ -172,6 +175,8 @@ class LorlWrapper(gym.Wrapper):
         self.initial_state = None
         self.instr = kwargs["instr"]
         self.orig_instr = kwargs["orig_instr"]
+        # LorlResetState to start the (non rendered) episodes from instead of initializing them
+        self.reset_state = kwargs.get("reset_state")
 
     def reset(self, render=False, **kwargs):
         if render:
@@ -179,85 +184,10 @@ class LorlWrapper(gym.Wrapper):
 
         env = self.env
         orig_instr, instr = self.orig_instr, self.instr
-        im, _ = env.reset()
-
-        # Initialize state for different tasks
-        if orig_instr == "open drawer":
-            env.sim.data.qpos[14] = 0 + np.random.uniform(-0.05, 0)
-        elif orig_instr == "close drawer":
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == "turn faucet right":
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-        elif orig_instr == "turn faucet left":
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-        elif orig_instr == "move black mug right":
-            env.sim.data.qpos[11] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[12] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == "move white mug down":
-            env.sim.data.qpos[9] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[10] = 0.65 + np.random.uniform(-0.05, 0.05)
-        # Dont know if the following are correct
-        elif orig_instr == 'open drawer and move black mug right':
-            env.sim.data.qpos[14] = 0 + np.random.uniform(-0.05, 0)
-            env.sim.data.qpos[11] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[12] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'pull the handle and move black mug down':
-            env.sim.data.qpos[14] = 0 + np.random.uniform(-0.05, 0)
-            env.sim.data.qpos[11] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[12] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'move white mug right':
-            env.sim.data.qpos[9] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[10] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'move black mug down':
-            env.sim.data.qpos[11] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[12] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'close drawer and turn faucet right':
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-        elif orig_instr == 'close drawer and turn faucet left':
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-        elif orig_instr == 'turn faucet left and move white mug down':
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-            env.sim.data.qpos[9] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[10] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'turn faucet right and close drawer':
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'move white mug down and turn faucet left':
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-            env.sim.data.qpos[9] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[10] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif orig_instr == 'close the drawer, turn the faucet left and move black mug right':
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-            env.sim.data.qpos[11] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[12] = 0.65 + np.random.uniform(-0.05, 0.05)
-        elif instr == "open drawer and turn faucet counterclockwise":
-            env.sim.data.qpos[14] = 0 + np.random.uniform(-0.05, 0)
-            env.sim.data.qpos[13] = 0 + np.random.uniform(-np.pi/5, np.pi/5)
-        elif instr == "slide the drawer closed and then shift white mug down":
-            env.sim.data.qpos[14] = -0.1 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[9] = -0.2 + np.random.uniform(-0.05, 0.05)
-            env.sim.data.qpos[10] = 0.65 + np.random.uniform(-0.05, 0.05)
-
-        # if orig_instr == "move white mug down":
-        #    env._reset_hand(pos=[-0.1, 0.55, 0.1])
-        # elif orig_instr == "move black mug right":
-        #    env._reset_hand(pos=[-0.1, 0.55, 0.1])
-        if "mug" in orig_instr:
-            env._reset_hand(pos=[-0.1, 0.55, 0.1])
+        if self.reset_state is not None and not render:
+            im = self.reset_state.restore(env)
         else:
-            env._reset_hand(pos=[0, 0.45, 0.1])
-
-        for _ in range(50):
-            env.sim.step()
-
-        reset_state = copy.deepcopy(env.sim.data.qpos[:])
-        env.sim.data.qpos[:] = reset_state
-        env.sim.data.qacc[:] = 0
-        env.sim.data.qvel[:] = 0
-        env.sim.step()
+            im, reset_state = lorl_initialize(env, orig_instr, instr)
         self.initial_state = copy.deepcopy(env.sim.data.qpos[:])
 
         if render:
@@ -333,3 +263,194 @@ class LorlWrapper(gym.Wrapper):
         obs = self.sim.render(h, w, camera_name="cam0") / 255.
         im = np.flip(obs, 0).copy()
         return (im[:, :, :3]*255.0).astype(np.uint8)
+
+
+def lorl_initialize(env, orig_instr, instr, rng=np.random):
+    """
+    Reset a LOReL env to the initial state of an episode of orig_instr (instr for the rephrasals that need it),
+    with the random perturbations drawn from rng.
+    Returns the image observation of env.reset and the positions before the state was settled
+    """
+    im, _ = env.reset()
+
+    # Initialize state for different tasks
+    if orig_instr == "open drawer":
+        env.sim.data.qpos[14] = 0 + rng.uniform(-0.05, 0)
+    elif orig_instr == "close drawer":
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == "turn faucet right":
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+    elif orig_instr == "turn faucet left":
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+    elif orig_instr == "move black mug right":
+        env.sim.data.qpos[11] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[12] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == "move white mug down":
+        env.sim.data.qpos[9] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[10] = 0.65 + rng.uniform(-0.05, 0.05)
+    # Dont know if the following are correct
+    elif orig_instr == 'open drawer and move black mug right':
+        env.sim.data.qpos[14] = 0 + rng.uniform(-0.05, 0)
+        env.sim.data.qpos[11] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[12] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'pull the handle and move black mug down':
+        env.sim.data.qpos[14] = 0 + rng.uniform(-0.05, 0)
+        env.sim.data.qpos[11] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[12] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'move white mug right':
+        env.sim.data.qpos[9] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[10] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'move black mug down':
+        env.sim.data.qpos[11] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[12] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'close drawer and turn faucet right':
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+    elif orig_instr == 'close drawer and turn faucet left':
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+    elif orig_instr == 'turn faucet left and move white mug down':
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+        env.sim.data.qpos[9] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[10] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'turn faucet right and close drawer':
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'move white mug down and turn faucet left':
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+        env.sim.data.qpos[9] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[10] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif orig_instr == 'close the drawer, turn the faucet left and move black mug right':
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+        env.sim.data.qpos[11] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[12] = 0.65 + rng.uniform(-0.05, 0.05)
+    elif instr == "open drawer and turn faucet counterclockwise":
+        env.sim.data.qpos[14] = 0 + rng.uniform(-0.05, 0)
+        env.sim.data.qpos[13] = 0 + rng.uniform(-np.pi/5, np.pi/5)
+    elif instr == "slide the drawer closed and then shift white mug down":
+        env.sim.data.qpos[14] = -0.1 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[9] = -0.2 + rng.uniform(-0.05, 0.05)
+        env.sim.data.qpos[10] = 0.65 + rng.uniform(-0.05, 0.05)
+
+    # if orig_instr == "move white mug down":
+    #    env._reset_hand(pos=[-0.1, 0.55, 0.1])
+    # elif orig_instr == "move black mug right":
+    #    env._reset_hand(pos=[-0.1, 0.55, 0.1])
+    if "mug" in orig_instr:
+        env._reset_hand(pos=[-0.1, 0.55, 0.1])
+    else:
+        env._reset_hand(pos=[0, 0.45, 0.1])
+
+    for _ in range(50):
+        env.sim.step()
+
+    reset_state = copy.deepcopy(env.sim.data.qpos[:])
+    env.sim.data.qpos[:] = reset_state
+    env.sim.data.qacc[:] = 0
+    env.sim.data.qvel[:] = 0
+    env.sim.step()
+    return im, reset_state
+
+
+class LorlResetState:
+    """
+    Simulator state of a LOReL env right after lorl_initialize, and the first observation of the episode.
+    `restore` puts an env back in that state with one set_state instead of resetting, perturbing and settling it.
+    """
+
+    def __init__(self, env, im):
+        data = env.sim.data
+        self.sim_state = env.sim.get_state()
+        # the hand is driven by the mocap body, which is not part of the MjSimState
+        self.mocap_pos = data.mocap_pos.copy()
+        self.mocap_quat = data.mocap_quat.copy()
+        self.qacc_warmstart = data.qacc_warmstart.copy()
+        self.im = im
+
+    def restore(self, env):
+        env.sim.set_state(self.sim_state)
+        env.sim.data.mocap_pos[:] = self.mocap_pos
+        env.sim.data.mocap_quat[:] = self.mocap_quat
+        env.sim.data.qacc_warmstart[:] = self.qacc_warmstart
+        env.sim.forward()
+        return self.im
+
+
+def lorl_reset_seed(seed, orig_instr, instr, index):
+    """Seed of the index-th initial state of (orig_instr, instr), independent of the process that generates it"""
+    key = zlib.crc32(f'{orig_instr}\n{instr}'.encode())
+    return int(np.random.SeedSequence([seed, key, index]).generate_state(1)[0])
+
+
+def make_lorl_reset_state(env, orig_instr, instr, seed):
+    env.seed(seed)
+    im, _ = lorl_initialize(env, orig_instr, instr, rng=np.random.RandomState(seed))
+    return LorlResetState(env, im)
+
+
+def make_env(env_id, **kwargs):
+    """gym.make that also works in fresh worker processes, where the LOReL envs are not registered yet"""
+    try:
+        import lorl_env  # registers the LOReL envs
+    except ImportError:
+        pass
+    import fake_lorl_env  # registers LorlFake-v0
+
+    return gym.make(env_id, **kwargs)
+
+
+def _reset_state_worker(env_id, jobs):
+    env = make_env(env_id)
+    try:
+        return [make_lorl_reset_state(env, orig_instr, instr, seed) for orig_instr, instr, seed in jobs]
+    finally:
+        env.close()
+
+
+class LorlResetPool:
+    """
+    Initial states of LOReL evaluation episodes, generated once and restored at every evaluation.
+
+    The index-th state of (orig_instr, instr) only depends on `seed`, so evaluations see the same initial states
+    whichever process or worker generated them. `fill` generates the missing states in `n_workers` processes,
+    `get` returns a LorlResetState that is passed to LorlWrapper as `reset_state`.
+    """
+
+    def __init__(self, env_id, seed=0, n_workers=1, context='spawn'):
+        self.env_id = env_id
+        self.seed = seed
+        self.n_workers = n_workers
+        self.context = context
+        self.states = {}
+
+    def __len__(self):
+        return len(self.states)
+
+    def fill(self, instrs, n):
+        """Make sure the first n states of every (orig_instr, instr) of instrs are generated.
+        They are generated with envs of their own, so the RNG of the eval env is left untouched
+        """
+        jobs = [(orig_instr, instr, index) for orig_instr, instr in dict.fromkeys(instrs) for index in range(n)
+                if (orig_instr, instr, index) not in self.states]
+        if not jobs:
+            return
+        seeded_jobs = [(orig_instr, instr, lorl_reset_seed(self.seed, orig_instr, instr, index))
+                       for orig_instr, instr, index in jobs]
+
+        if self.n_workers > 1:
+            n_workers = min(self.n_workers, len(jobs))
+            chunks = [seeded_jobs[i::n_workers] for i in range(n_workers)]
+            with mp.get_context(self.context).Pool(n_workers) as pool:
+                results = pool.starmap(_reset_state_worker, [(self.env_id, chunk) for chunk in chunks])
+            # undo the round robin split
+            reset_states = [None] * len(jobs)
+            for i, result in enumerate(results):
+                reset_states[i::n_workers] = result
+        else:
+            reset_states = _reset_state_worker(self.env_id, seeded_jobs)
+
+        self.states.update(zip(jobs, reset_states))
+
+    def get(self, orig_instr, instr, index):
+        return self.states[(orig_instr, instr, index)]
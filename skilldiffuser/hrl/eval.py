@@ -11,6 +11,9 @@ import torch
 # from stable_baselines3.common.vec_env import SubprocVecEnv
 # from stable_baselines3.common.utils import set_random_seed
 
+from history import HistoryBuffer, StateHistoryBuffer
+from option_transformer import OptionTransformerCache
+from utils import pad
 from viz import get_tokens
 
 
@@ -52,134 +55,35 @@ from viz import get_tokens
 #     env.close()
 
 
-# def parallel_eval_episode(
-#         num_episodes, env, tokenizer, model, max_ep_len, K, words_dict, render, device, N=20, **kwargs):
-#     """
-#         Evaluate num_episodes episodes in parallel across N parallel envs
-#     """
-#     # keep track of total returns and episode_lengths
-#     returns, lengths, success_list = [], [], []
-#     episode_counts = np.zeros(N, dtype="int")
-#     # Divides episodes among different sub environments in the vector as evenly as possible
-#     episode_count_targets = np.array([(num_episodes + i) // N for i in range(N)], dtype="int")
-
-#     env = SubprocVecEnv([make_env(env, i) for i in range(N)])
-#     episode_return, episode_length, success = np.zeros(N), np.zeros(N), np.zeros(N)
-
-#     states_list, actions_list, timesteps_list = [], [], []
-#     images = []
-#     method = model.method
-
-#     horizon = model.horizon
-#     if method != 'vanilla':
-#         option_dim = model.option_selector.option_dim
-#     else:
-#         option_dim = None
-
-#     if render and kwargs["i"] % kwargs["render_freq"] == 0:
-#         observation = env.reset(
-#             render=True, render_path=kwargs["render_path"],
-#             iter_num=kwargs["iter_num"],
-#             i=kwargs["i"])
-#         cur_states, langs = observation["state"], observation["lang"]
-#         images.append(env.env_method('get_image'))
-#     else:
-#         observation = env.reset(render=False)
-#         cur_states, langs = observation["state"], observation["lang"]
-
-#     state_dim = env.get_attr('state_dim', indices=0)[0]
-#     act_dim = env.get_attr('act_dim', indices=0)[0]
-
-#     if isinstance(state_dim, tuple):
-#         cur_states = torch.from_numpy(cur_states).to(device=device, dtype=torch.float32).reshape(-1, *state_dim)
-#     else:
-#         cur_states = torch.from_numpy(cur_states).to(device=device, dtype=torch.float32).reshape(-1, state_dim)
-
-#     states_list = [cur_states[i].reshape(1, state_dim) for i in range(N)]
-#     actions_list = [torch.zeros((0, act_dim), device=device, dtype=torch.float32) for i in range(N)]
-#     if method != 'vanilla':
-#         options_list = [torch.zeros((0, option_dim), device=device, dtype=torch.float32) for i in range(N)]
-#     else:
-#         options_list = None
-#     timesteps_list = [torch.tensor(0, device=device, dtype=torch.long).reshape(1, 1) for i in range(N)]
-
-#     # we keep all the histories on the device
-#     # note that the latest action and reward will be "padding"
-#     lm_input = tokenizer(text=langs, add_special_tokens=True, return_tensors='pt', padding=True).to(device=device)
-
-#     with torch.no_grad():
-#         lm_embeddings = model.lm(
-#             lm_input['input_ids'], lm_input['attention_mask']).last_hidden_state
-#         cls_embeddings = lm_embeddings[:, 0, :]
-#         # word_embeddings = lm_embeddings[:, 1:-1, :]      # skip the CLS and SEP tokens.
-#         word_embeddings = lm_embeddings[:, 1:, :]      # skip the CLS tokens
-
-#     option = None
-#     t = 0
-
-#     while (episode_counts < episode_count_targets).any():
-#         cur_actions = get_action_parallel(
-#             model, states_list, actions_list, options_list, timesteps_list, cls_embeddings, word_embeddings,
-#             options_list, cur_states, option, t, horizon, K, method, state_dim, act_dim, option_dim, device)
-#         if model.discrete:
-#             cur_actions = torch.nn.functional.one_hot(cur_actions, num_classes=act_dim)
-#         else:
-#             cur_actions = torch.clamp(cur_actions, torch.from_numpy(env.action_space.low).to(
-#                 device), torch.from_numpy(env.action_space.high).to(device))
-#         cur_actions = cur_actions.detach().cpu().numpy()
-
-#         assert cur_actions in env.action_space, f"Transformer predicted action: {cur_actions} outside env action space {env.action_space}"
-
-#         obs, rewards, dones, _ = env.step(cur_actions)
-
-#         episode_return += rewards
-#         episode_length += 1
-
-#         # process state
-#         cur_states = obs["state"]
-#         if isinstance(state_dim, tuple):
-#             cur_states = torch.from_numpy(cur_states).to(device=device, dtype=torch.float32).reshape(-1, *state_dim)
-#         else:
-#             cur_states = torch.from_numpy(cur_states).to(device=device, dtype=torch.float32).reshape(-1, state_dim)
-
-#         for i in range(N):
-#             if episode_counts[i] < episode_count_targets[i]:
-#                 # terminate if done or reached env max_episode_length timesteps
-#                 if dones[i] or states_list[i].shape[0] > max_ep_len:
-#                     if episode_return[i] > 0:
-#                         success[i] += 1
-
-#                     returns.append(episode_return[i])
-#                     lengths.append(episode_length[i])
-#                     success_list.append(success[i])
-
-#                     episode_return[i] = 0
-#                     episode_length[i] = 0
-#                     success[i] = 0
-#                     # clear episode from list
-#                     # TODO: THIS IS WRONG -- NEED TO CHANGE THE ENV TO RESET WHEN DONE BUT THIS IS A LITTLE UGLY
-#                     states_list[i] = cur_states[i].reshape(1, state_dim)  # Use the new reset state
-#                     actions_list[i] = torch.zeros((0, act_dim), device=device, dtype=torch.float32)
-#                     # Set initial timestep 0
-#                     timesteps_list[i] = torch.tensor(0, device=device, dtype=torch.long).reshape(1, 1)
-
-#                     # Only increment at the real end of an episode
-#                     episode_counts[i] += 1
-
-#         if render:
-#             images.append(Image.fromarray(env.render(), 'RGB'))
-
-#         states_list = [
-#             torch.cat([states_list[i], cur_states[i].reshape(1, state_dim)], dim=0) for i in range(N)]
-#         actions_list = [
-#             torch.cat([actions_list[i], cur_actions[i].reshape(1, act_dim)], dim=0) for i in range(N)]
-#         timesteps_list = [
-#             torch.cat([timesteps_list[i], timesteps_list[i][-1].reshape(1, 1) + 1], dim=0) for i in range(N)]
+def history_window(model, max_ep_len):
+    """Number of most recent steps of the episode history the model looks at"""
+    if model.method == 'vanilla':
+        max_lengths = [model.decision_transformer.max_length]
+    else:
+        max_lengths = [model.diffuser.max_length]
+        if model.method == 'traj_option':
+            max_lengths.append(model.option_selector.option_dt.max_length)
+    if None in max_lengths:
+        return max_ep_len + 1
+    return max(max_lengths)
+
+
+def state_history(model, window, state_shape, device):
+    """History of the episode states, traj_option models also keep the embedding of every state as it arrives"""
+    if model.method == 'traj_option':
+        return StateHistoryBuffer(window, state_shape, model.option_selector.option_dt.embed_state, device=device)
+    return HistoryBuffer(window, state_shape, device=device)
 
 
 def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, render, device, ema_diffusion_model, **kwargs):
-    """Evaluate a single episode."""
+    """Evaluate a single episode.
+
+    Rendered frames are streamed to `kwargs["sink"]` (a VideoSink) when it is given,
+    otherwise they are collected and returned in `images`.
+    """
     images = []
+    sink = kwargs.get("sink")
+    add_image = sink.add if sink is not None else images.append
     method = model.method
 
     horizon = model.horizon
@@ -194,7 +98,7 @@ def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, rend
             iter_num=kwargs["iter_num"],
             i=kwargs["i"])
         cur_state, lang = observation['state'], observation['lang']
-        images.append(env.get_image())
+        add_image(env.get_image())
     else:
         observation = env.reset(render=False)
         cur_state, lang = observation["state"], observation["lang"]
@@ -216,15 +120,22 @@ def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, rend
         # word_embeddings = lm_embeddings[:, 1:-1, :]      # skip the CLS and SEP tokens. here there's no padding so this is actually the CLS and SEP
         word_embeddings = lm_embeddings[:, 1:, :]      # skip the CLS tokens
 
-    if isinstance(state_dim, tuple):
-        states = cur_state.reshape(1, *state_dim).to(device=device, dtype=torch.float32)
-    else:
-        states = cur_state.reshape(1, state_dim).to(device=device, dtype=torch.float32)
-
-    actions = torch.zeros((0, act_dim), device=device, dtype=torch.float32)
-    timesteps = torch.tensor(0, device=device, dtype=torch.long).reshape(1, 1)
+    # fixed size histories, the model only looks at their last window steps
+    state_shape = state_dim if isinstance(state_dim, tuple) else (state_dim,)
+    window = history_window(model, max_ep_len)
+    states = state_history(model, window, state_shape, device)
+    states.append(cur_state.reshape(state_shape))
+    actions = HistoryBuffer(window, (act_dim,), device=device)
+    timesteps = HistoryBuffer(window, dtype=torch.long, device=device)
+    timesteps.append(0)
+    options = None
     if method != 'vanilla':
-        options = torch.zeros((0, option_dim), device=device, dtype=torch.float32)
+        options = HistoryBuffer(window, (option_dim,), device=device)
+    option_cache = None
+    if method == 'traj_option':
+        # language tokens and states go through the option transformer once per episode
+        option_cache = OptionTransformerCache(model.option_selector.option_dt, word_embeddings)
+        option_cache.append(states.embeddings[-1], timesteps[-1])
 
     episode_return, episode_length, success = 0, 0, 0
     options_list = []
@@ -234,17 +145,16 @@ def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, rend
 
     for t in range(max_ep_len):
         # add dummy action
-        actions = torch.cat([actions, torch.zeros((1, act_dim), device=device)], dim=0)
+        actions.append(0)
         if method != 'vanilla':
-            options = torch.cat([options, torch.zeros((1, option_dim), device=device)], dim=0)
-        else:
-            options = None
+            options.append(0)
 
         if action_hist is None:
 
             action_hist, option, states, actions, timesteps, options = get_action(
                 model, states, actions, options, timesteps, cls_embeddings, word_embeddings, options_list, cur_state,
-                option, t, horizon, K, method, state_dim, act_dim, option_dim, device, ema_diffusion_model, **kwargs)
+                option, t, horizon, K, method, state_dim, act_dim, option_dim, device, ema_diffusion_model,
+                option_cache=option_cache, **kwargs)
 
             action = action_hist[0]
             action_hist = action_hist[1:] if action_hist.shape[0] > 1 else None
@@ -265,20 +175,18 @@ def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, rend
 
         obs, reward, done, info = env.step(action)
         if render and kwargs["i"] % kwargs["render_freq"] == 0:
-            images.append(env.get_image())
+            add_image(env.get_image())
 
         state, lang = obs['state'], obs['lang']
         if no_lang:
             lang = ''
 
-        if isinstance(state_dim, tuple):
-            cur_state = torch.from_numpy(state).to(device=device).reshape(1, *state_dim)
-        else:
-            cur_state = torch.from_numpy(state).to(device=device).reshape(1, state_dim)
-        states = torch.cat([states, cur_state], dim=0).float()
-        timesteps = torch.cat(
-            [timesteps,
-                torch.ones((1, 1), device=device, dtype=torch.long) * (t + 1)], dim=1)
+        cur_state = torch.from_numpy(state).to(device=device).reshape(state_shape)
+        states.append(cur_state)
+        timesteps.append(t + 1)
+        # no option is chosen after the last step, whose timestep (max_ep_len) is past the timestep embeddings
+        if option_cache is not None and not done and t + 1 < max_ep_len:
+            option_cache.append(states.embeddings[-1], timesteps[-1])
 
         episode_return += reward
         episode_length += 1
@@ -298,15 +206,15 @@ def eval_episode(env, no_lang, tokenizer, model, max_ep_len, K, words_dict, rend
 
 def get_action(
         model, states, actions, options, timesteps, cls_embeddings, word_embeddings, options_list, cur_state, option, t,
-        horizon, K, method, state_dim, act_dim, option_dim, device, ema_diffusion_model, **kwargs):
+        horizon, K, method, state_dim, act_dim, option_dim, device, ema_diffusion_model, option_cache=None, **kwargs):
     """
         Compute action for model evaluation
     """
     if method == 'vanilla':
         action = model.get_action(
-            states.to(dtype=torch.float32),
-            actions.to(dtype=torch.float32),
-            timesteps.to(dtype=torch.long),
+            states.steps(),
+            actions.steps(),
+            timesteps.steps(),
             word_embeddings=word_embeddings.to(dtype=torch.float32)
         )
         return action, None, states, actions, timesteps, None
@@ -319,40 +227,248 @@ def get_action(
                 #     cls_embeddings, states[-1].reshape(1, 1, -1), **kwargs)
                 option, option_index = model.option_selector.get_option(
                     word_embeddings.mean(1, keepdim=True), states[-1].reshape(1, 1, -1), **kwargs)
+            elif option_cache is not None:
+                # only the states appended since the last option go through the option transformer
+                option, option_index = model.option_selector.get_cached_option(option_cache, **kwargs)
             else:
-                option, option_index = model.option_selector.get_option(word_embeddings, states.to(dtype=torch.float32), timesteps.to(dtype=torch.long), **kwargs)
+                # the padded window and its mask are views of the histories, get_option does not copy them
+                max_length = model.option_selector.option_dt.max_length
+                option, option_index = model.option_selector.get_option(
+                    word_embeddings, states.last(max_length), timesteps.last(max_length),
+                    attention_mask=states.attention_mask(max_length),
+                    state_embeddings=states.embeddings.last(max_length), **kwargs)
             options_list.append(option_index.cpu().item())
 
         if t % (K - 1) == 0:
             # Reset state, actions, options and timesteps after every K steps
-            actions = torch.zeros((1, act_dim), device=device, dtype=torch.float32)
-            options = torch.zeros((1, option_dim), device=device, dtype=torch.float32)
-
-            if isinstance(state_dim, tuple):
-                states = cur_state.reshape(1, *state_dim).to(device=device, dtype=torch.float32)
-            else:
-                states = cur_state.reshape(1, state_dim).to(device=device, dtype=torch.float32)
-            timesteps = torch.ones((1, 1), device=device, dtype=torch.long) * (t + 1)
+            actions.reset(0)
+            options.reset(0)
+            states.restart()
+            timesteps.reset(t + 1)
+            if option_cache is not None:
+                option_cache.reset(states.embeddings[-1], timesteps[-1])
 
         options[-1] = option
 
         # TODO
+        max_length = model.diffuser.max_length
         with torch.no_grad():
             action = model.get_action(
-                states.to(dtype=torch.float32),
-                actions.to(dtype=torch.float32),
-                timesteps.to(dtype=torch.long),
-                options=options.to(dtype=torch.float32),
+                states.last(max_length),
+                actions.last(max_length),
+                timesteps.last(max_length),
+                options=options.last(max_length),
                 ema_diffusion_model=ema_diffusion_model,
+                state_embeddings=states.embeddings.last(max_length) if method == 'traj_option' else None,
             )
 
         return action, option, states, actions, timesteps, options
 
 
-# def get_action_parallel(
-#         model, states, actions, options, timesteps, cls_embeddings, word_embeddings, options_list, cur_state, option, t,
-#         horizon, K, method, state_dim, act_dim, option_dim, device):
-#     pass
+class _Episode:
+    """Histories and bookkeeping of one episode of parallel_eval_episodes"""
+
+    def __init__(self, task, observation, state_dim, act_dim, action_space, no_lang, tokenizer, model, max_ep_len,
+                 device):
+        self.task = task
+        self.state_dim, self.act_dim, self.action_space = state_dim, act_dim, action_space
+        self.lang = '' if no_lang else observation['lang']
+
+        self.lm_input = tokenizer(text=[self.lang], add_special_tokens=True,
+                                  return_tensors='pt', padding=True).to(device=device)
+        lm_embeddings = model.lm(self.lm_input['input_ids'], self.lm_input['attention_mask']).last_hidden_state
+        self.word_embeddings = lm_embeddings[:, 1:, :]      # skip the CLS tokens
+
+        self.state_shape = state_dim if isinstance(state_dim, tuple) else (state_dim,)
+        window = history_window(model, max_ep_len)
+        self.states = state_history(model, window, self.state_shape, device)
+        self.states.append(self.to_state(observation['state'], device))
+        self.actions = HistoryBuffer(window, (act_dim,), device=device)
+        self.timesteps = HistoryBuffer(window, dtype=torch.long, device=device)
+        self.timesteps.append(0)
+        self.options = None
+        if model.method != 'vanilla':
+            self.options = HistoryBuffer(window, (model.option_selector.option_dim,), device=device)
+
+        self.t = 0
+        self.option = None
+        self.action_hist = None
+        self.options_list = []
+        self.episode_return, self.episode_length, self.success = 0, 0, 0
+
+    def to_state(self, state, device):
+        return torch.from_numpy(state).to(device=device, dtype=torch.float32).reshape(self.state_shape)
+
+
+def stack_histories(histories, max_length):
+    """Stack the last max_length steps (zero padded in front) of HistoryBuffers.
+    Returns the [B, max_length, ...] batch and its attention mask
+    """
+    attention_mask = torch.stack([h.attention_mask(max_length) for h in histories])
+    return torch.stack([h.last(max_length) for h in histories]), attention_mask
+
+
+def select_options(model, episodes, **kwargs):
+    """Options for all episodes that need a new one, with one call to the option selector"""
+    if 'constant_option' in kwargs:
+        return [model.option_selector.get_option(None, None, **kwargs) for _ in episodes]
+
+    if model.method == 'option':
+        word_embeddings = torch.cat([ep.word_embeddings.mean(1, keepdim=True) for ep in episodes], dim=0)
+        states = torch.cat([ep.states[-1].reshape(1, 1, -1) for ep in episodes], dim=0)
+        options, indices = model.option_selector.get_options(word_embeddings, states, **kwargs)
+    else:
+        max_length = model.option_selector.option_dt.max_length
+        states, attention_mask = stack_histories([ep.states for ep in episodes], max_length)
+        timesteps, _ = stack_histories([ep.timesteps for ep in episodes], max_length)
+        state_embeddings, _ = stack_histories([ep.states.embeddings for ep in episodes], max_length)
+
+        # instructions have different numbers of tokens, pad them at the end and mask them out
+        num_tokens = max(ep.word_embeddings.shape[1] for ep in episodes)
+        word_embeddings = torch.cat([pad(ep.word_embeddings, num_tokens, mode='post') for ep in episodes], dim=0)
+        lang_attention_mask = torch.stack([
+            pad(torch.ones(ep.word_embeddings.shape[1], dtype=torch.long, device=states.device), num_tokens,
+                axis=0, mode='post') for ep in episodes])
+
+        options, indices = model.option_selector.get_options(
+            word_embeddings, states.to(dtype=torch.float32), timesteps.to(dtype=torch.long),
+            attention_mask=attention_mask, lang_attention_mask=lang_attention_mask,
+            state_embeddings=state_embeddings, **kwargs)
+    return list(zip(options, indices))
+
+
+def plan_actions(model, episodes, horizon, K, device, ema_diffusion_model, **kwargs):
+    """Same as get_action for every episode that ran out of planned actions,
+    with batched option selection, diffusion sampling and inverse dynamics
+    """
+    if model.method == 'vanilla':
+        for ep in episodes:
+            ep.action_hist = model.get_action(
+                ep.states.steps(),
+                ep.actions.steps(),
+                ep.timesteps.steps(),
+                word_embeddings=ep.word_embeddings.to(dtype=torch.float32))
+        return
+
+    # Choose a new option after every horizon steps
+    choosing = [ep for ep in episodes if ep.t % (horizon - 1) == 0]
+    if choosing:
+        for ep, (option, option_index) in zip(choosing, select_options(model, choosing, **kwargs)):
+            ep.option = option
+            ep.options_list.append(option_index.cpu().item())
+
+    for ep in episodes:
+        if ep.t % (K - 1) == 0:
+            # Reset state, actions, options and timesteps after every K steps
+            ep.actions.reset(0)
+            ep.options.reset(0)
+            ep.states.restart()
+            ep.timesteps.reset(ep.t + 1)
+        ep.options[-1] = ep.option
+
+    max_length = model.diffuser.max_length
+    states, _ = stack_histories([ep.states for ep in episodes], max_length)
+    actions, _ = stack_histories([ep.actions for ep in episodes], max_length)
+    options, _ = stack_histories([ep.options for ep in episodes], max_length)
+    timesteps, _ = stack_histories([ep.timesteps for ep in episodes], max_length)
+    state_embeddings = None
+    if model.method == 'traj_option':
+        state_embeddings, _ = stack_histories([ep.states.embeddings for ep in episodes], max_length)
+
+    action_hists = model.get_actions(
+        states.to(dtype=torch.float32), actions.to(dtype=torch.float32), timesteps.to(dtype=torch.long),
+        options.to(dtype=torch.float32), ema_diffusion_model, state_embeddings=state_embeddings)
+    for ep, action_hist in zip(episodes, action_hists):
+        ep.action_hist = action_hist
+
+
+@torch.no_grad()
+def parallel_eval_episodes(envs, tasks, no_lang, tokenizer, model, max_ep_len, K, words_dict, device,
+                           ema_diffusion_model, **kwargs):
+    """
+        Evaluate one episode per task across the worker envs of a SubprocEnvs (without rendering).
+
+        `tasks` holds the wrapper kwargs of every episode (e.g. the LOReL instruction), a worker env starts
+        the next task as soon as its episode ends. At every step the option selector, the diffusion planner
+        and the inverse dynamics are called once for all the envs that need a new option or plan.
+        Returns (episode_return, episode_length, success, options_list, lang) of every task, in order.
+    """
+    horizon = model.horizon
+    results = [None] * len(tasks)
+    next_task = 0
+    episodes = {}
+
+    def start(env_ids):
+        nonlocal next_task
+        env_ids = env_ids[:len(tasks) - next_task]
+        task_ids = list(range(next_task, next_task + len(env_ids)))
+        next_task += len(env_ids)
+        resets = envs.reset(env_ids, [tasks[task] for task in task_ids])
+        for i, task, (observation, state_dim, act_dim, action_space) in zip(env_ids, task_ids, resets):
+            episodes[i] = _Episode(task, observation, state_dim, act_dim, action_space,
+                                   no_lang, tokenizer, model, max_ep_len, device)
+
+    def finish(i):
+        ep = episodes.pop(i)
+        if model.method != 'vanilla' and model.option_selector.use_vq:
+            tokens = get_tokens(ep.lm_input, tokenizer)
+            for o in ep.options_list:
+                for w in tokens:
+                    words_dict[o].append(w)
+        results[ep.task] = (ep.episode_return, ep.episode_length, ep.success, ep.options_list, ep.lang)
+
+    start(list(range(len(envs))))
+    while episodes:
+        # add dummy action
+        for ep in episodes.values():
+            ep.actions.append(0)
+            if ep.options is not None:
+                ep.options.append(0)
+
+        deciding = [ep for ep in episodes.values() if ep.action_hist is None]
+        if deciding:
+            plan_actions(model, deciding, horizon, K, device, ema_diffusion_model, **kwargs)
+
+        env_ids, env_actions = [], []
+        for i, ep in episodes.items():
+            action = ep.action_hist[0]
+            ep.action_hist = ep.action_hist[1:] if ep.action_hist.shape[0] > 1 else None
+
+            if model.diffuser.discrete:
+                ep.actions[-1] = torch.nn.functional.one_hot(action, num_classes=ep.act_dim)
+            else:
+                action = torch.clamp(action, torch.from_numpy(ep.action_space.low).to(device),
+                                     torch.from_numpy(ep.action_space.high).to(device))
+                ep.actions[-1] = action
+
+            action = action.detach().cpu().numpy()
+            assert action in ep.action_space, "Transformer predicted action outside env action space"
+            env_ids.append(i)
+            env_actions.append(action)
+
+        finished = []
+        for i, (obs, reward, done, info) in zip(env_ids, envs.step(env_ids, env_actions)):
+            ep = episodes[i]
+            if not no_lang:
+                ep.lang = obs['lang']
+            ep.states.append(ep.to_state(obs['state'], device))
+            ep.timesteps.append(ep.t + 1)
+            ep.t += 1
+
+            ep.episode_return += reward
+            ep.episode_length += 1
+
+            if done:
+                ep.success = info.get('success', -1)
+            if done or ep.t == max_ep_len:
+                finished.append(i)
+
+        for i in finished:
+            finish(i)
+        if finished and next_task < len(tasks):
+            start(finished)
+
+    return results
 
 
 # if __name__ == '__main__':
@@ -0,0 +1,311 @@
+"""
+Evaluation of the checkpoints of a training run, away from the training process.
+
+Watches the directory the training run saves its checkpoints to (Trainer.save, `model_<iter>.ckpt` in savepath)
+and evaluates every new checkpoint with Trainer.evaluate in a pool of local worker processes, e.g. next to a
+run started with trainer.inline_eval=False:
+
+    python eval_farm.py farm.watch_dir=checkpoints/<run> farm.n_workers=2 trainer.num_eval_episodes=20
+
+The model is built from the config saved with the checkpoint, the evaluation settings (num_eval_episodes,
+n_eval_envs, adaptive_eval, ...) come from the trainer section of this config. The results are appended to
+`farm.results` (json lines), keyed by the sha256 of the checkpoint file and the evaluation settings, so a
+checkpoint already in the results is not evaluated again, under any name or after a restart of the farm.
+Checkpoints of env.eval_offline runs are evaluated as in their training run, without env, on the held-out
+trajectories of the val_dataset of their config (offline_eval.offline_evaluate).
+The DiffTrainer `state_<step>.pt` files only hold the diffuser, they cannot be evaluated on their own.
+"""
+import ast
+import glob
+import hashlib
+import json
+import numbers
+import os
+import queue
+import random
+import time
+import traceback
+from types import SimpleNamespace
+
+import hydra
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import wandb
+from omegaconf import DictConfig, OmegaConf, open_dict
+from transformers import DistilBertTokenizer
+
+from env import make_env
+from expert_dataset import ExpertDataset
+from main_hot import build_model, get_args
+from trainer import Trainer
+from vec_env import DatasetStats
+
+# the settings of the evaluation, taken from the farm config instead of the checkpoint config
+EVAL_KEYS = ('num_eval_episodes', 'n_eval_envs', 'lorl_reset_pool', 'offline_eval_workers', 'adaptive_eval',
+             'min_eval_episodes', 'eval_ci_width', 'eval_ci', 'eval_budget')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def eval_config(cfg):
+    return {k: cfg.trainer[k] for k in EVAL_KEYS if k in cfg.trainer}
+
+
+class ResultsStore:
+    """
+    Append-only json lines file of evaluation records, one per (checkpoint_hash, eval_config).
+    Records are only ever appended, a line left incomplete by a crash is skipped when the store is read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.keys = set()
+        if os.path.exists(path):
+            with open(path) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.keys.add(self.key(record['checkpoint_hash'], record['eval_config']))
+
+    @staticmethod
+    def key(checkpoint_hash, config):
+        return checkpoint_hash, json.dumps(config, sort_keys=True)
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def append(self, record):
+        with open(self.path, 'a') as fp:
+            fp.write(json.dumps(record) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        self.keys.add(self.key(record['checkpoint_hash'], record['eval_config']))
+
+
+class CheckpointWatcher:
+    """New checkpoints of a directory, a file is only returned once its size and mtime are the same in two scans"""
+
+    def __init__(self, watch_dir, pattern):
+        self.pattern = os.path.join(watch_dir, pattern)
+        self.last_scan = {}  # path -> (size, mtime) at the previous scan
+        self.returned = {}  # path -> (size, mtime) when it was returned
+
+    def scan(self):
+        """Returns (new checkpoints, oldest first), and whether some files are still being written"""
+        new, pending = [], False
+        for path in sorted(glob.glob(self.pattern), key=os.path.getmtime):
+            stat = os.stat(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+            if self.returned.get(path) == version:
+                continue
+            if self.last_scan.get(path) != version:
+                self.last_scan[path] = version
+                pending = True
+                continue
+            self.returned[path] = version
+            new.append(path)
+        return new, pending
+
+
+def worker_devices(device, n_workers):
+    if torch.device(device).type == 'cuda' and torch.cuda.device_count() > 1:
+        return [f'cuda:{i % torch.cuda.device_count()}' for i in range(n_workers)]
+    return [device] * n_workers
+
+
+def load_dataset(args, dataset_args):
+    """ExpertDataset of the train_dataset or val_dataset section of a checkpoint config, as main_hot builds it"""
+    dataset_args = dict(dataset_args)
+    if 'BabyAI' in args.env.name:
+        return ExpertDataset(**dataset_args, use_direction=args.env.use_direction)
+    elif 'Lorl' in args.env.name:
+        return ExpertDataset(**dataset_args, use_state=args.env.use_state)
+    raise NotImplementedError
+
+
+def load_dataset_stats(args):
+    """DatasetStats of a checkpoint saved without them, from the training dataset"""
+    return DatasetStats(load_dataset(args, args.train_dataset))
+
+
+def dataset_key(dataset_args):
+    return json.dumps(OmegaConf.to_container(dataset_args, resolve=True), sort_keys=True)
+
+
+class EvalWorker:
+    """State of an eval worker process kept between checkpoints: envs, env worker processes, reset pools and
+    the datasets of the offline evaluations"""
+
+    def __init__(self, cfg, device):
+        self.cfg = cfg
+        self.device = device
+        self.tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+        self.envs, self.eval_envs, self.reset_pools, self.dataset_stats, self.val_datasets = {}, {}, {}, {}, {}
+
+    def evaluate(self, path):
+        checkpoint = torch.load(path, map_location=self.device)
+        args = checkpoint['config']
+        # checkpoints saved before some of the eval settings existed do not have them in their (struct) config
+        with open_dict(args.trainer):
+            for k, v in eval_config(self.cfg).items():
+                args.trainer[k] = v
+        args.trainer.device = self.device
+        args.method = args.model.name
+
+        state_dim = args.env.state_dim
+        if isinstance(state_dim, str):
+            state_dim = ast.literal_eval(state_dim)
+        if 'BabyAI' in args.env.name:
+            state_dim += 4 * args.env.use_direction
+        model = build_model(args, state_dim, args.env.action_dim, checkpoint['train_dataset_max_length'], self.device)
+        model.load_state_dict(checkpoint['model'])
+        model = model.to(device=self.device)
+        model.eval()
+
+        stats = checkpoint.get('dataset_stats')
+        if stats is None:
+            key = dataset_key(args.train_dataset)
+            if key not in self.dataset_stats:
+                self.dataset_stats[key] = load_dataset_stats(args)
+            stats = self.dataset_stats[key]
+
+        env_name = args.env.name
+        offline = args.env.get('eval_offline', False)
+        if offline:
+            # Trainer.evaluate without env runs the offline evaluation over the val_loader dataset
+            key = dataset_key(args.val_dataset)
+            if key not in self.val_datasets:
+                self.val_datasets[key] = load_dataset(args, args.val_dataset)
+            trainer = Trainer(args, model, self.tokenizer, None, SimpleNamespace(dataset=stats),
+                              val_loader=SimpleNamespace(dataset=self.val_datasets[key], batch_size=args.batch_size),
+                              skip_words=args.env.skip_words, **dict(args.trainer))
+        else:
+            if env_name not in self.envs:
+                self.envs[env_name] = make_env(env_name)
+                self.envs[env_name].seed(args.seed)
+                self.eval_envs[env_name] = {}
+            trainer = Trainer(args, model, self.tokenizer, None, SimpleNamespace(dataset=stats),
+                              env=self.envs[env_name], env_name=env_name, skip_words=args.env.skip_words,
+                              **dict(args.trainer))
+            # the env worker processes and the reset pool are shared by the evaluations of the same env
+            trainer.eval_envs = self.eval_envs[env_name]
+            trainer.reset_pool = self.reset_pools.get(env_name)
+
+        start = time.time()
+        metrics = trainer.evaluate(checkpoint['iter_num'], render=False)
+        if not offline:
+            self.reset_pools[env_name] = trainer.reset_pool
+        return {'iter_num': checkpoint['iter_num'],
+                'env': env_name,
+                'method': args.method,
+                'eval_time': time.time() - start,
+                # plots are left out of the store
+                'metrics': {k: v.item() if isinstance(v, np.generic) else v
+                            for k, v in metrics.items() if isinstance(v, numbers.Number)}}
+
+    def close(self):
+        for eval_envs in self.eval_envs.values():
+            for envs in eval_envs.values():
+                envs.close()
+        for env in self.envs.values():
+            env.close()
+
+
+def _eval_worker(cfg, device, num_threads, tasks, results):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    random.seed(cfg.seed)
+    np.random.seed(cfg.seed)
+    torch.manual_seed(cfg.seed)
+    # Trainer.evaluate logs its plots to wandb, they are not kept by the farm
+    wandb.init(mode='disabled')
+    worker = EvalWorker(cfg, device)
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            path, checkpoint_hash = task
+            try:
+                results.put((path, checkpoint_hash, worker.evaluate(path), None))
+            except Exception:
+                results.put((path, checkpoint_hash, None, traceback.format_exc()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.close()
+
+
+def watch(cfg, context='spawn'):
+    """Evaluate the new checkpoints of cfg.farm.watch_dir until interrupted (or until done, with farm.once)"""
+    farm = cfg.farm
+    watch_dir = hydra.utils.to_absolute_path(farm.watch_dir)
+    store = ResultsStore(os.path.join(watch_dir, farm.results))
+    config = eval_config(cfg)
+    watcher = CheckpointWatcher(watch_dir, farm.pattern)
+
+    ctx = mp.get_context(context)
+    tasks, results = ctx.Queue(), ctx.Queue()
+    devices = worker_devices(cfg.trainer.device, farm.n_workers)
+    num_threads = max(torch.get_num_threads() // farm.n_workers, 1) if devices[0] == 'cpu' else None
+    workers = [ctx.Process(target=_eval_worker, args=(cfg, device, num_threads, tasks, results))
+               for device in devices]
+    for process in workers:
+        process.start()
+
+    running = set()  # store keys of the checkpoints given to the workers
+    try:
+        while True:
+            new, writing = watcher.scan()
+            for path in new:
+                checkpoint_hash = file_hash(path)
+                key = store.key(checkpoint_hash, config)
+                if key in store or key in running:
+                    print(f'Skipping {path}, already evaluated ({checkpoint_hash[:12]})')
+                    continue
+                running.add(key)
+                tasks.put((path, checkpoint_hash))
+
+            while running:
+                timeout = None if farm.once and not writing else farm.poll_interval
+                try:
+                    path, checkpoint_hash, record, error = results.get(timeout=timeout)
+                except queue.Empty:  # back to scanning
+                    break
+                running.discard(store.key(checkpoint_hash, config))
+                if error is not None:
+                    print(f'Evaluation of {path} failed:\n{error}')
+                    continue
+                store.append({'checkpoint_hash': checkpoint_hash, 'checkpoint': os.path.relpath(path, watch_dir),
+                              'eval_config': config, 'finished': time.strftime('%Y-%m-%d %H:%M:%S'), **record})
+                print(f"{path}: {record['metrics']}")
+
+            if farm.once and not writing and not running and not new:
+                break
+            if not running:
+                time.sleep(farm.poll_interval)
+    finally:
+        for _ in workers:
+            tasks.put(None)
+        for process in workers:
+            process.join()
+
+
+@hydra.main(config_path="conf", config_name="config", version_base="1.1")
+def main(cfg: DictConfig):
+    args = get_args(cfg)
+    print(OmegaConf.to_yaml(args.farm))
+    watch(args)
+
+
+if __name__ == "__main__":
+    main()
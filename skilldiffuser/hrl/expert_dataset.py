@@ -7,10 +7,64 @@ import torch
 from torchvision import transforms
 from torch.utils.data import Dataset
 import os
+import hashlib
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from utils import pad, calculate_state_means_stds
 from tqdm import tqdm
 
 
+class TrajectoryView:
+    """Sequence of trajectories that indexes into shared storage without copying it.
+
+    Item i is `storage[index[i]][::stride]`, which is a view when the storage is a numpy
+    (or memory-mapped) array. Selecting, permuting and subsampling only compose the index
+    and stride, so the underlying data is never duplicated.
+    """
+
+    def __init__(self, storage, index=None, stride: int = 1):
+        if isinstance(storage, TrajectoryView):
+            index = storage.index if index is None else storage.index[np.asarray(index)]
+            stride = storage.stride * stride
+            storage = storage.storage
+        self.storage = storage
+        self.index = np.arange(len(storage)) if index is None else np.asarray(index)
+        self.stride = stride
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, i):
+        traj = self.storage[self.index[i]]
+        if self.stride != 1:
+            traj = traj[::self.stride]
+        return traj
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, index) -> 'TrajectoryView':
+        """Return a view over the trajectories at `index` (relative to this view)"""
+        return TrajectoryView(self, index)
+
+
+class RaggedTrajectories:
+    """Trajectories stored back to back in one flat array, item i is the view flat[offsets[i]:offsets[i+1]]"""
+
+    def __init__(self, flat, offsets):
+        self.flat = flat
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.flat[self.offsets[i]:self.offsets[i + 1]]
+
+
 class ExpertDataset(Dataset):
     """Dataset for expert trajectories.
     Assumes expert dataset is a dict with keys {states, actions, rewards, lengths} with values
@@ -32,6 +86,8 @@ class ExpertDataset(Dataset):
                  full_traj: bool = True,
                  normalize_states: bool = True,
                  no_lang=False,
+                 cache_stats: bool = False,
+                 stats_workers: int = 0,
                  **kwargs):
         """Subsamples an expert dataset from saved expert trajectories.
         Args:
@@ -40,6 +96,9 @@ class ExpertDataset(Dataset):
             subsample_frequency:      Subsamples each trajectory at specified frequency of steps.
             seed:                     Seed for sampling trajectories.
             full_traj:                If True, each item will be a full trajectory and not just a (s,s',a,r,d) tuple
+            cache_stats:              If True, state normalization statistics are cached in an .npz next to the
+                                      dataset, whose directory then has to be writable.
+            stats_workers:            Number of threads used to compute state normalization statistics.
         """
         all_trajectories = load_trajectories(expert_location, num_trajectories, seed, **kwargs)
         self.kwargs = kwargs
@@ -66,8 +125,13 @@ class ExpertDataset(Dataset):
             self.normalize_state_dim = np.array(all_trajectories["states"][0]).shape[1:]
 
         if normalize_states:
+            cache_path = None
+            if cache_stats:
+                cache_path = stats_cache_path(expert_location, num_trajectories, seed, self.normalize_state_dim,
+                                              **kwargs)
             self.state_mean, self.state_std = calculate_state_means_stds(
-                all_trajectories["states"], self.normalize_state_dim)
+                all_trajectories["states"], self.normalize_state_dim, num_workers=stats_workers,
+                cache_path=cache_path)
         else:
             self.state_mean, self.state_std = np.zeros(self.normalize_state_dim), np.ones(self.normalize_state_dim)
 
@@ -75,17 +139,15 @@ class ExpertDataset(Dataset):
         # start_idx = torch.randint(0, subsample_frequency, size=(num_trajectories,)).long()
 
         # Subsample expert trajectories with every `subsample_frequency` step.
+        # Trajectories stay views into the loaded storage, only the stride changes.
         for k, v in all_trajectories.items():
-            data = v
-
-            if k != "lengths":
-                samples = []
-                for i in range(num_trajectories):
-                    samples.append(data[i][0::subsample_frequency])
-                self.trajectories[k] = samples
-            else:
+            if k == "lengths":
                 # Adjust the length of trajectory after subsampling
-                self.trajectories[k] = np.array(data) // subsample_frequency
+                self.trajectories[k] = np.asarray(v) // subsample_frequency
+            elif k == "language":
+                self.trajectories[k] = v
+            else:
+                self.trajectories[k] = TrajectoryView(v, stride=subsample_frequency)
 
         if not full_traj:
             self.length = self.trajectories["lengths"].sum().item()
@@ -99,17 +161,13 @@ class ExpertDataset(Dataset):
 
         # Convert flattened index i to trajectory indx and offset within trajectory
         if not self.full_traj:
-            traj_idx = 0
-            i = 0
-            self.get_idx = []
-
-            for _j in range(self.length):
-                while self.trajectories["lengths"][traj_idx].item() <= i:
-                    i -= self.trajectories["lengths"][traj_idx].item()
-                    traj_idx += 1
+            self.traj_ends = np.cumsum(self.trajectories["lengths"])
+            self.traj_starts = self.traj_ends - self.trajectories["lengths"]
 
-                self.get_idx.append((traj_idx, i))
-                i += 1
+    def get_idx(self, i):
+        """Map flattened index (or array of indices) i to (trajectory index, offset within trajectory)"""
+        traj_idx = np.searchsorted(self.traj_ends, i, side='right')
+        return traj_idx, i - self.traj_starts[traj_idx]
 
     def __len__(self) -> int:
         """Return the length of the dataset."""
@@ -117,17 +175,21 @@ class ExpertDataset(Dataset):
 
     def __getitem__(self, i):
         if not self.full_traj:
-            traj_idx, i = self.get_idx[i]
+            traj_idx, i = self.get_idx(i)
 
-            state = self.trajectories["states"][traj_idx][i]
-            next_state = self.trajectories["states"][traj_idx][i+1]
+            # Copy so that normalization does not write into the shared storage
+            state = np.array(self.trajectories["states"][traj_idx][i])
+            next_state = np.array(self.trajectories["states"][traj_idx][i+1])
 
             # Rescale states and next_states to [0, 1] if are images
             # if isinstance(states, np.ndarray) and states.ndim == 3:
             #     states = np.array(states) / 255.0
             # if isinstance(states, np.ndarray) and next_states.ndim == 3:
             #     next_states = np.array(next_states) / 255.0
-            if self.normalize_states:
+            if self.normalize_states and isinstance(self.normalize_state_dim, tuple):
+                state = (state - self.state_mean) / self.state_std
+                next_state = (next_state - self.state_mean) / self.state_std
+            elif self.normalize_states:
                 state[:self.normalize_state_dim] = (
                     state[:self.normalize_state_dim] - self.state_mean) / self.state_std
                 next_state[:self.normalize_state_dim] = (
@@ -147,7 +209,9 @@ class ExpertDataset(Dataset):
             # Rescale states and next_states to [0, 1] if are images
             # if isinstance(states, np.ndarray) and states.ndim == 3:
             #     states = np.array(states) / 255.0
-            if self.normalize_states:
+            if self.normalize_states and isinstance(self.normalize_state_dim, tuple):
+                states = (states - self.state_mean) / self.state_std
+            elif self.normalize_states:
                 states[:, :self.normalize_state_dim] = (
                     states[:, :self.normalize_state_dim] - self.state_mean) / self.state_std
 
@@ -183,7 +247,7 @@ def load_trajectories(expert_location: str,
         if 'babyai' in expert_location:
             trajs = load_babyai_data(expert_location, num_trajectories, seed, **kwargs)
             # BabyAI does the random shuffling and taking subset for us
-            return trajs
+            return select_trajectories(trajs, np.arange(len(trajs["lengths"])))
         elif 'lorel' in expert_location:
             trajs = load_lorel_data(expert_location, **kwargs)
         elif 'calvin' in expert_location:
@@ -202,15 +266,39 @@ def load_trajectories(expert_location: str,
         perm = rng.permutation(perm)
 
         idx = perm[:num_trajectories]
-        for k, v in trajs.items():
-            # if not torch.is_tensor(v):
-            #     v = np.array(v)  # convert to numpy array
-            trajs[k] = [v[i] for i in idx]
+        trajs = select_trajectories(trajs, idx)
     else:
         raise ValueError(f"{expert_location} is not a valid path")
     return trajs
 
 
+def select_trajectories(trajs: Dict[str, Any], idx: np.ndarray) -> Dict[str, Any]:
+    """Select trajectories `idx` from every key as views into the loaded storage"""
+    selected = {}
+    for k, v in trajs.items():
+        if k == "lengths":
+            selected[k] = np.asarray(v)[idx]
+        else:
+            selected[k] = TrajectoryView(v).select(idx)
+    return selected
+
+
+def dataset_digest(expert_location: str, *key) -> str:
+    """Short hash of the dataset file and `key`. The file size and modification time are part of it
+    so that regenerated datasets are not matched with stale caches.
+    """
+    stat = os.stat(expert_location.rstrip('/'))
+    key = (*key, stat.st_size, int(stat.st_mtime))
+    return hashlib.md5(repr(key).encode()).hexdigest()[:12]
+
+
+def stats_cache_path(expert_location: str, num_trajectories: int, seed: int, state_dim, **kwargs) -> str:
+    """Path of the cached state normalization statistics for a given dataset selection."""
+    digest = dataset_digest(expert_location, num_trajectories, seed, state_dim,
+                            kwargs.get('use_state'), kwargs.get('use_direction'))
+    return f'{os.path.splitext(expert_location.rstrip("/"))[0]}_state_stats_{digest}.npz'
+
+
 def read_file(path: str, file_handle: IO[Any]) -> Dict[str, Any]:
     """Read file from the input path. Assumes the file stores dictionary data.
     Args:
@@ -232,36 +320,90 @@ def read_file(path: str, file_handle: IO[Any]) -> Dict[str, Any]:
     return data
 
 
-def load_babyai_data(expert_location, num_trajs, seed, **kwargs):
-    from babyai.utils.demos import load_demos, transform_demos
-    demos = transform_demos(load_demos(expert_location), num_trajs, seed)
-    trajs = {"states": [], "actions": [], "rewards": [], "lengths": [], "language": [], "dones": []}
-    for demo in tqdm(demos):
-        trajs["language"].append(demo[0][0]["mission"])
-        trajs["lengths"].append(len(demo))
-        traj_states, traj_actions, traj_rewards, traj_dones = [], [], [], []
-        for step in demo:
-            obs, action, done = step
-            if kwargs['use_direction']:
-                direction = np.zeros(4)
-                direction[obs["direction"]] = 1.
-                state = np.concatenate([obs["image"].reshape(-1), direction])
-            else:
-                state = obs["image"].reshape(-1)
-            traj_states.append(state)
-            traj_actions.append(action)
-            traj_rewards.append(None)
-            traj_dones.append(done)
-        trajs["states"].append(np.array(traj_states))
-        trajs["actions"].append(np.array(traj_actions))
-        trajs["rewards"].append(np.array(traj_rewards))
-        trajs["dones"].append(np.array(traj_dones))
+def load_babyai_data(expert_location, num_trajs, seed, cache_demos=True, **kwargs):
+    """Load BabyAI demos as flat arrays. The conversion is done once and cached next to the demo file
+    (keyed by the file, the sampled demos and `use_direction`); later runs memory-map the cache.
+    """
+    if cache_demos:
+        cache_dir = babyai_cache_dir(expert_location, num_trajs, seed, kwargs['use_direction'])
+        if not os.path.isdir(cache_dir):
+            convert_babyai_demos(expert_location, num_trajs, seed, kwargs['use_direction'], out_dir=cache_dir)
+        arrays = {k: np.load(os.path.join(cache_dir, f'{k}.npy'), mmap_mode='r')
+                  for k in ["states", "actions", "dones", "lengths"]}
+        arrays["language"] = np.load(os.path.join(cache_dir, 'language.npy'))
+    else:
+        arrays = convert_babyai_demos(expert_location, num_trajs, seed, kwargs['use_direction'])
+
+    lengths = np.asarray(arrays["lengths"])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    trajs = {"states": RaggedTrajectories(arrays["states"], offsets),
+             "actions": RaggedTrajectories(arrays["actions"], offsets),
+             "rewards": RaggedTrajectories(np.broadcast_to(np.array(None), (offsets[-1],)), offsets),
+             "lengths": lengths,
+             "language": [str(mission) for mission in arrays["language"]],
+             "dones": RaggedTrajectories(arrays["dones"], offsets)}
 
     assert len(trajs["states"]) == len(trajs["actions"]) == len(trajs["rewards"]) == len(
         trajs["lengths"]) == len(trajs["language"]) == len(trajs["dones"])
     return trajs
 
 
+def convert_babyai_demos(expert_location, num_trajs, seed, use_direction, out_dir=None):
+    """Convert BabyAI demos to flat arrays {states, actions, dones, lengths, language}.
+    If `out_dir` is given, the arrays are written there as .npy files instead of being kept in memory.
+    """
+    from babyai.utils.demos import load_demos, transform_demos
+    demos = transform_demos(load_demos(expert_location), num_trajs, seed)
+
+    lengths = np.array([len(demo) for demo in demos])
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    first_obs = demos[0][0][0]
+    image_dim = first_obs["image"].size
+    state_dim = image_dim + 4 * use_direction
+    state_dtype = np.result_type(first_obs["image"].dtype, np.float64) if use_direction else first_obs["image"].dtype
+
+    num_steps = int(offsets[-1])
+    shapes = {"states": ((num_steps, int(state_dim)), state_dtype),
+              "actions": ((num_steps,), np.int64),
+              "dones": ((num_steps,), np.bool_)}
+    if out_dir is not None:
+        tmp_dir = f'{out_dir}.tmp{os.getpid()}'
+        os.makedirs(tmp_dir, exist_ok=True)
+        arrays = {k: np.lib.format.open_memmap(os.path.join(tmp_dir, f'{k}.npy'), mode='w+', dtype=dtype, shape=shape)
+                  for k, (shape, dtype) in shapes.items()}
+    else:
+        arrays = {k: np.empty(shape, dtype=dtype) for k, (shape, dtype) in shapes.items()}
+
+    for demo, start, end in zip(tqdm(demos), offsets[:-1], offsets[1:]):
+        obss, actions, dones = zip(*demo)
+        arrays["states"][start:end, :image_dim] = np.stack([obs["image"] for obs in obss]).reshape(end - start, -1)
+        if use_direction:
+            arrays["states"][start:end, image_dim:] = np.eye(4)[[obs["direction"] for obs in obss]]
+        arrays["actions"][start:end] = [int(action) for action in actions]
+        arrays["dones"][start:end] = dones
+
+    arrays["lengths"] = lengths
+    arrays["language"] = np.array([demo[0][0]["mission"] for demo in demos])
+
+    if out_dir is not None:
+        for k in ["states", "actions", "dones"]:
+            arrays.pop(k).flush()
+        np.save(os.path.join(tmp_dir, 'lengths.npy'), arrays["lengths"])
+        np.save(os.path.join(tmp_dir, 'language.npy'), arrays["language"])
+        try:
+            os.rename(tmp_dir, out_dir)
+        except OSError:
+            # another process finished the same conversion first
+            shutil.rmtree(tmp_dir)
+    return arrays
+
+
+def babyai_cache_dir(expert_location: str, num_trajs: int, seed: int, use_direction: bool) -> str:
+    """Directory of the converted BabyAI demos for a given demo file and conversion options"""
+    digest = dataset_digest(expert_location, num_trajs, seed, use_direction)
+    return f'{os.path.splitext(expert_location)[0]}_converted_{digest}'
+
+
 def load_lorel_data(expert_location, **kwargs):
     trajs = {"states": [], "actions": [], "rewards": [], "lengths": [], "language": [], "dones": []}
     data = pickle.load(open(expert_location, 'rb'))
@@ -271,18 +413,20 @@ def load_lorel_data(expert_location, **kwargs):
     else:
         trajs["states"] = np.moveaxis(data["ims"], 4, 2)  # making images C,H,W
     trajs["actions"] = data["actions"]
-    trajs["rewards"] = np.array([[None for _ in range(traj_len)] for _ in range(num_trajs)])
-    trajs["lengths"] = np.array([traj_len]*num_trajs)
-    trajs["dones"] = np.array([[0]*(traj_len-1) + [1] for _ in range(num_trajs)])
+    # Rewards are unused placeholders, so broadcast a single None instead of a [num_trajs, traj_len] object array
+    trajs["rewards"] = np.broadcast_to(np.array(None), (num_trajs, traj_len))
+    trajs["lengths"] = np.full(num_trajs, traj_len)
+    trajs["dones"] = np.zeros((num_trajs, traj_len), dtype=np.int64)
+    trajs["dones"][:, -1] = 1
 
     if 'sawyer' in expert_location:
         trajs["language"] = data['langs'].reshape(-1)
     elif 'franka' in expert_location:
-        trajs["states"] = np.concatenate([trajs["states"], trajs["states"]], axis=0)
-        trajs["actions"] = np.concatenate([trajs["actions"], trajs["actions"]], axis=0)
-        trajs["rewards"] = np.concatenate([trajs["rewards"], trajs["rewards"]], axis=0)
-        trajs["lengths"] = np.concatenate([trajs["lengths"], trajs["lengths"]], axis=0)
-        trajs["dones"] = np.concatenate([trajs["dones"], trajs["dones"]], axis=0)
+        # Every trajectory has two language labels; both labels share the same trajectory storage
+        storage_idx = np.tile(np.arange(num_trajs), 2)
+        for k in ["states", "actions", "rewards", "dones"]:
+            trajs[k] = TrajectoryView(trajs[k], storage_idx)
+        trajs["lengths"] = trajs["lengths"][storage_idx]
         trajs["language"] = data['langs'].T.reshape(-1)
     else:
         raise NotImplementedError
@@ -297,30 +441,165 @@ def load_lorel_data(expert_location, **kwargs):
     return trajs
 
 
-def load_calvin_data(expert_location, num_trajs, seed, **kwargs):
-    trajs = {"states": [], "actions": [], "rewards": [], "lengths": [], "language": [], "dones": []}
+class CalvinFrameReader:
+    """Reads CALVIN `episode_XXXXXXX.npz` frames on demand.
+
+    Frames of a window are decoded in parallel on a thread pool and kept in a bounded LRU cache, so
+    overlapping annotation windows and states/actions of the same window are only decoded once.
+    If `consolidated` (see `consolidate_calvin_frames`) is given, windows are served as views into
+    the memory-mapped frames instead.
+    """
+
+    def __init__(self, expert_location, num_workers=8, cache_size=4096, consolidated=None):
+        self.expert_location = expert_location
+        self.num_workers = num_workers
+        self.cache_size = cache_size
+        self.consolidated = consolidated
+        self._reset()
+
+    def _reset(self):
+        self._cache = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in ['_cache', '_pending', '_lock', '_executor']:
+            state.pop(k)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    @property
+    def executor(self):
+        # DataLoader workers are forked from the main process, each of them needs its own pool
+        if self._pid != os.getpid():
+            self._reset()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        return self._executor
+
+    def load_frame(self, idx):
+        """Return (rgb_static as C,H,W, actions) of frame `idx`"""
+        with self._lock:
+            if idx in self._cache:
+                self._cache.move_to_end(idx)
+                return self._cache[idx]
+        info = np.load(f'{self.expert_location}/episode_{str(idx).zfill(7)}.npz')
+        frame = (np.moveaxis(info['rgb_static'], 2, 0), info['actions'])
+        with self._lock:
+            self._pending.discard(idx)
+            self._cache[idx] = frame
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return frame
+
+    def read(self, start_idx, end_idx, key):
+        """Return `key` ('states' or 'actions') for frames start_idx..end_idx (inclusive)"""
+        if self.consolidated is not None:
+            frame_ids, arrays = self.consolidated
+            pos = np.searchsorted(frame_ids, start_idx)
+            return arrays[key][pos:pos + end_idx - start_idx + 1]
+
+        field = 0 if key == 'states' else 1
+        frames = self.executor.map(self.load_frame, range(start_idx, end_idx + 1))
+        return np.stack([frame[field] for frame in frames])
+
+    def prefetch(self, ranges):
+        """Start decoding the frames of `ranges` in the background"""
+        if self.consolidated is not None:
+            return
+        for start_idx, end_idx in ranges:
+            for idx in range(start_idx, end_idx + 1):
+                with self._lock:
+                    if idx in self._cache or idx in self._pending:
+                        continue
+                    self._pending.add(idx)
+                self.executor.submit(self.load_frame, idx)
+
+
+class CalvinEpisodes:
+    """Sequence of lazily read CALVIN annotation windows for one field ('states' or 'actions').
+    Reading window i also starts prefetching the next `read_ahead` windows.
+    """
+
+    def __init__(self, reader, ranges, key, read_ahead=2):
+        self.reader = reader
+        self.ranges = ranges
+        self.key = key
+        self.read_ahead = read_ahead
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __getitem__(self, i):
+        self.reader.prefetch(self.ranges[i + 1:i + 1 + self.read_ahead])
+        start_idx, end_idx = self.ranges[i]
+        return self.reader.read(start_idx, end_idx, self.key)
+
+
+def consolidate_calvin_frames(expert_location, ranges, num_workers=8):
+    """Write every frame covered by `ranges` into memory-mapped arrays under `expert_location`/consolidated.
+    This only happens on first use, later calls just map the existing files.
+    Returns (sorted frame ids, {'states': memmap, 'actions': memmap}).
+    """
+    out_dir = os.path.join(expert_location, 'consolidated')
+    paths = {k: os.path.join(out_dir, f'{k}.npy') for k in ['states', 'actions', 'frame_ids']}
+
+    if not os.path.isfile(paths['frame_ids']):
+        frame_ids = np.unique(np.concatenate([np.arange(start, end + 1) for start, end in ranges]))
+        reader = CalvinFrameReader(expert_location, num_workers, cache_size=0)
+        first = reader.load_frame(frame_ids[0])
+        os.makedirs(out_dir, exist_ok=True)
+        arrays = {k: np.lib.format.open_memmap(paths[k] + '.tmp', mode='w+', dtype=x.dtype,
+                                               shape=(len(frame_ids), *x.shape))
+                  for k, x in zip(['states', 'actions'], first)}
+
+        def write(pos):
+            arrays['states'][pos], arrays['actions'][pos] = reader.load_frame(frame_ids[pos])
+
+        list(tqdm(reader.executor.map(write, range(len(frame_ids))), total=len(frame_ids),
+                  desc='Consolidating CALVIN frames'))
+        for k in list(arrays):
+            arrays.pop(k).flush()
+            os.replace(paths[k] + '.tmp', paths[k])
+        # frame ids are written last and mark the consolidation as complete
+        np.save(paths['frame_ids'], frame_ids)
+
+    frame_ids = np.load(paths['frame_ids'])
+    arrays = {k: np.load(paths[k], mmap_mode='r') for k in ['states', 'actions']}
+    return frame_ids, arrays
+
+
+def load_calvin_data(expert_location, num_trajs, seed, prefetch_workers=8, frame_cache_size=4096, consolidate=False,
+                     **kwargs):
+    """Index the language annotated CALVIN windows; frames are only read when a trajectory is accessed.
+    Args:
+        prefetch_workers:         Number of threads decoding episode files.
+        frame_cache_size:         Maximum number of decoded frames kept in memory per process.
+        consolidate:              If True, copy all annotated frames into memory-mapped arrays on first use.
+    """
     lang_anns = np.load(f'{expert_location}/lang_annotations/auto_lang_ann.npy', allow_pickle=True).item()
     np.random.seed(seed)
     chosen_traj_inds = np.random.choice(len(lang_anns['info']['indx']), size=num_trajs, replace=False)
-    for i in chosen_traj_inds:
-        start_idx, end_idx = lang_anns['info']['indx'][i]
-        states, actions = [], []
-        length = end_idx - start_idx + 1
-        rewards = np.array([None] * length)
-        language = lang_anns['language']['ann'][i]
-        dones = np.array([0] * (length-1) + [1])
-        for idx in range(start_idx, end_idx+1):
-            info = np.load(f'{expert_location}/episode_{str(idx).zfill(7)}.npz')
-            states.append(np.moveaxis(info['rgb_static'], 2,0))
-            actions.append(info['actions'])
-        assert len(states) == len(actions) == length
-        states, actions = np.array(states), np.array(actions)
-        trajs['states'].append(states)
-        trajs['actions'].append(actions)
-        trajs['rewards'].append(rewards)
-        trajs['lengths'].append(length)
-        trajs['language'].append(language)
-        trajs['dones'].append(dones)
+    ranges = [tuple(lang_anns['info']['indx'][i]) for i in chosen_traj_inds]
+    lengths = np.array([end_idx - start_idx + 1 for start_idx, end_idx in ranges])
+
+    consolidated = None
+    if consolidate:
+        consolidated = consolidate_calvin_frames(expert_location, lang_anns['info']['indx'], prefetch_workers)
+    reader = CalvinFrameReader(expert_location, prefetch_workers, frame_cache_size, consolidated)
+
+    trajs = {"states": CalvinEpisodes(reader, ranges, 'states'),
+             "actions": CalvinEpisodes(reader, ranges, 'actions'),
+             "rewards": [np.array([None] * length) for length in lengths],
+             "lengths": lengths,
+             "language": [lang_anns['language']['ann'][i] for i in chosen_traj_inds],
+             "dones": [np.array([0] * (length-1) + [1]) for length in lengths]}
     assert len(
         trajs["states"]) == len(
         trajs["actions"]) == len(
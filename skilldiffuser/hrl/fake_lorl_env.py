@@ -0,0 +1,177 @@
+import time
+from collections import namedtuple
+
+import gym
+import numpy as np
+from PIL import Image
+
+FakeSimState = namedtuple('FakeSimState', 'time qpos qvel')
+
+# qpos layout, the indices read by LorlWrapper and lorl_gt_reward
+HAND = slice(0, 3)
+WHITE_MUG = slice(9, 11)
+BLACK_MUG = slice(11, 13)
+FAUCET = 13
+DRAWER = 14
+
+# table area seen by the camera, (x, y) in [-0.3, 0.3] x [0.35, 0.95]
+VIEW_LOW, VIEW_HIGH = np.array([-0.3, 0.35]), np.array([0.3, 0.95])
+FAUCET_POS = np.array([0.15, 0.8])
+DRAWER_POS = np.array([-0.1, 0.85])
+
+
+class FakeSimData:
+    def __init__(self, nq=15):
+        self.time = 0.0
+        self.qpos = np.zeros(nq)
+        self.qvel = np.zeros(nq)
+        self.qacc = np.zeros(nq)
+        self.qacc_warmstart = np.zeros(nq)
+        self.mocap_pos = np.zeros((1, 3))
+        self.mocap_quat = np.array([[1.0, 0.0, 0.0, 0.0]])
+
+
+class FakeSim:
+    """
+    Deterministic stand-in for the mujoco_py MjSim of the LOReL Sawyer env.
+
+    The hand follows the mocap target, and pushes the mugs, the drawer handle and the faucet handle
+    when it is close enough to them. Every `step` costs `step_cost` seconds of busy waiting.
+    """
+
+    def __init__(self, dt=0.0125, step_cost=0.0):
+        self.data = FakeSimData()
+        self.dt = dt
+        self.step_cost = step_cost
+
+    def get_state(self):
+        return FakeSimState(self.data.time, self.data.qpos.copy(), self.data.qvel.copy())
+
+    def set_state(self, state):
+        self.data.time = state.time
+        self.data.qpos[:] = state.qpos
+        self.data.qvel[:] = state.qvel
+
+    def forward(self):
+        pass
+
+    def step(self):
+        data = self.data
+        qpos = data.qpos
+        old_qpos = qpos.copy()
+
+        hand = qpos[HAND]
+        hand += 0.5 * (data.mocap_pos[0] - hand) + 0.001 * data.qacc_warmstart[HAND]
+        move = hand[:2] - old_qpos[HAND][:2]
+        if hand[2] < 0.1:
+            for mug in (WHITE_MUG, BLACK_MUG):
+                if np.linalg.norm(hand[:2] - qpos[mug]) < 0.05:
+                    qpos[mug] += move
+            if np.linalg.norm(hand[:2] - (DRAWER_POS + [0, qpos[DRAWER]])) < 0.05:
+                qpos[DRAWER] = np.clip(qpos[DRAWER] + move[1], -0.15, 0.0)
+            if np.linalg.norm(hand[:2] - FAUCET_POS) < 0.08:
+                qpos[FAUCET] = np.clip(qpos[FAUCET] + 5 * move[0], -np.pi / 2, np.pi / 2)
+
+        data.qvel[:] = (qpos - old_qpos) / self.dt
+        data.qacc_warmstart[:] = data.qvel
+        data.time += self.dt
+        busy_wait(self.step_cost)
+
+    def render(self, width, height, camera_name=None):
+        image = (render_scene(self.data.qpos, 64) * 255).astype(np.uint8)
+        # flipped vertically, like mujoco offscreen rendering
+        return np.asarray(Image.fromarray(image[::-1]).resize((width, height), Image.NEAREST))
+
+
+class FakeLorlEnv(gym.Env):
+    """
+    Hermetic stand-in for the LOReL Sawyer env (LorlEnv-v0), registered as LorlFake-v0.
+
+    It has the API used by LorlWrapper and the evaluation: `sim.data.qpos` with the same object indices,
+    `_reset_hand`, `_get_obs` returning 64 x 64 x 3 images in [0, 1], `reset` returning (image, info),
+    a 5 dimensional action_space and `sim.render` for rendered episodes. The dynamics are deterministic given
+    the seed, and `step_cost` seconds are spent per simulator step to mimic the cost of the physics.
+    """
+
+    def __init__(self, step_cost=0.0, frame_skip=5, image_size=64):
+        self.sim = FakeSim(step_cost=step_cost)
+        self.frame_skip = frame_skip
+        self.image_size = image_size
+        self.action_space = gym.spaces.Box(low=-1, high=1, shape=(5,), dtype=np.float32)
+        self.observation_space = gym.spaces.Box(low=0, high=1, shape=(image_size, image_size, 3), dtype=np.float32)
+        self.np_random = np.random.RandomState(0)
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+        return [seed]
+
+    def reset(self):
+        data = self.sim.data
+        data.time = 0.0
+        data.qpos[:] = 0
+        data.qpos[WHITE_MUG] = [0.1, 0.55]
+        data.qpos[BLACK_MUG] = [-0.1, 0.6]
+        data.qpos[HAND] = [0, 0.45, 0.15]
+        data.qpos[:9] += self.np_random.uniform(-0.01, 0.01, 9)
+        data.qvel[:] = 0
+        data.qacc[:] = 0
+        data.qacc_warmstart[:] = 0
+        data.mocap_pos[0] = data.qpos[HAND]
+        return self._get_obs(), {}
+
+    def _reset_hand(self, pos):
+        self.sim.data.mocap_pos[0] = pos
+        for _ in range(10):
+            self.sim.step()
+
+    def _get_obs(self):
+        return render_scene(self.sim.data.qpos, self.image_size)
+
+    def step(self, action):
+        action = np.clip(action, self.action_space.low, self.action_space.high)
+        self.sim.data.mocap_pos[0] += 0.02 * action[:3]
+        for _ in range(self.frame_skip):
+            self.sim.step()
+        return self._get_obs(), 0.0, False, {}
+
+    def close(self):
+        pass
+
+
+def busy_wait(seconds):
+    # sleeping would leave the CPU to the other workers, unlike a physics step
+    if seconds > 0:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            pass
+
+
+_GRIDS = {}
+
+
+def render_scene(qpos, size):
+    """H x W x 3 float image of the scene, objects are drawn as colored blobs"""
+    if size not in _GRIDS:
+        ys, xs = np.meshgrid(np.linspace(VIEW_HIGH[1], VIEW_LOW[1], size),
+                             np.linspace(VIEW_LOW[0], VIEW_HIGH[0], size), indexing='ij')
+        _GRIDS[size] = np.stack([xs, ys], axis=-1)
+    grid = _GRIDS[size]
+
+    objects = [
+        (qpos[HAND][:2], 0.03 + 0.1 * max(qpos[HAND][2], 0), (0.9, 0.2, 0.2)),
+        (qpos[WHITE_MUG], 0.03, (0.9, 0.9, 0.9)),
+        (qpos[BLACK_MUG], 0.03, (0.1, 0.1, 0.1)),
+        (DRAWER_POS + [0, qpos[DRAWER]], 0.04, (0.5, 0.3, 0.1)),
+        (FAUCET_POS + 0.05 * np.array([np.sin(qpos[FAUCET]), np.cos(qpos[FAUCET])]), 0.02, (0.2, 0.4, 0.9)),
+    ]
+    image = np.full((size, size, 3), 0.6, dtype=np.float32)
+    for pos, radius, color in objects:
+        weight = np.exp(-((grid - pos) ** 2).sum(-1) / (2 * radius ** 2))[..., None]
+        image = (1 - weight) * image + weight * np.asarray(color, dtype=np.float32)
+    return image.astype(np.float32)
+
+
+try:
+    gym.register(id='LorlFake-v0', entry_point='fake_lorl_env:FakeLorlEnv')
+except gym.error.Error:
+    pass  # already registered
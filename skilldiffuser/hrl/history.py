@@ -0,0 +1,118 @@
+import torch
+
+
+class HistoryBuffer:
+    """
+    Preallocated on-device history of one episode (states, actions, options or timesteps).
+
+    Rows are stored after `window` rows of zeros, so the last `n <= window` steps are always a contiguous view that
+    is already zero padded in front, the same as cutting the history and calling `utils.pad(..., mode='pre')`.
+    `fill` replaces the zeros of the padding rows if given.
+    `attention_mask(n)` is the matching view of 1s (steps) and 0s (padding).
+    When the `capacity` rows after the padding are full, the last `window` rows are moved to the front,
+    so appending stays O(1) amortized and older steps are dropped.
+    """
+
+    def __init__(self, window, shape=(), capacity=None, dtype=torch.float32, device='cpu', fill=0):
+        self.window = window
+        self.capacity = capacity or window
+        self.fill = fill
+        self.data = torch.zeros((window + self.capacity, *shape), dtype=dtype, device=device)
+        self.data[:] = fill
+        self.mask = torch.zeros(window + self.capacity, dtype=torch.long, device=device)
+        # stored steps are rows [start, end), every row before start is padding
+        self.start = self.end = window
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        return self.data[self._row(index)]
+
+    def __setitem__(self, index, value):
+        self.data[self._row(index)] = value
+
+    def _row(self, index):
+        if not -len(self) <= index < len(self):
+            raise IndexError(f'History index {index} out of range for {len(self)} steps')
+        return self.end + index if index < 0 else self.start + index
+
+    def append(self, x):
+        if self.end == len(self.data):
+            self._compact()
+        self.data[self.end] = x
+        self.mask[self.end] = 1
+        self.end += 1
+
+    def reset(self, x=None):
+        """Clear the history, and start it again from x if given"""
+        self.data[self.start:self.end] = self.fill
+        self.mask[self.start:self.end] = 0
+        self.start = self.end
+        if x is not None:
+            self.append(x)
+
+    def restart(self):
+        """Clear the history except for its last step"""
+        self.reset(self[-1].clone())
+
+    def _compact(self):
+        keep = self.data[self.end - self.window:self.end].clone()
+        keep_mask = self.mask[self.end - self.window:self.end].clone()
+        self.data[self.window:] = self.fill
+        self.mask[self.window:] = 0
+        self.data[:self.window] = keep
+        self.mask[:self.window] = keep_mask
+        self.start = max(self.start - (self.end - self.window), 0)
+        self.end = self.window
+
+    def last(self, n=None):
+        """[n x ...] view of the last n steps, padded in front"""
+        n = n or self.window
+        assert n <= self.window, f'Only the last {self.window} steps are kept'
+        return self.data[self.end - n:self.end]
+
+    def attention_mask(self, n=None):
+        """[n] view, 1 for the steps in `last(n)` and 0 for the padding"""
+        n = n or self.window
+        assert n <= self.window, f'Only the last {self.window} steps are kept'
+        return self.mask[self.end - n:self.end]
+
+    def steps(self):
+        """View of the stored steps of the last window, without padding"""
+        return self.data[max(self.start, self.end - self.window):self.end]
+
+
+class StateHistoryBuffer(HistoryBuffer):
+    """
+    HistoryBuffer of states that also keeps the embedding of every state in `embeddings`.
+
+    Each state goes through `embed_state` once, when it is appended, and the padding rows of `embeddings` hold
+    the embedding of a zero state, so `embeddings.last(n)` equals `embed_state(last(n))` without re-encoding
+    the window at every decision.
+    """
+
+    def __init__(self, window, shape, embed_state, capacity=None, device='cpu'):
+        super().__init__(window, shape, capacity=capacity, device=device)
+        self.embed_state = embed_state
+        padding = self._embed(torch.zeros(shape, device=device))
+        self.embeddings = HistoryBuffer(window, padding.shape, capacity=capacity, device=device, fill=padding)
+
+    @torch.no_grad()
+    def _embed(self, state):
+        return self.embed_state(state.reshape(1, 1, *state.shape))[0, 0]
+
+    def append(self, x):
+        super().append(x)
+        self.embeddings.append(self._embed(self[-1]))
+
+    def reset(self, x=None):
+        self.embeddings.reset()
+        super().reset(x)
+
+    def restart(self):
+        # the last state keeps its embedding
+        state, embedding = self[-1].clone(), self.embeddings[-1].clone()
+        super().reset()
+        HistoryBuffer.append(self, state)
+        self.embeddings.reset(embedding)
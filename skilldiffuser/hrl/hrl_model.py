@@ -192,7 +192,8 @@ class HRLModel(nn.Module, IQMixin):
                 'diff_loss': diff_loss,
                 'entropy': entropy}
 
-    def get_action(self, states, actions, timesteps, options=None, word_embeddings=None, ema_diffusion_model=None):
+    def get_action(self, states, actions, timesteps, options=None, word_embeddings=None, ema_diffusion_model=None,
+                   state_embeddings=None):
         if self.method == 'vanilla':
             preds = self.decision_transformer.get_action(
                 states, actions, timesteps, word_embeddings=word_embeddings)
@@ -202,7 +203,8 @@ class HRLModel(nn.Module, IQMixin):
             # preds = self.decision_transformer.get_action(
             #     states, actions, timesteps, options=options)
             encoder_out = self.diffuser.get_action(states, actions, timesteps,
-                                                   options=options, embed_state=self.option_selector.option_dt.embed_state)
+                                                   options=options, embed_state=self.option_selector.option_dt.embed_state,
+                                                   state_embeddings=state_embeddings)
             stacked_inputs = encoder_out['stacked_inputs']
             option_embeddings = encoder_out['option_embeddings']
 
@@ -210,32 +212,37 @@ class HRLModel(nn.Module, IQMixin):
             returns = option_embeddings  # conditions
 
             samples = ema_diffusion_model.conditional_sample(conds, returns=returns)
-
-            action_hist = []
-            for tt in range(samples.shape[1]-1):
-                obs_comb = torch.cat([samples[:, tt, :], samples[:, tt+1, :]], dim=-1)
-                obs_comb = obs_comb.reshape(-1, 2 * self.diffuser.hidden_size)
-                action = ema_diffusion_model.inv_model(obs_comb)
-                action_hist.append(action)
-
-            # obs_comb = torch.cat([samples[:, 0, :], samples[:, 1, :]], dim=-1)
-            # obs_comb = obs_comb.reshape(-1, 2 * self.diffuser.hidden_size)
-            # action = ema_diffusion_model.inv_model(obs_comb)
+            action_hist = self.inverse_dynamics(samples, ema_diffusion_model)
 
         if self.diffuser.predict_q:
             # Choose actions from q_values
             # action = self.iq_choose_action(preds['q_preds'][:, -1], sample=True)
             raise NotImplementedError
-        else:
-            # Choose actions from direct predictions
-            # action = preds['action_preds'][:, -1]
-            if self.diffuser.discrete:
-                action = action.argmax(dim=1)
 
-        # action = action.squeeze(0)
-        action = torch.cat(action_hist, dim=0)
+        # actions of consecutive planned steps, [ (horizon - 1) * batch_size x act_dim ]
+        action = action_hist.transpose(0, 1).reshape(-1, action_hist.shape[-1])
         return action
 
+    def get_actions(self, states, actions, timesteps, options, ema_diffusion_model, state_embeddings=None):
+        """Batched version of get_action for inputs that are already cut and padded to the encoder max_length.
+        Returns the planned actions of every sequence, [batch_size x (horizon - 1) x act_dim]
+        """
+        if state_embeddings is None:
+            state_embeddings = self.option_selector.option_dt.embed_state(states)
+        encoder_out = self.diffuser.encode(states, actions, timesteps, options=options,
+                                           state_embeddings=state_embeddings)
+        conds = {0: encoder_out['stacked_inputs'][:, -1, self.diffuser.act_dim:]}
+        samples = ema_diffusion_model.conditional_sample(conds, returns=encoder_out['option_embeddings'])
+        return self.inverse_dynamics(samples, ema_diffusion_model)
+
+    def inverse_dynamics(self, samples, ema_diffusion_model):
+        """Actions between consecutive planned states, computed for all steps of the plan in one call"""
+        batch_size, horizon = samples.shape[:2]
+        obs_comb = torch.cat([samples[:, :-1], samples[:, 1:]], dim=-1)
+        obs_comb = obs_comb.reshape(-1, 2 * self.diffuser.hidden_size)
+        action = ema_diffusion_model.inv_model(obs_comb)
+        return action.reshape(batch_size, horizon - 1, -1)
+
     def save(self, iter_num, filepath, config):
         if hasattr(self.model, 'module'):
             model = self.model.module
@@ -19,6 +19,7 @@ from omegaconf import DictConfig, OmegaConf
 from transformers import DistilBertTokenizer
 from torch.utils.data import DataLoader
 from expert_dataset import ExpertDataset
+from prefetcher import collate_trajectories
 from hrl_model import HRLModel
 from trainer import Trainer
 from difftrainer import DiffTrainer
@@ -84,7 +85,7 @@ def evaluate(cfg):
     else:
         raise NotImplementedError
     train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, num_workers=32,
-                              shuffle=True, drop_last=True)
+                              shuffle=True, drop_last=True, collate_fn=collate_trajectories)
 
     if args.method == 'traj_option':
         args.option_selector.option_transformer.max_length = int(max_length)
@@ -144,95 +145,21 @@ def evaluate(cfg):
 
     # Restore trainer from checkpoint
     trainer.load(args.checkpoint_path)
-    trainer.evaluate(iter_num=0, render=args.render, max_ep_len=500, render_path=args.render_path)
+    trainer.evaluate(iter_num=0, render=args.render, max_ep_len=500, render_path=args.render_path,
+                     render_size=cfg.get('render_size'), render_fps=cfg.get('render_fps', 25))
 
 
-def train(args):
-    device = args.trainer.device
-
-    args.method = args.model.name
-    # args.method = "option"
-    # args.model.name = "option"
-    exp_name = f'{args.project_name}-{args.train_dataset.num_trajectories}-{args.method}'
-    args.savepath = f'{args.hydra_base_dir}/{args.savedir}/{exp_name}-{datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}'
-
-    if args.wandb:
-        # os.environ["WANDB_MODE"] = "offline"
-        wandb.init(
-            name=exp_name,
-            group=args.method,
-            project=f'eval_long_horizon_{args.env.name}',  # diff_hot_pluo_diff_loss_{args.env.name} # TODO frozen  diff_hot_A100_LN
-            config=dict(args),
-            # entity='language-rl'
-        )
-
-    if not os.path.isdir(args.savepath):
-        os.makedirs(args.savepath, exist_ok=True)
-
-    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
-
-    #K = args['K']
-    batch_size = args.batch_size
-
-    train_dataset_args = dict(args.train_dataset)
-    if 'BabyAI' in args.env.name:
-        train_dataset = ExpertDataset(**train_dataset_args, use_direction=args.env.use_direction)
-    elif 'Lorl' in args.env.name:
-        train_dataset = ExpertDataset(**train_dataset_args, use_state=args.env.use_state)
-    elif 'Hopper' in args.env.name:
-        train_dataset = ExpertDataset(**train_dataset_args)
-    else:
-        raise NotImplementedError
-    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, num_workers=32,
-                              shuffle=True, pin_memory=True, drop_last=True)
-
-    print('=' * 50)
-    print(f'Starting new experiment: {args.env.name} {args.train_dataset.num_trajectories}')
-    print(f'{len(train_dataset)} trajectories, {train_dataset.total_timesteps} timesteps found')
-    print('=' * 50)
-
-    state_dim = args.env.state_dim
-    action_dim = args.env.action_dim
-    if isinstance(state_dim, str):
-        state_dim = ast.literal_eval(state_dim)
-
-    if isinstance(state_dim, tuple):
-        assert not args.trainer.state_il, "Cannot do state imitation learning with an image input"
-
-    if not args.env.eval_offline:
-        if args.env.eval_env:
-            env_name = args.env.eval_env
-        else:
-            env_name = args.env.name
-        print(f'-->Testing on {env_name}')
-
-        env = gym.make(env_name)
-        env_name = env_name
-        val_loader = None
-    else:
-        val_dataset_args = dict(args.val_dataset)
-        if 'BabyAI' in args.env.name:
-            val_dataset = ExpertDataset(**val_dataset_args, use_direction=args.env.use_direction)
-        elif 'lorel' in args.env.name:
-            val_dataset = ExpertDataset(**val_dataset_args, use_state=args.env.use_state)
-        else:
-            raise NotImplementedError
-        val_loader = DataLoader(dataset=val_dataset, batch_size=batch_size, num_workers=32,
-                                shuffle=True, pin_memory=True, drop_last=True)
-
-    if 'BabyAI' in args.env.name:
-        state_dim += 4*args.env.use_direction
-
-    print(f'--> Train episode max length: {train_dataset.max_length}')
+def build_model(args, state_dim, action_dim, max_length, device):
+    """HRLModel (with its diffusion trainer) for the given config and training episode max_length"""
     if args.method == 'traj_option':
-        args.option_selector.option_transformer.max_length = int(train_dataset.max_length)
+        args.option_selector.option_transformer.max_length = int(max_length)
         args.option_selector.option_transformer.max_ep_len = args.env.eval_episode_factor * \
-            int(train_dataset.max_length)
+            int(max_length)
 
     if args.model.horizon == 'max':
-        args.model.horizon = int(train_dataset.max_length)
+        args.model.horizon = int(max_length)
     if args.model.K == 'max':
-        args.model.K = int(train_dataset.max_length)
+        args.model.K = int(max_length)
 
     option_selector_args = dict(args.option_selector)
     option_selector_args['state_dim'] = state_dim
@@ -248,8 +175,8 @@ def train(args):
                      'use_language': args.method == 'vanilla',
                      'use_options': args.method != 'vanilla',
                      'predict_q': args.use_iq,
-                     'max_length': train_dataset.max_length if 'option' not in args.method else args.model.K,  # used to be K
-                     'max_ep_len': args.env.eval_episode_factor * train_dataset.max_length,
+                     'max_length': max_length if 'option' not in args.method else args.model.K,  # used to be K
+                     'max_ep_len': args.env.eval_episode_factor * max_length,
                      }
 
     # decision_transformer_args = {
@@ -374,6 +301,89 @@ def train(args):
     model = HRLModel(args, option_selector_args, state_reconstructor_args,
                      lang_reconstructor_args, decision_args, iq_args, diff_trainer, device, **hrl_model_args)
 
+    return model
+
+
+def train(args):
+    device = args.trainer.device
+
+    args.method = args.model.name
+    # args.method = "option"
+    # args.model.name = "option"
+    exp_name = f'{args.project_name}-{args.train_dataset.num_trajectories}-{args.method}'
+    args.savepath = f'{args.hydra_base_dir}/{args.savedir}/{exp_name}-{datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")}'
+
+    if args.wandb:
+        # os.environ["WANDB_MODE"] = "offline"
+        wandb.init(
+            name=exp_name,
+            group=args.method,
+            project=f'eval_long_horizon_{args.env.name}',  # diff_hot_pluo_diff_loss_{args.env.name} # TODO frozen  diff_hot_A100_LN
+            config=dict(args),
+            # entity='language-rl'
+        )
+
+    if not os.path.isdir(args.savepath):
+        os.makedirs(args.savepath, exist_ok=True)
+
+    tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+
+    #K = args['K']
+    batch_size = args.batch_size
+
+    train_dataset_args = dict(args.train_dataset)
+    if 'BabyAI' in args.env.name:
+        train_dataset = ExpertDataset(**train_dataset_args, use_direction=args.env.use_direction)
+    elif 'Lorl' in args.env.name:
+        train_dataset = ExpertDataset(**train_dataset_args, use_state=args.env.use_state)
+    elif 'Hopper' in args.env.name:
+        train_dataset = ExpertDataset(**train_dataset_args)
+    else:
+        raise NotImplementedError
+    train_loader = DataLoader(dataset=train_dataset, batch_size=batch_size, num_workers=32,
+                              shuffle=True, pin_memory=True, drop_last=True, collate_fn=collate_trajectories)
+
+    print('=' * 50)
+    print(f'Starting new experiment: {args.env.name} {args.train_dataset.num_trajectories}')
+    print(f'{len(train_dataset)} trajectories, {train_dataset.total_timesteps} timesteps found')
+    print('=' * 50)
+
+    state_dim = args.env.state_dim
+    action_dim = args.env.action_dim
+    if isinstance(state_dim, str):
+        state_dim = ast.literal_eval(state_dim)
+
+    if isinstance(state_dim, tuple):
+        assert not args.trainer.state_il, "Cannot do state imitation learning with an image input"
+
+    if not args.env.eval_offline:
+        if args.env.eval_env:
+            env_name = args.env.eval_env
+        else:
+            env_name = args.env.name
+        print(f'-->Testing on {env_name}')
+
+        env = gym.make(env_name)
+        env_name = env_name
+        val_loader = None
+    else:
+        env, env_name = None, None
+        val_dataset_args = dict(args.val_dataset)
+        if 'BabyAI' in args.env.name:
+            val_dataset = ExpertDataset(**val_dataset_args, use_direction=args.env.use_direction)
+        elif 'Lorl' in args.env.name:
+            val_dataset = ExpertDataset(**val_dataset_args, use_state=args.env.use_state)
+        else:
+            raise NotImplementedError
+        val_loader = DataLoader(dataset=val_dataset, batch_size=batch_size, num_workers=32,
+                                shuffle=True, pin_memory=True, drop_last=True, collate_fn=collate_trajectories)
+
+    if 'BabyAI' in args.env.name:
+        state_dim += 4*args.env.use_direction
+
+    print(f'--> Train episode max length: {train_dataset.max_length}')
+    model = build_model(args, state_dim, action_dim, train_dataset.max_length, device)
+
     # # load saved arguments
     # checkpoint = torch.load(cfg.checkpoint_path)
     # args = checkpoint['config']
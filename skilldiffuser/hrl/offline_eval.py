@@ -0,0 +1,241 @@
+import time
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Subset
+
+from prefetcher import DevicePrefetcher, collate_trajectories, to_device
+
+
+class OfflineEvalStats:
+    """Sums of the offline evaluation metrics, merged across batches and worker processes"""
+
+    def __init__(self, num_options):
+        self.trajectories = 0
+        self.decisions = 0
+        self.actions = 0  # compared planned actions
+        self.sq_error = 0.0  # summed over the action dims
+        self.first_actions = 0  # compared first actions of the plans
+        self.first_sq_error = 0.0
+        self.errors = 0  # wrong planned actions of discrete envs
+        self.option_counts = np.zeros(num_options, dtype=np.int64)
+        self.option_switches = 0
+        self.option_pairs = 0  # consecutive decisions of a trajectory
+        self.plan_time = 0.0  # option selection and planning
+        self.embed_time = 0.0  # language model and state embeddings
+        self.loader_wait = 0.0  # waiting on the DataLoader for the next batch
+
+    def merge(self, other):
+        for k, v in vars(other).items():
+            setattr(self, k, getattr(self, k) + v)
+        return self
+
+    def metrics(self, act_dim, discrete, eval_time):
+        option_freqs = self.option_counts / max(self.option_counts.sum(), 1)
+        nonzero = option_freqs[option_freqs > 0]
+        metrics = {
+            'num_trajectories': self.trajectories,
+            'num_decisions': self.decisions,
+            'option_entropy': float(-(nonzero * np.log(nonzero)).sum()),
+            'options_used': int((self.option_counts > 0).sum()),
+            'option_switch_rate': self.option_switches / max(self.option_pairs, 1),
+            'plan_latency_ms': 1000 * self.plan_time / max(self.decisions, 1),
+            'embed_latency_ms': 1000 * self.embed_time / max(self.trajectories, 1),
+            'loader_wait': self.loader_wait,
+            'eval_time': eval_time,
+        }
+        if discrete:
+            metrics['action_error'] = self.errors / max(self.actions, 1)
+        else:
+            metrics['action_mse'] = self.sq_error / max(self.actions * act_dim, 1)
+            metrics['first_action_mse'] = self.first_sq_error / max(self.first_actions * act_dim, 1)
+        return metrics
+
+
+def plan_decisions(lengths, plan_length, K):
+    """
+    Decisions of eval_episode along trajectories of the given lengths, had the agent followed the expert.
+
+    A new plan (and option) is chosen every plan_length steps, and the histories are cut after every K - 1 steps.
+    Returns, for every decision, (trajectory, t, option_start, plan_start): the option selector sees the states
+    from option_start to t, the planner the states from plan_start to t.
+    """
+    decisions = []
+    for b, length in enumerate(lengths):
+        start = 0
+        for t in range(0, length, plan_length):
+            # the option is chosen before the histories are cut
+            option_start = start
+            if t % (K - 1) == 0:
+                start = t
+            decisions.append((b, t, option_start, start))
+    return decisions
+
+
+def windows(starts, ends, length):
+    """[N x length] steps of the windows [start, end] cut to their last length steps, -1 for the padding in front"""
+    steps = ends[:, None] - torch.arange(length - 1, -1, -1, device=ends.device)[None]
+    return torch.where(steps >= starts[:, None], steps, torch.full_like(steps, -1))
+
+
+def window_timesteps(steps, starts, cut):
+    """Timesteps of the window steps, eval_episode restarts the timesteps of a cut history at t + 1"""
+    return steps.clamp(min=0) + ((steps == starts[:, None]) & cut[:, None]).long()
+
+
+def gather_steps(x, traj, offsets, steps, fill):
+    """x[traj, offsets + steps] of the (pre padded) trajectories, fill for the padding steps (-1)"""
+    out = x[traj[:, None], offsets[traj][:, None] + steps.clamp(min=0)]
+    padding = (steps < 0).reshape(*steps.shape, *([1] * (out.dim() - 2)))
+    return torch.where(padding, fill, out)
+
+
+@torch.no_grad()
+def evaluate_batch(model, tokenizer, batch, ema_diffusion_model, stats, device):
+    """
+    Plan from every decision point of a batch of expert trajectories, with the histories eval_episode would have,
+    and compare the plans with the expert actions.
+    """
+    synchronize = torch.cuda.synchronize if torch.device(device).type == 'cuda' else (lambda: None)
+    langs, states, actions, timesteps, dones, attention_mask = to_device(batch, device)
+    option_dt = model.option_selector.option_dt
+    discrete, act_dim = model.diffuser.discrete, model.diffuser.act_dim
+    B, L = attention_mask.shape
+    lengths = attention_mask.sum(1)
+    offsets = L - lengths  # ExpertDataset pads trajectories in front
+
+    synchronize()
+    start = time.perf_counter()
+    lm_input = tokenizer(text=list(langs), add_special_tokens=True, return_tensors='pt', padding=True).to(device)
+    lm_embeddings = model.lm(lm_input['input_ids'], lm_input['attention_mask']).last_hidden_state
+    word_embeddings = lm_embeddings[:, 1:, :]  # skip the CLS tokens
+    lang_attention_mask = lm_input['attention_mask'][:, 1:]
+
+    # every frame goes through the state encoder once, as in the rollouts
+    state_embeddings = torch.zeros((B, L, option_dt.hidden_size), device=device)
+    state_embeddings[attention_mask > 0] = option_dt.embed_state(states[attention_mask > 0][None])[0]
+    padding_embedding = option_dt.embed_state(torch.zeros_like(states[:1, :1]))[0, 0]
+    synchronize()
+    stats.embed_time += time.perf_counter() - start
+
+    plan_length = model.horizon - 1
+    decisions = torch.tensor(plan_decisions(lengths.tolist(), plan_length, model.K), device=device)
+    traj, t, option_start, plan_start = decisions.unbind(1)
+    zero_state = torch.zeros((), device=device)
+
+    synchronize()
+    start = time.perf_counter()
+    # options, from the states since the last cut
+    steps = windows(option_start, t, option_dt.max_length)
+    options, option_indices = model.option_selector.get_options(
+        word_embeddings[traj], gather_steps(states, traj, offsets, steps, zero_state),
+        window_timesteps(steps, option_start, t > 0), attention_mask=(steps >= 0).long(),
+        lang_attention_mask=lang_attention_mask[traj],
+        state_embeddings=gather_steps(state_embeddings, traj, offsets, steps, padding_embedding))
+
+    # the planner sees the expert actions and the options chosen since the last cut, the current action is padding
+    max_length = model.diffuser.max_length
+    steps = windows(plan_start, t, max_length)
+    history_actions = gather_steps(actions, traj, offsets, steps, zero_state)
+    if discrete:
+        history_actions = F.one_hot(history_actions.long(), act_dim)
+    history_actions = history_actions.float()
+    history_actions[:, -1] = 0
+    history_options = torch.zeros((len(decisions), max_length, options.shape[-1]), device=device)
+    step_list = t.tolist()
+    for i, j in torch.nonzero((traj[:, None] == traj[None]) & (t[None] >= plan_start[:, None])
+                              & (t[None] <= t[:, None]) & (t[:, None] - t[None] < max_length)).tolist():
+        history_options[i, max_length - 1 - (step_list[i] - step_list[j])] = options[j]
+
+    plans = model.get_actions(
+        gather_steps(states, traj, offsets, steps, zero_state), history_actions,
+        window_timesteps(steps, plan_start, torch.ones_like(t, dtype=torch.bool)), history_options, ema_diffusion_model,
+        state_embeddings=gather_steps(state_embeddings, traj, offsets, steps, padding_embedding))
+    synchronize()
+    stats.plan_time += time.perf_counter() - start
+
+    # expert actions of the planned steps
+    target_steps = t[:, None] + torch.arange(plans.shape[1], device=device)[None]
+    valid = target_steps < lengths[traj][:, None]
+    targets = actions[traj[:, None], offsets[traj][:, None] + torch.where(valid, target_steps, t[:, None])]
+    if discrete:
+        stats.errors += ((plans.argmax(-1) != targets.long()) & valid).sum().item()
+    else:
+        sq_error = ((plans - targets) ** 2).sum(-1)
+        stats.sq_error += sq_error[valid].sum().item()
+        stats.first_sq_error += sq_error[:, 0].sum().item()
+        stats.first_actions += len(decisions)
+    stats.actions += valid.sum().item()
+
+    option_indices = option_indices.long()
+    stats.option_counts += np.bincount(option_indices.cpu().numpy(), minlength=len(stats.option_counts))
+    same_traj = traj[1:] == traj[:-1]
+    stats.option_switches += ((option_indices[1:] != option_indices[:-1]) & same_traj).sum().item()
+    stats.option_pairs += same_traj.sum().item()
+    stats.decisions += len(decisions)
+    stats.trajectories += B
+    return stats
+
+
+def _offline_eval_worker(model, tokenizer, dataset, indices, batch_size, device, seed, num_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = model.to(device=device)
+    model.eval()
+    ema_diffusion_model = model.diff_trainer.ema_model
+    use_cuda = torch.device(device).type == 'cuda'
+    loader = DataLoader(Subset(dataset, indices), batch_size=batch_size, shuffle=False,
+                        pin_memory=use_cuda, collate_fn=collate_trajectories)
+    # the next batch is copied to the device while the current one is evaluated
+    prefetcher = DevicePrefetcher(loader, device)
+    stats = OfflineEvalStats(model.option_selector.num_options)
+    # the diffusion noise is seeded without touching the random state of the caller (e.g. the training loop)
+    cuda_devices = [torch.device(device)] if use_cuda else []
+    with torch.random.fork_rng(devices=cuda_devices):
+        torch.manual_seed(seed)
+        for batch in prefetcher:
+            evaluate_batch(model, tokenizer, batch, ema_diffusion_model, stats, device)
+    stats.loader_wait += prefetcher.wait_time
+    return stats
+
+
+def offline_evaluate(model, tokenizer, dataset, batch_size=64, device='cpu', n_workers=1, seed=0,
+                     context='spawn'):
+    """
+    Evaluation of a traj_option HRLModel on held-out ExpertDataset (full_traj) trajectories, without simulator.
+
+    Every trajectory is replayed with the expert actions. At each point where eval_episode would plan, the option
+    selector and the planner get the histories the rollout would have and plan in one batched call, and the
+    planned actions are compared with the next expert actions (action_mse, or action_error for discrete actions).
+    Also reports how the options are used, the latency of planning (per decision) and of the language and
+    state embeddings (per trajectory) in the worker processes, and the seconds they waited on their DataLoader.
+    With n_workers > 1 the trajectories are split between that many processes, spread over the visible GPUs
+    when device is a GPU.
+    """
+    if model.method != 'traj_option':
+        raise NotImplementedError('Offline evaluation plans with the traj_option option selector')
+
+    start = time.perf_counter()
+    shards = [shard for shard in np.array_split(np.arange(len(dataset)), n_workers) if len(shard)]
+    if len(shards) > 1:
+        if torch.device(device).type == 'cuda' and torch.cuda.device_count() > 1:
+            devices = [f'cuda:{i % torch.cuda.device_count()}' for i in range(len(shards))]
+            num_threads = None
+        else:
+            devices = [device] * len(shards)
+            num_threads = max(torch.get_num_threads() // len(shards), 1)
+        with mp.get_context(context).Pool(len(shards)) as pool:
+            results = pool.starmap(_offline_eval_worker, [
+                (model, tokenizer, dataset, shard, batch_size, worker_device, seed + rank, num_threads)
+                for rank, (shard, worker_device) in enumerate(zip(shards, devices))])
+        stats = results[0]
+        for result in results[1:]:
+            stats.merge(result)
+    else:
+        training = model.training
+        stats = _offline_eval_worker(model, tokenizer, dataset, np.arange(len(dataset)), batch_size, device, seed)
+        model.train(training)
+
+    return stats.metrics(model.diffuser.act_dim, model.diffuser.discrete, time.perf_counter() - start)
@@ -69,7 +69,8 @@ class OptionSelector(nn.Module):
                                        'n_positions': option_transformer.n_positions,
                                        'resid_pdrop': option_transformer.dropout,
                                        'attn_pdrop': option_transformer.dropout,
-                                       'output_attentions': True  # option_transformer.output_attention,
+                                       # attention maps are only kept for visualization
+                                       'output_attentions': option_transformer.get('output_attention', False),
                                        }
             self.option_dt = OptionTransformer(**option_transformer_args)
         else:
@@ -95,9 +96,11 @@ class OptionSelector(nn.Module):
             self.pred_options = nn.Sequential(*z_layers)
             self.embed_lang = nn.Linear(lang_dim, hidden_size)
 
-    def forward(self, word_embeddings, states, timesteps=None, attention_mask=None, **kwargs):
+    def forward(self, word_embeddings, states, timesteps=None, attention_mask=None, lang_attention_mask=None,
+                state_embeddings=None, **kwargs):
         if self.method == 'traj_option':
-            dt_ret = self.option_dt(word_embeddings, states, timesteps, attention_mask)
+            dt_ret = self.option_dt(word_embeddings, states, timesteps, attention_mask,
+                                    lang_attention_mask=lang_attention_mask, state_embeddings=state_embeddings)
             option_preds = dt_ret[0]
             state_embeddings = dt_ret[2]
             option_preds = option_preds[:, ::self.horizon, :]
@@ -113,6 +116,10 @@ class OptionSelector(nn.Module):
 
             state_embeddings = ret_state_embeddings
 
+        options, indices, commitment_loss, entropies = self.quantize(option_preds)
+        return options, indices, commitment_loss, entropies, state_embeddings
+
+    def quantize(self, option_preds):
         if self.use_vq:
             options, indices, commitment_loss = self.Z(option_preds)
             entropies = entropy(self.Z.codebook, options, self.Z.project_in(option_preds))
@@ -121,9 +128,13 @@ class OptionSelector(nn.Module):
             options, indices = option_preds, option_preds[:, :, 0]
             commitment_loss = None
             entropies = None
-        return options, indices, commitment_loss, entropies, state_embeddings
+        return options, indices, commitment_loss, entropies
 
-    def get_option(self, word_embeddings, states, timesteps=None, **kwargs):
+    def get_option(self, word_embeddings, states, timesteps=None, attention_mask=None, state_embeddings=None,
+                   **kwargs):
+        """attention_mask can be given for states and timesteps that are already padded to max_length,
+        together with the matching state_embeddings if the states were embedded when they were observed
+        """
 
         if 'constant_option' in kwargs:
             return self.Z.project_out(
@@ -138,7 +149,11 @@ class OptionSelector(nn.Module):
             timesteps = timesteps.reshape(1, -1)
             max_length = self.option_dt.max_length
 
-            if max_length is not None:
+            if attention_mask is not None:
+                attention_mask = attention_mask.reshape(1, -1)
+                if state_embeddings is not None:
+                    state_embeddings = state_embeddings.reshape(1, -1, state_embeddings.shape[-1])
+            elif max_length is not None:
                 states = states[:, -max_length:]
                 timesteps = timesteps[:, -max_length:]
 
@@ -154,11 +169,34 @@ class OptionSelector(nn.Module):
                 attention_mask = None
                 raise ValueError('Attention mask should not be none')
 
+        options, option_indx = self.get_options(
+            word_embeddings, states, timesteps, attention_mask=attention_mask, state_embeddings=state_embeddings,
+            **kwargs)
+
+        return options[0], option_indx[0]
+
+    def get_cached_option(self, option_cache, **kwargs):
+        """get_option of traj_option from an OptionTransformerCache that holds the states of the episode"""
+        if 'constant_option' in kwargs:
+            return self.get_option(None, None, **kwargs)
+
+        # forward keeps the predictions of every horizon-th slot of the padded window, get_option the last of them
+        offset = (option_cache.max_length - 1) % self.horizon
+        options, option_indx, _, _ = self.quantize(option_cache.option_preds(offset)[:, None])
+        return options[0, -1], option_indx[0, -1]
+
+    def get_options(self, word_embeddings, states, timesteps=None, attention_mask=None, lang_attention_mask=None,
+                    **kwargs):
+        """Batched option selection from already padded inputs.
+        Returns the option (and its index) at the last step of every sequence in the batch.
+        """
+        if self.method == 'traj_option':
             options, option_indx, _, _, _ = self.forward(
-                word_embeddings, states, timesteps, attention_mask=attention_mask, **kwargs)
+                word_embeddings, states, timesteps, attention_mask=attention_mask,
+                lang_attention_mask=lang_attention_mask, **kwargs)
         else:
             states = states[:, ::self.horizon, :]
             options, option_indx, _, _, _ = self.forward(
                 word_embeddings, states, None, attention_mask=None, **kwargs)
 
-        return options[0, -1], option_indx[0, -1]
+        return options[:, -1], option_indx[:, -1]
@@ -60,7 +60,8 @@ class OptionTransformer(nn.Module):
         self.embed_ln = nn.LayerNorm(hidden_size)
         self.predict_options = torch.nn.Linear(hidden_size, self.option_dim)
 
-    def forward(self, word_embeddings, states, timesteps, attention_mask, **kwargs):
+    def forward(self, word_embeddings, states, timesteps, attention_mask, lang_attention_mask=None,
+                state_embeddings=None, **kwargs):
         batch_size, seq_length = states.shape[0], states.shape[1]
         num_tokens = word_embeddings.shape[1]
 
@@ -69,7 +70,9 @@ class OptionTransformer(nn.Module):
             # attention mask for GPT: 1 if can be attended to, 0 if not
             attention_mask = torch.ones((batch_size, seq_length), dtype=torch.long)
 
-        state_embeddings = self.embed_state(states)
+        if state_embeddings is None:
+            state_embeddings = self.embed_state(states)
+        # else the states were already embedded one by one, e.g. during a rollout
         ret_state_embeddings = state_embeddings.clone().detach()
         lang_embeddings = self.embed_lang(word_embeddings)
         time_embeddings = self.embed_timestep(timesteps)
@@ -80,7 +83,10 @@ class OptionTransformer(nn.Module):
         # LAYERNORM AFTER LANGUAGE
         stacked_inputs = self.embed_ln(lang_and_inputs)
 
-        lang_attn_mask = torch.cat([torch.ones((batch_size, num_tokens), device=states.device), attention_mask], dim=1)
+        if lang_attention_mask is None:
+            lang_attention_mask = torch.ones((batch_size, num_tokens), device=states.device)
+        # padded word tokens (batched instructions of different lengths) are masked out
+        lang_attn_mask = torch.cat([lang_attention_mask, attention_mask], dim=1)
 
         # we feed in the input embeddings (not word indices as in NLP) to the model
         transformer_outputs = self.transformer(
@@ -101,3 +107,99 @@ class OptionTransformer(nn.Module):
             return option_preds, attentions, ret_state_embeddings
 
         return option_preds, None, ret_state_embeddings
+
+    def embed_language(self, word_embeddings):
+        """Transformer inputs of the language tokens, as in forward"""
+        return self.embed_ln(self.embed_lang(word_embeddings))
+
+    def embed_steps(self, state_embeddings, timesteps):
+        """Transformer inputs of the states, as in forward"""
+        return self.embed_ln(state_embeddings + self.embed_timestep(timesteps))
+
+    def decode(self, inputs_embeds, attention_mask, past_key_values=None):
+        """Option predictions of new input tokens that follow past_key_values, and the keys and values of all tokens.
+        attention_mask covers the past and the new tokens
+        """
+        transformer_outputs = self.transformer(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_attentions=False,
+        )
+        return self.predict_options(transformer_outputs['last_hidden_state']), transformer_outputs['past_key_values']
+
+
+class OptionTransformerCache:
+    """
+    Incremental option inference of an OptionTransformer over one episode, with cached keys and values.
+
+    The GPT2 has no positional embeddings and the padding in front of the states is masked out, so the keys and
+    values of a token only depend on the tokens before it: the language prefix is encoded once when the cache is
+    created, and every appended state is encoded once, at the first `option_preds` call after it. When more than
+    max_length states were appended, the oldest one leaves the window and the states left in it are encoded again
+    after the language prefix, as the full forward over the last max_length states would do.
+    """
+
+    @torch.no_grad()
+    def __init__(self, option_dt, word_embeddings, lang_attention_mask=None):
+        self.option_dt = option_dt
+        self.max_length = option_dt.max_length
+        lang_inputs = option_dt.embed_language(word_embeddings)
+        if lang_attention_mask is None:
+            lang_attention_mask = torch.ones(lang_inputs.shape[:2], dtype=torch.long, device=lang_inputs.device)
+        self.lang_attention_mask = lang_attention_mask
+        _, self.lang_past = option_dt.decode(lang_inputs, lang_attention_mask)
+        self.padding_preds = None
+        self.reset()
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def reset(self, state_embedding=None, timestep=None):
+        """Drop all states, and start again from the given one"""
+        self.inputs = []  # transformer inputs of the states in the window
+        self.preds = []  # option predictions of the states whose keys and values are in past
+        self.past = self.lang_past
+        if state_embedding is not None:
+            self.append(state_embedding, timestep)
+
+    @torch.no_grad()
+    def append(self, state_embedding, timestep):
+        """Add the next state of the episode, from its embedding [hidden] and its timestep"""
+        timestep = torch.as_tensor(timestep, dtype=torch.long, device=state_embedding.device).reshape(1, 1)
+        self.inputs.append(self.option_dt.embed_steps(state_embedding.reshape(1, 1, -1), timestep))
+        if self.max_length is not None and len(self.inputs) > self.max_length:
+            # the states left attended to the one leaving the window, their keys and values are stale
+            self.inputs.pop(0)
+            self.preds, self.past = [], self.lang_past
+
+    def attention_mask(self, n_states):
+        states_mask = torch.ones((1, n_states), dtype=torch.long, device=self.lang_attention_mask.device)
+        return torch.cat([self.lang_attention_mask, states_mask], dim=1)
+
+    @torch.no_grad()
+    def option_preds(self, offset=0):
+        """[1 x option_dim] option prediction at the state `offset` steps before the last one.
+        For an offset past the first state, this is the prediction at a padding slot of the full forward
+        """
+        if len(self.preds) < len(self.inputs):
+            new_inputs = torch.cat(self.inputs[len(self.preds):], dim=1)
+            preds, self.past = self.option_dt.decode(new_inputs, self.attention_mask(len(self.inputs)), self.past)
+            self.preds.extend(preds.unbind(1))
+        if offset < len(self.preds):
+            return self.preds[-1 - offset]
+        if self.padding_preds is None:
+            self.padding_preds = self._padding_preds()
+        return self.padding_preds
+
+    def _padding_preds(self):
+        # a padding slot sees the language tokens and its own (masked) zero state at timestep 0
+        device = self.lang_attention_mask.device
+        state_dim = self.option_dt.state_dim
+        state_shape = state_dim if isinstance(state_dim, tuple) else (state_dim,)
+        state_embeddings = self.option_dt.embed_state(torch.zeros((1, 1, *state_shape), device=device))
+        inputs = self.option_dt.embed_steps(state_embeddings, torch.zeros((1, 1), dtype=torch.long, device=device))
+        attention_mask = torch.cat([self.lang_attention_mask, torch.zeros_like(self.lang_attention_mask[:, :1])], dim=1)
+        preds, _ = self.option_dt.decode(inputs, attention_mask, self.lang_past)
+        return preds[:, -1]
@@ -0,0 +1,90 @@
+import time
+
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def collate_trajectories(batch):
+    """Collate (language, states, actions, timesteps, dones, attention_mask) items of an ExpertDataset
+    and convert them to the dtypes used by the training loop.
+    Runs inside the DataLoader workers so the main process only has to move the batch to the device.
+    """
+    langs, states, actions, timesteps, dones, attention_mask = default_collate(batch)
+    return (langs,
+            states.float(),
+            actions.float(),
+            timesteps.long(),
+            dones.long(),
+            attention_mask.long())
+
+
+def to_device(batch, device, non_blocking=False):
+    """Move every tensor in a (nested) tuple/list/dict batch to device, leave everything else as is"""
+    if torch.is_tensor(batch):
+        if non_blocking and not batch.is_pinned():
+            batch = batch.pin_memory()
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, (tuple, list)):
+        return type(batch)(to_device(x, device, non_blocking) for x in batch)
+    elif isinstance(batch, dict):
+        return {k: to_device(v, device, non_blocking) for k, v in batch.items()}
+    return batch
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader and yields batches that are already on `device`.
+
+    On CUDA the next batch is copied from pinned memory on a side stream with non-blocking copies
+    while the current batch is being used (double buffering). `wait_time` accumulates the seconds
+    spent waiting on the DataLoader during the last pass.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.use_cuda = self.device.type == 'cuda' and torch.cuda.is_available()
+        self.wait_time = 0.
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, loader_iter, stream):
+        start = time.time()
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        self.wait_time += time.time() - start
+
+        if stream is None:
+            return to_device(batch, self.device)
+        with torch.cuda.stream(stream):
+            return to_device(batch, self.device, non_blocking=True)
+
+    def __iter__(self):
+        self.wait_time = 0.
+        stream = torch.cuda.Stream(device=self.device) if self.use_cuda else None
+        loader_iter = iter(self.loader)
+
+        next_batch = self._preload(loader_iter, stream)
+        while next_batch is not None:
+            batch = next_batch
+            if stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                # the batch was allocated on the side stream but is used on the current one
+                for x in _tensors(batch):
+                    x.record_stream(torch.cuda.current_stream(self.device))
+            next_batch = self._preload(loader_iter, stream)
+            yield batch
+
+
+def _tensors(batch):
+    if torch.is_tensor(batch):
+        yield batch
+    elif isinstance(batch, (tuple, list)):
+        for x in batch:
+            yield from _tensors(x)
+    elif isinstance(batch, dict):
+        for x in batch.values():
+            yield from _tensors(x)
@@ -0,0 +1,130 @@
+"""
+Parity of the batched kernels of diffuser.utils.transformations with their single-transform versions,
+on numpy arrays and torch tensors. Run from skilldiffuser/hrl with `python -m pytest tests`.
+"""
+import math
+
+import numpy as np
+import pytest
+
+from diffuser.utils import transformations as tf
+
+BACKENDS = ['numpy', pytest.param('torch', marks=pytest.mark.skipif(tf.torch is None, reason='torch not installed'))]
+
+
+def to_backend(x, backend):
+    return tf.torch.as_tensor(np.asarray(x, dtype=np.float64)) if backend == 'torch' else np.asarray(x)
+
+
+def to_numpy(x):
+    return x.numpy() if tf.torch is not None and tf.torch.is_tensor(x) else np.asarray(x)
+
+
+def assert_rows_close(batched, scalar_fn, inputs):
+    batched = to_numpy(batched)
+    assert len(batched) == len(inputs[0])
+    for n in range(len(batched)):
+        np.testing.assert_allclose(batched[n], scalar_fn(*(x[n] for x in inputs)), atol=1e-12, equal_nan=True)
+
+
+@pytest.fixture
+def rng():
+    return np.random.RandomState(0)
+
+
+def random_quaternions(rng, n):
+    return np.stack([tf.random_quaternion(rng.rand(3)) for _ in range(n)])
+
+
+def random_matrices(rng, n):
+    return np.stack([tf.random_rotation_matrix(rng.rand(3)) for _ in range(n)])
+
+
+def gimbal_lock_matrices():
+    # rotations where the scalar euler_from_matrix takes its sy / cy <= _EPS branch, for every axes sequence
+    angles = [(0.3, math.pi / 2, -0.2), (1.0, -math.pi / 2, 0.5), (0.4, 0.0, 0.7), (-0.6, math.pi, 0.1)]
+    return np.stack([tf.euler_matrix(*a, axes=axes) for axes in tf._AXES2TUPLE for a in angles])
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_unit_vectors(backend, rng):
+    v = rng.rand(20, 4) - 0.5
+    v[0] = 0.0  # nan, as in unit_vector
+    with np.errstate(invalid='ignore'):
+        assert_rows_close(tf.unit_vectors(to_backend(v, backend)), tf.unit_vector, (v,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_quaternion_matrices(backend, rng):
+    q = np.concatenate([random_quaternions(rng, 50), 3 * random_quaternions(rng, 5),
+                        np.zeros((1, 4)), np.full((1, 4), 1e-9)])  # zero and below _EPS give the identity
+    assert_rows_close(tf.quaternion_matrices(to_backend(q, backend)), tf.quaternion_matrix, (q,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_quaternions_from_matrices(backend, rng):
+    R = np.concatenate([random_matrices(rng, 50), gimbal_lock_matrices(),
+                        # trace <= M[3, 3], one per largest diagonal element
+                        [np.diag([1.0, -1, -1, 1]), np.diag([-1.0, 1, -1, 1]), np.diag([-1.0, -1, 1, 1])]])
+    assert_rows_close(tf.quaternions_from_matrices(to_backend(R, backend)), tf.quaternion_from_matrix, (R,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('axes', sorted(tf._AXES2TUPLE))
+def test_eulers_from_matrices(backend, axes, rng):
+    R = np.concatenate([random_matrices(rng, 20), gimbal_lock_matrices()])
+    assert_rows_close(tf.eulers_from_matrices(to_backend(R, backend), axes),
+                      lambda M: tf.euler_from_matrix(M, axes), (R,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('axes', ['sxyz', 'rxyz', 'szxz', 'rzyx'])
+def test_eulers_from_quaternions(backend, axes, rng):
+    q = np.concatenate([random_quaternions(rng, 20), tf.quaternions_from_matrices(gimbal_lock_matrices()),
+                        np.zeros((1, 4))])
+    assert_rows_close(tf.eulers_from_quaternions(to_backend(q, backend), axes),
+                      lambda x: tf.euler_from_quaternion(x, axes), (q,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('axes', sorted(tf._AXES2TUPLE))
+def test_quaternions_from_eulers(backend, axes, rng):
+    angles = np.concatenate([4 * math.pi * (rng.rand(20, 3) - 0.5), [[0.3, math.pi / 2, -0.2], [0.0, 0.0, 0.0]]])
+    assert_rows_close(tf.quaternions_from_eulers(to_backend(angles, backend), axes),
+                      lambda a: tf.quaternion_from_euler(*a, axes=axes), (angles,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_quaternions_multiply_conjugate_inverse(backend, rng):
+    q0, q1 = random_quaternions(rng, 20), 2 * random_quaternions(rng, 20)
+    assert_rows_close(tf.quaternions_multiply(to_backend(q1, backend), to_backend(q0, backend)),
+                      tf.quaternion_multiply, (q1, q0))
+    assert_rows_close(tf.quaternions_conjugate(to_backend(q1, backend)), tf.quaternion_conjugate, (q1,))
+    assert_rows_close(tf.quaternions_inverse(to_backend(q1, backend)), tf.quaternion_inverse, (q1,))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('spin, shortestpath', [(0, True), (0, False), (1, True)])
+def test_quaternions_slerp(backend, spin, shortestpath, rng):
+    n = 30
+    q0, q1 = random_quaternions(rng, n), random_quaternions(rng, n)
+    fraction = rng.rand(n)
+    fraction[:2] = 0.0, 1.0
+    q1[2], q1[3] = q0[2], -q0[3]  # |d| = 1, q0 is returned
+    q1[4] = -q1[4]  # d < 0, shortest path flips q1
+    q0[5] = 2 * q0[5]  # not normalized
+    q0[6], q1[7] = 0.0, 0.0  # zero quaternions, nan as in the scalar version
+    slerp = lambda a, b, f: tf.quaternion_slerp(a, b, f, spin=spin, shortestpath=shortestpath)
+    with np.errstate(invalid='ignore'):
+        batched = tf.quaternions_slerp(to_backend(q0, backend), to_backend(q1, backend), to_backend(fraction, backend),
+                                       spin=spin, shortestpath=shortestpath)
+        assert_rows_close(batched, slerp, (q0, q1, fraction))
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_quaternions_slerp_broadcasts(backend, rng):
+    q0, q1 = random_quaternions(rng, 2)
+    fractions = np.linspace(0, 1, 7)
+    batched = tf.quaternions_slerp(to_backend(q0, backend), to_backend(q1, backend), to_backend(fractions, backend))
+    assert_rows_close(batched, lambda f: tf.quaternion_slerp(q0, q1, f), (fractions,))
+    assert to_numpy(tf.quaternions_slerp(q0, q1, [])).shape == (0, 4)
@@ -5,15 +5,18 @@ import torch.nn as nn
 from torch.utils.data import DataLoader
 import torch.nn.functional as F
 import time
-import imageio
+from itertools import chain
 import numpy as np
 from tqdm import tqdm
 import os
-import imageio
 import wandb
 
-from env import BaseWrapper, LorlWrapper, BabyAIWrapper
-from eval import eval_episode
+from adaptive_eval import AdaptiveEvalSchedule
+from env import BaseWrapper, LorlWrapper, BabyAIWrapper, LorlResetPool
+from eval import eval_episode, parallel_eval_episodes
+from offline_eval import offline_evaluate
+from video_sink import VideoSink
+from vec_env import DatasetStats, SubprocEnvs
 from utils import pad, LORL_EVAL_INSTRS, LORL_COMPOSITION_INSTRS
 from viz import get_tokens, viz_matrix, plot_hist, viz_matrix2
 
@@ -22,7 +25,9 @@ class Trainer:
 
     def __init__(self, args, model, tokenizer, optimizer, train_loader, env=None, env_name=None, val_loader=None,
                  state_il=True, scheduler=None, eval_episode_factor=2, eval_every=50, num_eval_episodes=10, K=10,
-                 skip_words=None, device='cuda'):
+                 skip_words=None, device='cuda', n_eval_envs=1, lorl_reset_pool=False, offline_eval_workers=1,
+                 adaptive_eval=False, min_eval_episodes=10, eval_ci_width=0.2, eval_ci='wilson', eval_budget=None,
+                 inline_eval=True):
         self.args = args
         self.model = model
         self.tokenizer = tokenizer
@@ -39,6 +44,18 @@ class Trainer:
         self.device = device
         self.K = K  # DT sequence length
         self.skip_words = skip_words
+        self.n_eval_envs = n_eval_envs  # > 1: evaluate without rendering in that many env worker processes
+        self.eval_envs = {}
+        self.lorl_reset_pool = lorl_reset_pool  # start LOReL eval episodes from pooled initial states
+        self.reset_pool = None
+        self.offline_eval_workers = offline_eval_workers  # processes of the offline evaluation (env.eval_offline)
+        # LOReL evaluation stopping early for the instructions whose success rate is known well enough
+        self.adaptive_eval = adaptive_eval
+        self.min_eval_episodes = min_eval_episodes
+        self.eval_ci_width = eval_ci_width
+        self.eval_ci = eval_ci
+        self.eval_budget = eval_budget
+        self.inline_eval = inline_eval  # False leaves the evaluation of the saved checkpoints to eval_farm.py
 
         self.start_time = time.time()
 
@@ -50,11 +67,13 @@ class Trainer:
         entropies, lang_entropies, mutual_info = [], [], []
         logs = dict()
 
-        if iter_num == 1:
+        if iter_num == 1 and self.inline_eval:
             eval_start = time.time()
 
             self.model.eval()
-            eval_outputs = self.evaluate(iter_num, render=eval_render, render_path=self.args.render_path)
+            eval_outputs = self.evaluate(iter_num, render=eval_render, render_path=self.args.render_path,
+                                         render_size=getattr(self.args, 'render_size', None),
+                                         render_fps=getattr(self.args, 'render_fps', 25))
             for k, v in eval_outputs.items():
                 logs[f'evaluation/{k}'] = v
             logs['time/evaluation'] = time.time() - eval_start
@@ -265,9 +284,18 @@ class Trainer:
 
         return logs
 
-    def evaluate(self, iter_num, render=False, max_ep_len=500, render_path='', render_freq=1, lorl_compose=True):
+    def evaluate(self, iter_num, render=False, max_ep_len=500, render_path='', render_freq=1, lorl_compose=True,
+                 render_size=None, render_fps=25):
         model = self.model
 
+        # rendered episodes are encoded in the background and only waited for at the end of the evaluation
+        sinks = []
+
+        def open_sink(path):
+            sink = VideoSink(path, fps=render_fps, size=render_size)
+            sinks.append(sink)
+            return sink
+
         if hasattr(self.model, 'module'):
             model = self.model.module
 
@@ -289,31 +317,42 @@ class Trainer:
             max_ep_len = self.eval_episode_factor * self.train_loader.dataset.max_length
 
             returns, lengths, successes = [], [], []
-            for i in tqdm(range(1, self.num_eval_episodes + 1)):
-                env = BabyAIWrapper(self.env, self.train_loader.dataset)
+            if self.n_eval_envs > 1 and not render:
+                results = self.evaluate_parallel(BabyAIWrapper, [{}] * self.num_eval_episodes, model, no_lang,
+                                                 max_ep_len, words_dict, device, ema_diffusion_model)
+                for episode_return, episode_length, success, _, _ in results:
+                    returns.append(episode_return)
+                    lengths.append(episode_length)
+                    successes.append(success)
+            else:
+                for i in tqdm(range(1, self.num_eval_episodes + 1)):
+                    env = BabyAIWrapper(self.env, self.train_loader.dataset)
 
-                episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
-                    env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
-                    render_path=render_path, render_freq=render_freq, iter_num=iter_num, i=i, ema_diffusion_model=ema_diffusion_model)
+                    sink = None
+                    if render and i % render_freq == 0:
+                        r = f'{iter_num}_{i}'
+                        if not os.path.isdir(render_path):
+                            os.makedirs(render_path, exist_ok=True)
+                        sink = open_sink(f'{render_path}/{r}.gif')
 
-                if render and i % render_freq == 0:
-                    r = f'{iter_num}_{i}'
-                    if not os.path.isdir(render_path):
-                        os.makedirs(render_path, exist_ok=True)
-                    images[0].save(f'{render_path}/{r}.gif', save_all=True,
-                                   append_images=images[1:], optimize=False, duration=40, loop=0)
-                    with open(f'{render_path}/{r}.txt', 'w') as fp:
-                        fp.write(lang)
+                    episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
+                        env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
+                        render_path=render_path, render_freq=render_freq, iter_num=iter_num, i=i, ema_diffusion_model=ema_diffusion_model, sink=sink)
 
-                    print(options_list)
-                    print(f'Return: {episode_return}')
+                    if sink is not None:
+                        sink.close()
+                        with open(f'{render_path}/{r}.txt', 'w') as fp:
+                            fp.write(lang)
 
-                    with open(f'{render_path}/{r}_options.txt', 'w') as fp:
-                        fp.write(str(options_list))
+                        print(options_list)
+                        print(f'Return: {episode_return}')
 
-                returns.append(episode_return)
-                lengths.append(episode_length)
-                successes.append(success)
+                        with open(f'{render_path}/{r}_options.txt', 'w') as fp:
+                            fp.write(str(options_list))
+
+                    returns.append(episode_return)
+                    lengths.append(episode_length)
+                    successes.append(success)
 
             metrics = {
                 f'return_mean': np.mean(returns),
@@ -342,21 +381,43 @@ class Trainer:
             #     'seen', 'unseen verb', 'unseen noun', 'unseen verb noun', 'human']}
 
             instr_wise_stats = {k: [] for k in LORL_COMPOSITION_INSTRS}
-
-            for i in tqdm(range(1, self.num_eval_episodes+1)):
-                for instr in LORL_COMPOSITION_INSTRS:
-                    # for rephrasal_type, instr_list in rephrasals.items():
+            reset_state = self.lorl_reset_states([(instr, instr) for instr in LORL_COMPOSITION_INSTRS], render)
+            schedule = self.adaptive_eval_schedule(LORL_COMPOSITION_INSTRS)
+
+            if self.n_eval_envs > 1 and not render:
+                for episodes in self.lorl_eval_batches(LORL_COMPOSITION_INSTRS, schedule, self.n_eval_envs):
+                    tasks = [dict(instr=instr, orig_instr=instr, reset_state=reset_state(instr, instr, i))
+                             for instr, i in episodes]
+                    results = self.evaluate_parallel(LorlWrapper, tasks, model, no_lang,
+                                                     max_ep_len, words_dict, device, ema_diffusion_model)
+                    for task, (episode_return, episode_length, success, _, _) in zip(tasks, results):
+                        dists.append(episode_return)
+                        lengths.append(episode_length)
+                        successes.append(success)
+                        instr_wise_stats[task['instr']].append(success)
+                        if schedule is not None:
+                            schedule.update(task['instr'], success)
+            else:
+                episodes = chain.from_iterable(self.lorl_eval_batches(LORL_COMPOSITION_INSTRS, schedule, 1))
+                total = (schedule.budget if schedule is not None
+                         else self.num_eval_episodes * len(LORL_COMPOSITION_INSTRS))
+                for instr, episode in tqdm(episodes, total=total):
+                    i = episode + 1
                     env = LorlWrapper(self.env, self.train_loader.dataset,
-                                      instr=instr, orig_instr=instr)
+                                      instr=instr, orig_instr=instr, reset_state=reset_state(instr, instr, episode))
+                    sink = None
+                    if render and i % render_freq == 0:
+                        r = f'{iter_num}_{i}'
+                        sink = open_sink(f'{render_path}/episode_{r}_{instr}.gif')
+
                     with torch.no_grad():
                         episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
                             env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
                             render_path=render_path, ema_diffusion_model=ema_diffusion_model,
-                            render_freq=render_freq, iter_num=iter_num, i=i)
+                            render_freq=render_freq, iter_num=iter_num, i=i, sink=sink)
 
-                    if render and i % render_freq == 0:
-                        r = f'{iter_num}_{i}'
-                        imageio.mimsave(f'{render_path}/episode_{r}_{instr}.gif', images)
+                    if sink is not None:
+                        sink.close()
                         print(options_list)
                         print(f'Success: {success}')
 
@@ -367,7 +428,8 @@ class Trainer:
                     lengths.append(episode_length)
                     successes.append(success)
                     instr_wise_stats[instr].append(success)
-                    # rephrasal_wise_stats[rephrasal_type].append(success)
+                    if schedule is not None:
+                        schedule.update(instr, success)
 
             instr_wise_stats = {k: np.mean(instr_wise_stats[k]) for k in instr_wise_stats.keys()}
             # rephrasal_wise_stats = {k: np.mean(rephrasal_wise_stats[k]) for k in rephrasal_wise_stats.keys()}
@@ -383,6 +445,8 @@ class Trainer:
                 f'success_rate': np.mean(successes),
                 f'instr_wise': plot_hist(instr_wise_stats),}
                 # f'rephrasal_wise': plot_hist(rephrasal_wise_stats)}
+            if schedule is not None:
+                metrics.update(schedule.metrics())
 
         elif self.env and 'Lorl' in self.env.unwrapped.spec.id and not lorl_compose:
             # For Lorl env
@@ -400,22 +464,56 @@ class Trainer:
             instr_wise_stats = {k: [] for k in LORL_EVAL_INSTRS.keys()}
             rephrasal_wise_stats = {k: [] for k in [
                 'seen', 'unseen verb', 'unseen noun', 'unseen verb noun', 'human']}
-
-            for i in tqdm(range(1, self.num_eval_episodes+1)):
-                for orig_instr, rephrasals in LORL_EVAL_INSTRS.items():
-                    for rephrasal_type, instr_list in rephrasals.items():
+            reset_state = self.lorl_reset_states(
+                [(orig_instr, instr) for orig_instr, rephrasals in LORL_EVAL_INSTRS.items()
+                 for instr_list in rephrasals.values() for instr in instr_list], render)
+            # an episode of an instruction runs all of its rephrasals
+            schedule = self.adaptive_eval_schedule(LORL_EVAL_INSTRS.keys())
+
+            if self.n_eval_envs > 1 and not render:
+                rollouts = max(sum(map(len, rephrasals.values())) for rephrasals in LORL_EVAL_INSTRS.values())
+                for episodes in self.lorl_eval_batches(LORL_EVAL_INSTRS.keys(), schedule,
+                                                       max(self.n_eval_envs // rollouts, 1)):
+                    tasks, rephrasal_types = [], []
+                    for orig_instr, i in episodes:
+                        for rephrasal_type, instr_list in LORL_EVAL_INSTRS[orig_instr].items():
+                            tasks += [dict(instr=instr, orig_instr=orig_instr,
+                                           reset_state=reset_state(orig_instr, instr, i)) for instr in instr_list]
+                            rephrasal_types += [rephrasal_type] * len(instr_list)
+                    results = self.evaluate_parallel(LorlWrapper, tasks, model, no_lang,
+                                                     max_ep_len, words_dict, device, ema_diffusion_model)
+                    for task, rephrasal_type, (episode_return, episode_length, success, _, _) in zip(
+                            tasks, rephrasal_types, results):
+                        dists.append(episode_return)
+                        lengths.append(episode_length)
+                        successes.append(success)
+                        instr_wise_stats[task['orig_instr']].append(success)
+                        rephrasal_wise_stats[rephrasal_type].append(success)
+                        if schedule is not None:
+                            schedule.update(task['orig_instr'], success)
+            else:
+                episodes = chain.from_iterable(self.lorl_eval_batches(LORL_EVAL_INSTRS.keys(), schedule, 1))
+                total = schedule.budget if schedule is not None else self.num_eval_episodes * len(LORL_EVAL_INSTRS)
+                for orig_instr, episode in tqdm(episodes, total=total):
+                    i = episode + 1
+                    for rephrasal_type, instr_list in LORL_EVAL_INSTRS[orig_instr].items():
                         for instr in instr_list:
                             env = LorlWrapper(self.env, self.train_loader.dataset,
-                                              instr=instr, orig_instr=orig_instr)
+                                              instr=instr, orig_instr=orig_instr,
+                                              reset_state=reset_state(orig_instr, instr, episode))
+                            sink = None
+                            if render and i % render_freq == 0:
+                                r = f'{iter_num}_{i}'
+                                sink = open_sink(f'{render_path}/episode_{r}_{instr}.gif')
+
                             with torch.no_grad():
                                 episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
                                     env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
                                     render_path=render_path, ema_diffusion_model=ema_diffusion_model,
-                                    render_freq=render_freq, iter_num=iter_num, i=i)
+                                    render_freq=render_freq, iter_num=iter_num, i=i, sink=sink)
 
-                            if render and i % render_freq == 0:
-                                r = f'{iter_num}_{i}'
-                                imageio.mimsave(f'{render_path}/episode_{r}_{instr}.gif', images)
+                            if sink is not None:
+                                sink.close()
                                 print(options_list)
                                 print(f'Success: {success}')
 
@@ -427,6 +525,8 @@ class Trainer:
                             successes.append(success)
                             instr_wise_stats[orig_instr].append(success)
                             rephrasal_wise_stats[rephrasal_type].append(success)
+                            if schedule is not None:
+                                schedule.update(orig_instr, success)
 
             instr_wise_stats = {k: np.mean(instr_wise_stats[k]) for k in instr_wise_stats.keys()}
             rephrasal_wise_stats = {k: np.mean(rephrasal_wise_stats[k]) for k in rephrasal_wise_stats.keys()}
@@ -442,6 +542,8 @@ class Trainer:
                 f'success_rate': np.mean(successes),
                 f'instr_wise': plot_hist(instr_wise_stats),
                 f'rephrasal_wise': plot_hist(rephrasal_wise_stats)}
+            if schedule is not None:
+                metrics.update(schedule.metrics())
 
         elif self.env and 'Hopper' in self.env.unwrapped.spec.id:
             # For env
@@ -452,16 +554,19 @@ class Trainer:
             for i in tqdm(range(1, self.num_eval_episodes + 1)):
                 env = BaseWrapper(self.env, self.train_loader.dataset)
 
-                episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
-                    env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
-                    render_path=render_path, render_freq=render_freq, iter_num=iter_num, i=i)
-
+                sink = None
                 if render and i % render_freq == 0:
                     r = f'{iter_num}_{i}'
                     if not os.path.isdir(render_path):
                         os.makedirs(render_path, exist_ok=True)
-                    images[0].save(f'{render_path}/{r}.gif', save_all=True,
-                                   append_images=images[1:], optimize=False, duration=40, loop=0)
+                    sink = open_sink(f'{render_path}/{r}.gif')
+
+                episode_return, episode_length, success, options_list, lang, images, words_dict = eval_episode(
+                    env, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict, render, device,
+                    render_path=render_path, render_freq=render_freq, iter_num=iter_num, i=i, sink=sink)
+
+                if sink is not None:
+                    sink.close()
                     with open(f'{render_path}/{r}.txt', 'w') as fp:
                         fp.write(lang)
 
@@ -483,99 +588,13 @@ class Trainer:
                 f'success_rate': np.mean(successes),
             }
         else:
-            discrete = model.diffuser.discrete
-            train_losses, action_losses, action_errors, state_losses = [], [], [], []
-            state_rc_losses, lang_rc_losses = [], []
-
-            for langs, states, actions, timesteps, dones, attention_mask in tqdm(self.val_loader):
-                lm_input = self.tokenizer(text=langs, add_special_tokens=True,
-                                          return_tensors='pt', padding=True).to(self.device)
-
-                if method == 'traj_option' or method == 'option':
-                    # Pad sequences to allows reshape
-                    K = self.K
-                    B, L, _ = states.shape
-                    num_seq = (L // K + 1)
-                    padded_length = num_seq * K
-
-                    # This ensures the DT only looks at chunks of size horizon
-                    states = pad(states, padded_length)
-                    actions = pad(actions, padded_length)
-                    timesteps = pad(timesteps, padded_length)
-                    attention_mask = pad(attention_mask, padded_length)
-
-                action_target = torch.clone(actions).detach()
-                state_target = torch.clone(states).detach()
-
-                if discrete:
-                    actions = F.one_hot(actions.long(), act_dim)
-
-                states = states.float().to(self.device)
-                actions = actions.float().to(self.device)
-                timesteps = timesteps.long().to(self.device)
-                attention_mask = attention_mask.long().to(self.device)
-                dones = dones.long().to(self.device)
-                action_target = action_target.long().to(self.device)
-                state_target = state_target.float().to(self.device)
-
-                outputs = self.model(lm_input['input_ids'], lm_input['attention_mask'],
-                                     states, actions, timesteps, attention_mask=attention_mask)
-
-                state_preds, action_preds = outputs['dt']
-                state_rc_preds, state_rc_targets = outputs['state_rc']
-                lang_rc_preds, lang_rc_targets = outputs['lang_rc']
-
-                act_dim = action_preds.shape[-1]
-                state_dim = state_preds.shape[-1]
-                action_preds = action_preds.reshape(-1, act_dim)[attention_mask.reshape(-1) > 0]
-                action_target = action_target.reshape(-1)[attention_mask.reshape(-1) > 0]
-
-                attention_mask = attention_mask.reshape(state_preds.shape[0], -1)
-                B, _ = attention_mask.shape
-                # Pad extra zero to mask for target state prediction to ignore s_0
-                target_attention_mask = torch.cat(
-                    [torch.zeros(B, 1).to(self.device), attention_mask[:, :-1]], axis=-1)
-                # Pred states are from s1, ... s_T (ignoring s_T+1). We remove the last element of the mask to get correct shapes.
-                pred_attention_mask = attention_mask[:, :-1]
-
-                # We actually don't do this in the old DT code
-                state_preds = state_preds.reshape(-1,
-                                                  state_dim)[pred_attention_mask.reshape(-1) > 0]
-                state_target = state_target.reshape(-1,
-                                                    state_dim)[target_attention_mask.reshape(-1) > 0]
-
-                dones = dones.reshape(-1)[attention_mask.reshape(-1) > 0]
-                if self.state_il:
-                    act_loss, state_loss = imitation_loss(
-                        action_preds, action_target, state_preds, state_target, discrete,
-                        loss_fn=model.iq_critic_loss, step=iter_num)
-                else:
-                    act_loss, state_loss = imitation_loss(
-                        action_preds, action_target, None, None, discrete, loss_fn=model.iq_critic_loss, step=iter_num)
-
-                state_rc_loss = state_reconstruction_loss(state_rc_preds, state_rc_targets)
-                lang_rc_loss = lang_reconstruction_loss(lang_rc_preds, lang_rc_targets)
-                loss = act_loss + state_loss + state_rc_loss + lang_rc_loss
-
-                train_losses.append(loss.detach().cpu().item())
-                if discrete:
-                    action_errors.append(1 - torch.mean(
-                        (torch.argmax(action_preds, dim=1) == action_target).float()).detach().cpu().item())
-                action_losses.append(act_loss.detach().cpu().item())
-                state_losses.append(state_loss.detach().cpu().item())
-                state_rc_losses.append(state_rc_loss.detach().cpu().item())
-                lang_rc_losses.append(lang_rc_loss.detach().cpu().item())
+            # held-out trajectories, without simulator
+            metrics = offline_evaluate(model, self.tokenizer, self.val_loader.dataset,
+                                       batch_size=self.val_loader.batch_size, device=device,
+                                       n_workers=self.offline_eval_workers, seed=getattr(self.args, 'seed', 0))
 
-            metrics = {
-                'eval_loss_mean': np.mean(train_losses),
-                'eval_loss_std': np.std(train_losses),
-                'action_pred_loss': np.mean(action_losses),
-                'state_pred_loss': np.mean(state_losses),
-                'state_rc_loss': np.mean(state_rc_losses),
-                'lang_rc_loss': np.mean(lang_rc_losses)
-            }
-            if discrete:
-                metrics['action_error'] = np.mean(action_errors)
+        for sink in sinks:
+            sink.join()
 
         if method != 'vanilla' and model.option_selector.use_vq:
             # viz_matrix(words_dict, num_options, iter_num, self.skip_words)
@@ -586,22 +605,71 @@ class Trainer:
             # # self.skip_words = ['go', 'to', 'the', 'a', '[SEP]', '.']
             words_dict = {0: ['pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]'], 1: [], 2: ['pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]', 'move', 'black', 'mug', 'down', '[SEP]'], 3: [], 4: [], 5: ['turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]'], 6: ['open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'down', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]'], 7: ['move', 'white', 'mug', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]'], 8: ['pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]', 'pull', 'the', 'handle', 'and', 'move', 'black', 'mug', 'down', '[SEP]'], 9: ['open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'open', 'drawer', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]', 'turn', 'fa', '##uce', '##t', 'right', 'and', 'close', 'drawer', '[SEP]'], 10: ['move', 'white', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]'], 11: [], 12: ['turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]'], 13: [], 14: ['open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'right', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]', 'open', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'counter', '##cl', '##ock', '##wise', '[SEP]'], 15: ['move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'move', 'white', 'mug', 'right', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'drawer', 'and', 'turn', 'fa', '##uce', '##t', 'left', '[SEP]', 'close', 'the', 'drawer', ',', 'turn', 'the', 'fa', '##uce', '##t', 'left', 'and', 'move', 'black', 'mug', 'right', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]'], 16: [], 17: ['slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]', 'slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]'], 18: ['slide', 'the', 'drawer', 'closed', 'and', 'then', 'shift', 'white', 'mug', 'down', '[SEP]'], 19: ['turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]', 'turn', 'fa', '##uce', '##t', 'left', 'and', 'move', 'white', 'mug', 'down', '[SEP]']}
             viz_matrix2(words_dict, num_options, iter_num, self.skip_words)
-            pdb.set_trace()
 
         return metrics
 
+    def lorl_reset_states(self, instrs, render=False):
+        """Returns reset_state(orig_instr, instr, i), the LorlWrapper reset_state of the i-th eval episode of
+        (orig_instr, instr): None, or a state of the reset pool (generated on first use, in n_eval_envs processes)
+        """
+        if not self.lorl_reset_pool or render:
+            return lambda orig_instr, instr, i: None
+
+        if self.reset_pool is None:
+            self.reset_pool = LorlResetPool(self.env.unwrapped.spec.id, seed=getattr(self.args, 'seed', 0),
+                                            n_workers=self.n_eval_envs)
+        self.reset_pool.fill(instrs, self.num_eval_episodes)
+        return self.reset_pool.get
+
+    def adaptive_eval_schedule(self, instrs):
+        """AdaptiveEvalSchedule of the LOReL instructions with adaptive_eval, else None (num_eval_episodes each)"""
+        if not self.adaptive_eval:
+            return None
+        # at most num_eval_episodes per instruction, the reset pool holds that many initial states
+        return AdaptiveEvalSchedule(instrs, self.num_eval_episodes, min_episodes=self.min_eval_episodes,
+                                    target_width=self.eval_ci_width, budget=self.eval_budget, interval=self.eval_ci)
+
+    def lorl_eval_batches(self, instrs, schedule, batch_size):
+        """Batches of (instr, episode index) to evaluate: all the episodes at once without schedule, else the next
+        batch_size episodes of the schedule, asked for once the previous batch has been evaluated
+        """
+        if schedule is None:
+            yield [(instr, i) for i in range(self.num_eval_episodes) for instr in instrs]
+            return
+        while True:
+            episodes = schedule.next_episodes(batch_size)
+            if not episodes:
+                return
+            yield episodes
+
+    def evaluate_parallel(self, wrapper_cls, tasks, model, no_lang, max_ep_len, words_dict, device,
+                          ema_diffusion_model):
+        """Run one episode per task (wrapper kwargs) in self.n_eval_envs worker processes with batched inference.
+        The workers are started on first use and kept for the following evaluations.
+        """
+        if wrapper_cls not in self.eval_envs:
+            self.eval_envs[wrapper_cls] = SubprocEnvs(
+                self.env.unwrapped.spec.id, wrapper_cls, self.train_loader.dataset, self.n_eval_envs,
+                seed=getattr(self.args, 'seed', 0))
+        return parallel_eval_episodes(
+            self.eval_envs[wrapper_cls], tasks, no_lang, self.tokenizer, model, max_ep_len, self.K, words_dict,
+            device, ema_diffusion_model)
+
     def save(self, iter_num, filepath, config):
         if hasattr(self.model, 'module'):
             model = self.model.module
         else:
             model = self.model
 
+        # written next to filepath and moved in place, so a watcher (eval_farm.py) never sees a partial checkpoint
         torch.save({'model': model.state_dict(),
                     'optimizer': self.optimizer.state_dict(),
                     'scheduler': self.scheduler.state_dict(),
                     'iter_num': iter_num,
                     'train_dataset_max_length': self.train_loader.dataset.max_length,
-                    'config': config}, filepath)
+                    'dataset_stats': DatasetStats(self.train_loader.dataset),
+                    'config': config}, f'{filepath}.tmp')
+        os.replace(f'{filepath}.tmp', filepath)
 
     def load(self, filepath):
         checkpoint = torch.load(filepath)
@@ -47,6 +47,9 @@ from transformers.models.gpt2.configuration_gpt2 import GPT2Config
 
 logger = logging.get_logger(__name__)
 
+# attention weights are only materialized when they are returned, or without fused attention (torch < 2.0)
+_HAS_SDPA = hasattr(nn.functional, "scaled_dot_product_attention")
+
 _CONFIG_FOR_DOC = "GPT2Config"
 _TOKENIZER_FOR_DOC = "GPT2Tokenizer"
 
@@ -186,6 +189,26 @@ class Attention(nn.Module):
             outputs.append(w)
         return outputs
 
+    def _fused_attn(self, q, k, v, attention_mask=None):
+        """Same as _attn without attention weights, with torch's fused scaled_dot_product_attention kernels"""
+        k = k.transpose(-2, -1)  # keys are kept transposed, cf split_heads
+        nd, ns = q.size(-2), k.size(-2)
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        scale = None if self.scale else 1.0
+
+        if not self.is_cross_attention:
+            if attention_mask is None and nd == ns:
+                # no padding and no past, eligible for the flash attention kernel
+                return nn.functional.scaled_dot_product_attention(
+                    q, k, v, dropout_p=dropout_p, is_causal=True, scale=scale)
+            causal_mask = self.bias[:, :, ns - nd: ns, :ns].bool()
+            mask = torch.zeros(causal_mask.shape, dtype=q.dtype, device=q.device)
+            mask = mask.masked_fill(~causal_mask, self.masked_bias.item())
+            attention_mask = mask if attention_mask is None else mask + attention_mask
+
+        return nn.functional.scaled_dot_product_attention(
+            q, k, v, attn_mask=attention_mask, dropout_p=dropout_p, scale=scale)
+
     def merge_heads(self, x):
         x = x.permute(0, 2, 1, 3).contiguous()
         new_x_shape = x.size()[:-2] + (x.size(-2) * x.size(-1),)
@@ -233,7 +256,10 @@ class Attention(nn.Module):
         else:
             present = (None,)
 
-        attn_outputs = self._attn(query, key, value, attention_mask, head_mask, output_attentions)
+        if output_attentions or head_mask is not None or not _HAS_SDPA:
+            attn_outputs = self._attn(query, key, value, attention_mask, head_mask, output_attentions)
+        else:
+            attn_outputs = [self._fused_attn(query, key, value, attention_mask)]
         a = attn_outputs[0]
 
         a = self.merge_heads(a)
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -13,6 +14,7 @@ import string
 import torch.distributions as pyd
 from einops import rearrange, repeat
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 # We addded these instructions
 LORL_COMPOSITION_INSTRS = ['open drawer and move black mug right',
@@ -265,13 +267,77 @@ def pad(x, max_len, axis=1, const=0, mode='pre'):
     return x_padded
 
 
-def calculate_state_means_stds(states_list, state_dim=None):
-    # used for input normalization
+def _state_moments(states, state_dim, chunk_size):
+    """Single pass count/mean/M2 over one trajectory, read in chunks of `chunk_size` steps"""
+    count, mean, m2 = 0, None, None
+    for start in range(0, len(states), chunk_size):
+        if isinstance(state_dim, tuple):
+            chunk = np.asarray(states[start:start + chunk_size], dtype=np.float64)
+        else:
+            chunk = np.asarray(states[start:start + chunk_size, :state_dim], dtype=np.float64)
+        chunk_count = len(chunk)
+        if chunk_count == 0:
+            continue
+        chunk_mean = chunk.mean(axis=0)
+        chunk_m2 = ((chunk - chunk_mean) ** 2).sum(axis=0)
+        count, mean, m2 = _merge_moments((count, mean, m2), (chunk_count, chunk_mean, chunk_m2))
+    return count, mean, m2
+
+
+def _merge_moments(a, b):
+    """Combine two (count, mean, M2) triples (Chan et al. parallel variance)"""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    if count_a == 0:
+        return b
+    if count_b == 0:
+        return a
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + delta ** 2 * (count_a * count_b / count)
+    return count, mean, m2
+
+
+def calculate_state_means_stds(states_list, state_dim=None, chunk_size=4096, num_workers=0, cache_path=None):
+    """Streaming (Welford) mean and std of states, used for input normalization
+
+    Inputs:
+        states_list: List of per-trajectory state arrays
+        state_dim: Int to only use the first `state_dim` features, or a tuple for the full state shape
+        chunk_size: Number of steps of a trajectory reduced at once
+        num_workers: Reduce trajectories in a thread pool of this size (Default: 0, serial)
+        cache_path: If given, load the statistics from / save them to this .npz file
+    """
+    if cache_path is not None and os.path.isfile(cache_path):
+        stats = np.load(cache_path)
+        return stats['state_mean'], stats['state_std']
+
     if state_dim is None:
         state_dim = states_list[0].shape[-1]
-    states = [traj[:, :state_dim].reshape(-1, state_dim) for traj in states_list]
-    states = np.concatenate(states, axis=0)
-    state_mean, state_std = np.mean(states, axis=0), np.std(states, axis=0) + 1e-6
+    if isinstance(state_dim, list):
+        state_dim = tuple(state_dim)
+
+    moments = (0, None, None)
+    if num_workers > 0:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for traj_moments in executor.map(lambda s: _state_moments(s, state_dim, chunk_size), states_list):
+                moments = _merge_moments(moments, traj_moments)
+    else:
+        for states in states_list:
+            moments = _merge_moments(moments, _state_moments(states, state_dim, chunk_size))
+
+    count, mean, m2 = moments
+    dtype = states_list[0].dtype
+    dtype = dtype if np.issubdtype(dtype, np.floating) else np.float64
+    state_mean = mean.astype(dtype)
+    state_std = (np.sqrt(m2 / count) + 1e-6).astype(dtype)
+
+    if cache_path is not None:
+        try:
+            np.savez(cache_path, state_mean=state_mean, state_std=state_std)
+        except OSError:
+            print(f'Could not cache state statistics to {cache_path}')
     return state_mean, state_std
 
 
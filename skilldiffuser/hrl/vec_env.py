@@ -0,0 +1,91 @@
+import multiprocessing as mp
+
+
+class DatasetStats:
+    """The parts of an ExpertDataset used by the env wrappers and Trainer.evaluate, small enough to be sent to
+    worker processes and saved with the checkpoints"""
+
+    def __init__(self, dataset):
+        self.state_mean = dataset.state_mean
+        self.state_std = dataset.state_std
+        self.kwargs = dict(dataset.kwargs)
+        self.max_length = getattr(dataset, 'max_length', None)
+        self.no_lang = getattr(dataset, 'no_lang', False)
+
+
+def _worker(remote, parent_remote, env_id, wrapper_cls, stats, seed, env_kwargs):
+    parent_remote.close()
+    from env import make_env
+
+    base_env = make_env(env_id, **env_kwargs)
+    base_env.seed(seed)
+    env = None
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == 'reset':
+                # every episode gets a fresh wrapper, e.g. for a new LOReL instruction
+                env = wrapper_cls(base_env, stats, **data)
+                observation = env.reset(render=False)
+                remote.send((observation, env.state_dim, env.act_dim, env.action_space))
+            elif cmd == 'step':
+                remote.send(env.step(data))
+            elif cmd == 'close':
+                break
+            else:
+                raise NotImplementedError(cmd)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        base_env.close()
+        remote.close()
+
+
+class SubprocEnvs:
+    """
+    N copies of a gym env, each stepped in its own worker process.
+
+    Every worker builds `gym.make(env_id, **env_kwargs)` once and wraps it with
+    `wrapper_cls(env, DatasetStats(dataset), **kwargs)` at every `reset`, so consecutive episodes of a worker can use
+    different wrapper arguments (LOReL instructions).
+    `step` sends the actions of all the given envs before waiting for any of them, so the envs run in parallel.
+    """
+
+    def __init__(self, env_id, wrapper_cls, dataset, n_envs, seed=0, context='spawn', env_kwargs=None):
+        ctx = mp.get_context(context)
+        stats = DatasetStats(dataset)
+        self.n_envs = n_envs
+        self.remotes, self.processes = [], []
+        for rank in range(n_envs):
+            remote, work_remote = ctx.Pipe()
+            process = ctx.Process(target=_worker, daemon=True,
+                                  args=(work_remote, remote, env_id, wrapper_cls, stats, seed + rank, env_kwargs or {}))
+            process.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(process)
+        self.closed = False
+
+    def __len__(self):
+        return self.n_envs
+
+    def reset(self, env_ids, wrapper_kwargs):
+        """Start a new episode in every env of env_ids, returns (observation, state_dim, act_dim, action_space)s"""
+        for i, kwargs in zip(env_ids, wrapper_kwargs):
+            self.remotes[i].send(('reset', kwargs))
+        return [self.remotes[i].recv() for i in env_ids]
+
+    def step(self, env_ids, actions):
+        """Step every env of env_ids with its action, returns their (observation, reward, done, info)s"""
+        for i, action in zip(env_ids, actions):
+            self.remotes[i].send(('step', action))
+        return [self.remotes[i].recv() for i in env_ids]
+
+    def close(self):
+        if self.closed:
+            return
+        for remote in self.remotes:
+            remote.send(('close', None))
+        for process in self.processes:
+            process.join()
+        self.closed = True
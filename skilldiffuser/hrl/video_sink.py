@@ -0,0 +1,111 @@
+import os
+import queue
+import threading
+
+import numpy as np
+from PIL import GifImagePlugin, Image
+
+_CLOSE = object()
+
+
+class VideoSink:
+    """
+    Encodes the frames of a rollout in a background thread while the rollout is still running.
+
+    Frames (PIL images or H x W x C uint8 arrays) are pushed with `add` into a bounded queue, so at most
+    `max_queue` full-resolution frames are held in memory; `add` blocks when the encoder falls behind.
+    Every frame is downscaled to `size` (width, height) before it is written. Every format is streamed to
+    disk frame by frame: GIF frames are appended to the file as palette frames with their own color table,
+    any other extension goes through imageio (ffmpeg for .mp4).
+
+    `close` only enqueues the end of the video, call `join` (or use the sink as a context manager) to
+    wait until the file is written.
+    """
+
+    def __init__(self, path, fps=25, size=None, max_queue=32):
+        self.path = path
+        self.fps = fps
+        self.size = tuple(size) if size is not None else None
+        self.is_gif = os.path.splitext(path)[1].lower() == '.gif'
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._writer = None
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        self.join()
+
+    def add(self, frame):
+        if self._closed:
+            raise RuntimeError(f'Adding a frame to closed video sink {self.path}')
+        self._raise_error()
+        self._queue.put(frame)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_CLOSE)
+
+    def join(self):
+        self.close()
+        self._thread.join()
+        self._raise_error()
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise RuntimeError(f'Failed to encode video {self.path}') from self._error
+
+    def _run(self):
+        frame = None
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is _CLOSE:
+                    break
+                self._write(self._resize(frame))
+            self._finish()
+        except Exception as e:
+            self._error = e
+            # keep draining so that `add` never blocks on a dead encoder
+            while frame is not _CLOSE:
+                frame = self._queue.get()
+
+    def _resize(self, frame):
+        if not isinstance(frame, Image.Image):
+            frame = Image.fromarray(np.asarray(frame, dtype=np.uint8))
+        frame = frame.convert('RGB')
+        if self.size is not None and frame.size != self.size:
+            frame = frame.resize(self.size, Image.BILINEAR)
+        return frame
+
+    def _write(self, frame):
+        if self.is_gif:
+            self._write_gif(frame.convert('P', palette=Image.ADAPTIVE))
+            return
+        if self._writer is None:
+            import imageio
+            self._writer = imageio.get_writer(self.path, fps=self.fps)
+        self._writer.append_data(np.asarray(frame))
+
+    def _write_gif(self, frame):
+        # imageio and PIL's save(save_all=True) keep every frame until the file is closed, the GIF
+        # blocks are written here instead: the header (looping forever) and then one block per frame
+        if self._writer is None:
+            self._writer = open(self.path, 'wb')
+            header, _ = GifImagePlugin.getheader(frame, info={'loop': 0})
+            self._writer.writelines(header)
+        self._writer.writelines(GifImagePlugin.getdata(frame, include_color_table=True,
+                                                       duration=int(round(1000 / self.fps))))
+
+    def _finish(self):
+        if self._writer is not None:
+            if self.is_gif:
+                self._writer.write(b';')  # GIF trailer
+            self._writer.close()
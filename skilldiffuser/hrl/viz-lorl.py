@@ -131,7 +131,7 @@ def evaluate(cfg):
     if args.method == 'traj_option':
         args.option_selector.option_transformer.max_length = int(max_length)
         args.option_selector.option_transformer.max_ep_len = eval_episode_factor * int(max_length)
-        # args.option_selector.option_transformer.output_attention = True
+        args.option_selector.option_transformer.output_attention = True
 
     option_selector_args = dict(args.option_selector)
     option_selector_args['state_dim'] = state_dim